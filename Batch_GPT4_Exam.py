@@ -0,0 +1,175 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Batch export and import of Simple-template exam questions.
+
+Turns of a conversation depend on all prior answers, so they cannot be sent as a batch.
+In batch mode, each question is instead sent as an independent request consisting of the
+initial Simple-template prompt followed by the question. Every such request from one or more
+course settings files is compiled into an OpenAI Batch API input file (JSONL), and the completed
+batch results file is imported into Query_Reporter text reports with the usual details and
+usage blocks. Results may be partial or in any order; missing or failed requests are reported
+as such and listed on import.
+
+Usage:
+    python Batch_GPT4_Exam.py export BATCH_FILE SETTINGS_FILE [SETTINGS_FILE ...]
+    python Batch_GPT4_Exam.py import RESULTS_FILE SETTINGS_FILE [SETTINGS_FILE ...]
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import Query_GPT4_Exam
+
+BATCH_TEMPLATE_NAME = 'Simple'
+BATCH_URL = '/v1/chat/completions'
+BATCH_OUT_FILE_SUFFIX = '_Batch.txt'
+
+
+# Plan the independent batch requests for a single exam settings file.
+def plan_batch_requests(target_exam_file_name, template_name=BATCH_TEMPLATE_NAME):
+    """
+    Plan the independent batch requests for a single exam settings file.
+
+    Returns: (initial_prompt, out_file_name, requests), where requests is a list of dicts
+        with keys: custom_id, prompt_i, exam_prompt, messages.
+    """
+    conversations = [c for c in Query_GPT4_Exam.plan_conversations(target_exam_file_name)
+                     if c['template_name'] == template_name]
+    initial_prompt = conversations[0]['initial_prompt']
+    out_file_name = os.path.join(
+        Query_GPT4_Exam.IO_DIR,
+        conversations[0]['out_file_prefix'] + '_' + template_name + BATCH_OUT_FILE_SUFFIX
+    )
+
+    requests = []
+    for conversation in conversations:
+        for prompt_i, exam_prompt in conversation['prompts']:
+            messages = Query_GPT4_Exam.add_to_prompt(initial_prompt, 'user', exam_prompt)
+            messages = messages.to_messages()
+            messages_hash = hashlib.sha256(
+                json.dumps(messages, sort_keys=True).encode('utf-8')
+            ).hexdigest()[:12]
+            custom_id = '-'.join([conversation['out_file_prefix'], template_name,
+                                  '%04d' % prompt_i, messages_hash])
+            requests.append({
+                'custom_id': custom_id,
+                'prompt_i': prompt_i,
+                'exam_prompt': exam_prompt,
+                'messages': messages,
+            })
+    return initial_prompt, out_file_name, requests
+
+
+# Compile the independent requests of all exam settings files into a batch input file.
+def export_batch(target_exam_file_names, batch_file_name):
+    """Compile the independent requests of all exam settings files into a batch input file."""
+    num_requests = 0
+    with open(batch_file_name, 'w') as batch_file_obj:
+        for target_exam_file_name in target_exam_file_names:
+            _, _, requests = plan_batch_requests(target_exam_file_name)
+            for request in requests:
+                batch_line = {
+                    'custom_id': request['custom_id'],
+                    'method': 'POST',
+                    'url': BATCH_URL,
+                    'body': {
+                        'model': Query_GPT4_Exam.MODEL,
+                        'messages': request['messages'],
+                    },
+                }
+                batch_file_obj.write(json.dumps(batch_line) + '\n')
+                num_requests += 1
+    print('Wrote', num_requests, 'requests to batch file:', batch_file_name)
+    return num_requests
+
+
+# Load a batch results file.
+def load_batch_results(results_file_name):
+    """
+    Load a batch results file.
+
+    Returns: dict of custom_id to either a chat completion response body, or an error dict
+        with key "error" for failed requests.
+    """
+    results = {}
+    with open(results_file_name, 'r') as results_file_obj:
+        for line in results_file_obj:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if result.get('error') or response.get('status_code', 200) != 200:
+                results[result['custom_id']] = {
+                    'error': result.get('error') or response.get('body', {}).get('error')
+                }
+            else:
+                results[result['custom_id']] = response['body']
+    return results
+
+
+# Import a batch results file into text reports for all exam settings files.
+def import_batch(target_exam_file_names, results_file_name):
+    """
+    Import a batch results file into text reports for all exam settings files.
+
+    Returns: list of custom_ids of requests that are missing from or failed in the results.
+    """
+    results = load_batch_results(results_file_name)
+    missing = []
+    for target_exam_file_name in target_exam_file_names:
+        initial_prompt, out_file_name, requests = plan_batch_requests(target_exam_file_name)
+        query_reporter = Query_GPT4_Exam.Query_Reporter(out_file_name, initial_prompt)
+        for request in requests:
+            query_reporter({'role': 'user', 'content': request['exam_prompt']}, do_print=False)
+            response_obj = results.get(request['custom_id'])
+            if response_obj is None or 'error' in response_obj:
+                missing.append(request['custom_id'])
+                if response_obj is None:
+                    response = 'No response from GPT! (missing from batch results)'
+                else:
+                    response = 'No response from GPT! (batch error: '
+                    response += json.dumps(response_obj['error']) + ')'
+                query_reporter({'role': 'assistant', 'content': response}, do_print=False)
+                continue
+
+            processed_response = Query_GPT4_Exam.process_gpt_response(
+                response_obj,
+                print_completion=False,
+                print_response=False,
+                print_tokens=False,
+                print_details=False,
+            )
+            response, finish_reason, tokens, details, usage = processed_response
+            query_reporter({'role': 'assistant', 'content': response}, do_print=False)
+            if details is not None:
+                query_reporter.add_details(details, usage)
+        query_reporter.close()
+        print('Wrote batch report:', out_file_name)
+
+    if missing:
+        print('\nMissing or failed batch requests (' + str(len(missing)) + '):')
+        for custom_id in missing:
+            print('   ', custom_id)
+    return missing
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('action', choices=('export', 'import'),
+                        help='Export a batch input file, or import a batch results file')
+    parser.add_argument('batch_file', help='Batch input file (export) or results file (import)')
+    parser.add_argument('settings_files', nargs='+', help='Course settings json file(s)')
+    args = parser.parse_args()
+
+    if args.action == 'export':
+        export_batch(args.settings_files, args.batch_file)
+    else:
+        import_batch(args.settings_files, args.batch_file)
+
+    print('\nDone.\n')
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+End-to-end throughput benchmark of the exam pipeline against the local mock server.
+
+Scales Example_Course_settings.json and Example_Course_questions.txt to the requested number of
+questions, runs the full exam loop of Query_GPT4_Exam.py (all prompt templates) against the
+mock server in Mock_Server_GPT4_Exam.py, and reports conversations, questions, and API calls
+per second, the memory high-water mark, and time per stage. No API key is required.
+
+Usage:
+    python Benchmark_GPT4_Exam.py [--questions 1000] [--concurrency 8] [--latency 0.05] ...
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import contextlib
+
+os.environ.setdefault('OPENAI_API_KEY', 'mock')
+
+import openai  # noqa: E402
+import Query_GPT4_Exam  # noqa: E402
+from Governor_GPT4_Exam import Request_Governor  # noqa: E402
+from Metrics_GPT4_Exam import Metrics_Sink, load_metrics, summarize  # noqa: E402
+from Mock_Server_GPT4_Exam import start_mock_server, add_mock_arguments, \
+                                  mock_config_from_args  # noqa: E402
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE_SETTINGS_FILE_NAME = 'Example_Course_settings.json'
+
+
+# Write settings and questions files for an exam scaled to num_questions questions.
+def write_scaled_exam(io_dir, num_questions, reset_every):
+    """
+    Write settings and questions files for an exam scaled to num_questions questions.
+
+    Questions from the example questions file are repeated (and renumbered) as needed.
+    Returns: the settings file name.
+    """
+    with open(os.path.join(SOURCE_DIR, EXAMPLE_SETTINGS_FILE_NAME), 'r') as settings_file_obj:
+        exam_parameters = json.load(settings_file_obj)
+    with open(os.path.join(SOURCE_DIR, exam_parameters['questions_file_name']), 'r') as q_obj:
+        example_questions = [q.strip() for q in q_obj.read().split('-&-')]
+
+    questions = []
+    for question_i in range(num_questions):
+        question = example_questions[question_i % len(example_questions)]
+        question_lines = question.split('\n', 1)
+        question_lines[0] = 'Question ' + str(question_i + 1) + ': ' + \
+            question_lines[0].split(':', 1)[-1].strip()
+        questions.append('\n'.join(question_lines))
+
+    exam_parameters['out_file_prefix'] = 'Benchmark_Course'
+    exam_parameters['questions_file_name'] = 'Benchmark_Course_questions.txt'
+    if reset_every:
+        exam_parameters['reset_prompt_numbers'] = list(
+            range(reset_every + 1, num_questions + 1, reset_every)
+        )
+    else:
+        exam_parameters['reset_prompt_numbers'] = []
+    with open(os.path.join(io_dir, exam_parameters['questions_file_name']), 'w') as q_obj:
+        q_obj.write('\n-&-\n'.join(questions) + '\n')
+    settings_file_name = 'Benchmark_Course_settings.json'
+    with open(os.path.join(io_dir, settings_file_name), 'w') as settings_file_obj:
+        json.dump(exam_parameters, settings_file_obj, indent=2)
+    return settings_file_name
+
+
+# Run the benchmark.
+def run_benchmark(num_questions, concurrency, reset_every, mock_config, io_dir,
+                  stream_responses=False):
+    """
+    Run the benchmark.
+
+    Returns: dict of benchmark results.
+    """
+    mock_server, api_base = start_mock_server(**mock_config)
+    openai.api_base = api_base
+    Query_GPT4_Exam.IO_DIR = io_dir
+    Query_GPT4_Exam.STREAM_RESPONSES = stream_responses
+    Query_GPT4_Exam.REQUEST_GOVERNOR = Request_Governor(
+        requests_per_minute=10 ** 9,
+        tokens_per_minute=10 ** 12,
+        max_retries=Query_GPT4_Exam.MAX_RETRIES,
+        base_delay=0.05,
+    )
+    metrics_file_name = os.path.join(io_dir, 'Benchmark_Metrics.jsonl')
+    Query_GPT4_Exam.METRICS_SINK = Metrics_Sink(metrics_file_name)
+
+    stage_seconds = {}
+    settings_file_name = write_scaled_exam(io_dir, num_questions, reset_every)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        conversations = Query_GPT4_Exam.plan_conversations(settings_file_name)
+        stage_seconds['plan'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        Query_GPT4_Exam.run_conversations(conversations, max_concurrent=concurrency)
+        stage_seconds['run'] = time.perf_counter() - start_time
+    Query_GPT4_Exam.METRICS_SINK.close()
+    mock_server.shutdown()
+
+    records = load_metrics([metrics_file_name])
+    summary = summarize(records)
+    api_seconds = sum(r['latency_seconds'] for r in records)
+    # API time is spread across concurrent conversations; the remainder of the run stage is
+    #   time spent in the pipeline itself (prompt building, reporting, journaling, etc.)
+    stage_seconds['api (per worker)'] = api_seconds / min(concurrency, len(conversations))
+    stage_seconds['pipeline overhead'] = max(0.0, stage_seconds['run']
+                                             - stage_seconds['api (per worker)'])
+    total_seconds = stage_seconds['plan'] + stage_seconds['run']
+    return {
+        'questions': num_questions,
+        'conversations': len(conversations),
+        'api_calls': len(records),
+        'retries': summary['overall']['retries'],
+        'total_seconds': total_seconds,
+        'conversations_per_second': len(conversations) / total_seconds,
+        'question_requests_per_second': summary['overall']['questions'] / total_seconds,
+        'api_calls_per_second': len(records) / total_seconds,
+        'latency_p50': summary['overall']['latency_p50'],
+        'latency_p99': summary['overall']['latency_p99'],
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'stage_seconds': stage_seconds,
+        'mock_requests': mock_server.mock_requests,
+    }
+
+
+# Create the benchmark report string.
+def benchmark_str(results):
+    """Create the benchmark report string."""
+    report = 'Benchmark Results:\n'
+    report += '    Questions: ' + str(results['questions']) + '\n'
+    report += '    Conversations: ' + str(results['conversations']) + '\n'
+    report += '    API Calls: ' + str(results['api_calls']) + '\n'
+    report += '    Mock Server Requests: ' + str(results['mock_requests']) + '\n'
+    report += '    Retries: ' + str(results['retries']) + '\n'
+    report += '    Total Seconds: ' + '%.3f' % results['total_seconds'] + '\n'
+    report += '    Conversations / Second: ' + '%.2f' % results['conversations_per_second'] + '\n'
+    report += '    Question Requests / Second: ' + '%.2f' % \
+        results['question_requests_per_second'] + '\n'
+    report += '    API Calls / Second: ' + '%.2f' % results['api_calls_per_second'] + '\n'
+    report += '    Latency p50 / p99 (s): ' + '%.4f / %.4f' % (results['latency_p50'],
+                                                             results['latency_p99']) + '\n'
+    report += '    Max RSS (MB): ' + '%.1f' % results['max_rss_mb'] + '\n'
+    report += 'Stage Seconds:\n'
+    for stage, seconds in results['stage_seconds'].items():
+        report += '    ' + stage.title() + ': ' + '%.3f' % seconds + '\n'
+    return report
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--questions', type=int, default=1000,
+                        help='Number of questions in the scaled exam (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Maximum concurrent conversations (default: %(default)s)')
+    parser.add_argument('--reset-every', type=int, default=10,
+                        help=('Questions per conversation segment, 0 for none '
+                              '(default: %(default)s)'))
+    parser.add_argument('--stream-responses', action='store_true',
+                        help='Benchmark streaming mode')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the benchmark output directory')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    benchmark_dir = tempfile.mkdtemp(prefix='GPT4_Benchmark_')
+    try:
+        benchmark_results = run_benchmark(args.questions, args.concurrency, args.reset_every,
+                                          mock_config_from_args(args), benchmark_dir,
+                                          stream_responses=args.stream_responses)
+    finally:
+        if args.keep:
+            print('Benchmark output kept in:', benchmark_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(benchmark_dir)
+
+    if args.json:
+        print(json.dumps(benchmark_results, indent=2))
+    else:
+        print('\n' + benchmark_str(benchmark_results))
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Content-addressed on-disk cache of OpenAI chat completion responses.
+
+Responses are stored in a SQLite database keyed by a hash of (model, temperature, messages, and
+number of choices n), so that rerunning a course settings file reuses every identical
+conversation prefix instead of paying for it again. The cache supports age and size based
+eviction (--cache-max-age-days and --cache-max-bytes in Query_GPT4_Exam.py) and a read-only
+"replay" mode in which a cache miss is an error rather than an API call.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+CACHE_MODES = ('off', 'readwrite', 'replay')
+DEFAULT_CACHE_FILE_NAME = 'GPT4_Response_Cache.sqlite'
+
+
+# Error raised when a request is not found in the cache in replay mode.
+class Replay_Miss_Error(KeyError):
+    """Error raised when a request is not found in the cache in replay mode."""
+
+
+# Create a stable hash key for a request.
+def make_cache_key(model, temperature, messages, n=1, max_tokens=None):
+    """
+    Create a stable hash key for a request from its model, sampling arguments, and messages.
+
+    n is only included in the key when more than one choice is requested, and max_tokens only
+    when provided, so keys of other requests are unchanged.
+    """
+    key_obj = {
+        'model': model,
+        'temperature': temperature,
+        'messages': [{'role': m['role'], 'content': m['content']} for m in messages],
+    }
+    if n != 1:
+        key_obj['n'] = n
+    if max_tokens is not None:
+        key_obj['max_tokens'] = max_tokens
+    key_str = json.dumps(key_obj, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+# SQLite-backed response cache.
+class Response_Cache():
+    """
+    SQLite-backed response cache.
+
+    A single cache object is shared by all concurrent conversations; access to the database is
+    serialized with a lock. Hit and miss counts are kept overall, and may also be added to a
+    caller-provided stats dict so that each conversation can report its own statistics.
+    """
+
+    def __init__(self, file_name, mode='readwrite', max_age_days=None, max_bytes=None):
+        """Open (or create) the cache database and apply eviction limits."""
+        if mode not in CACHE_MODES or mode == 'off':
+            raise ValueError('Response cache mode must be "readwrite" or "replay", not: '
+                             + str(mode))
+        self.file_name = file_name
+        self.mode = mode
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        self.connection = sqlite3.connect(self.file_name, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                ' key TEXT PRIMARY KEY,'
+                ' model TEXT,'
+                ' response TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' created REAL NOT NULL,'
+                ' last_access REAL NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)'
+            )
+        if self.mode == 'readwrite':
+            self.evict()
+
+    def count(self, counter, stats=None):
+        """Increment a counter overall and in stats (if provided)."""
+        self.counters[counter] += 1
+        if stats is not None:
+            stats[counter] = stats.get(counter, 0) + 1
+
+    def get(self, model, temperature, messages, stats=None, n=1, max_tokens=None):
+        """
+        Return the cached response for the request, or None if not cached.
+
+        If stats is a dict, its "hits" or "misses" count is incremented.
+        Raises: Replay_Miss_Error on a miss in replay mode.
+        """
+        key = make_cache_key(model, temperature, messages, n=n, max_tokens=max_tokens)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT response FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self.count('misses', stats)
+            else:
+                self.count('hits', stats)
+                if self.mode == 'readwrite':
+                    with self.connection:
+                        self.connection.execute(
+                            'UPDATE responses SET last_access = ? WHERE key = ?',
+                            (time.time(), key)
+                        )
+        if row is None:
+            if self.mode == 'replay':
+                raise Replay_Miss_Error('Request not found in response cache (replay mode): '
+                                        + key)
+            return None
+        return json.loads(row[0])
+
+    def put(self, model, temperature, messages, response_obj, n=1, max_tokens=None):
+        """Store a response for the request (ignored in replay mode)."""
+        if self.mode != 'readwrite':
+            return
+        key = make_cache_key(model, temperature, messages, n=n, max_tokens=max_tokens)
+        response_str = json.dumps(response_obj)
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model, response_str, len(response_str), now, now)
+            )
+            self.counters['writes'] += 1
+
+    def evict(self):
+        """Remove entries older than max_age_days, then least-recently used beyond max_bytes."""
+        with self.lock, self.connection:
+            evicted = 0
+            if self.max_age_days is not None:
+                cutoff = time.time() - (float(self.max_age_days) * 86400)
+                evicted += self.connection.execute(
+                    'DELETE FROM responses WHERE created < ?', (cutoff,)
+                ).rowcount
+            if self.max_bytes is not None:
+                total_bytes = self.connection.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM responses'
+                ).fetchone()[0]
+                if total_bytes > self.max_bytes:
+                    remove_keys = []
+                    for key, size in self.connection.execute(
+                            'SELECT key, size FROM responses ORDER BY last_access'):
+                        if total_bytes <= self.max_bytes:
+                            break
+                        remove_keys.append((key,))
+                        total_bytes -= size
+                    self.connection.executemany('DELETE FROM responses WHERE key = ?',
+                                                remove_keys)
+                    evicted += len(remove_keys)
+            self.counters['evictions'] += evicted
+        return evicted
+
+    def stats(self):
+        """Return a copy of the overall cache counters, with current entry count and size."""
+        with self.lock:
+            entries, total_bytes = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()
+            stats = dict(self.counters)
+        stats['entries'] = entries
+        stats['bytes'] = total_bytes
+        return stats
+
+    def stats_str(self):
+        """Return a report string of the overall cache counters."""
+        stats = self.stats()
+        stats_str = 'Response Cache (' + self.mode + '): '
+        stats_str += os.path.basename(self.file_name) + '\n'
+        stats_str += '    Hits: ' + str(stats['hits']) + '\n'
+        stats_str += '    Misses: ' + str(stats['misses']) + '\n'
+        stats_str += '    Writes: ' + str(stats['writes']) + '\n'
+        stats_str += '    Evictions: ' + str(stats['evictions']) + '\n'
+        stats_str += '    Entries: ' + str(stats['entries']) + '\n'
+        stats_str += '    Bytes: ' + str(stats['bytes']) + '\n'
+        return stats_str
+
+    def close(self):
+        """Close the cache database."""
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Lazily initialized, pooled chat completions client.
+
+Creating a Chat_Client performs no I/O: the API key is resolved (from the client arguments,
+the OPENAI_API_KEY environment variable, an API key file, or an interactive prompt) and the
+HTTP session is created only when the first request is made. All requests then share a single
+keep-alive connection pool with configurable connect and read timeouts, rather than the
+per-thread sessions (recreated every few minutes) used by the openai package by default.
+A client can be shared by any number of threads, and by asyncio tasks through acreate().
+"""
+
+import os
+import asyncio
+import functools
+import threading
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_API_KEY_FILE = os.path.join('..', '..', 'GPT', 'API_KEY.txt')
+DEFAULT_POOL_SIZE = 32
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 600.0
+
+
+# Requests session shared by all threads, whose connection pool is kept open between requests.
+class Keep_Alive_Session(requests.Session):
+    """
+    Requests session shared by all threads, whose connection pool is kept open between requests.
+
+    The openai package periodically closes the session of each thread to limit its lifetime;
+    as this session is shared, close() is ignored and the pool is closed with shutdown().
+    """
+
+    def close(self):
+        """Ignore requests to close the shared session."""
+
+    def shutdown(self):
+        """Close the connection pool."""
+        super().close()
+
+
+# Lazily initialized, pooled chat completions client.
+class Chat_Client():
+    """Lazily initialized, pooled chat completions client."""
+
+    def __init__(self, api_key=None, api_base=None, api_key_file=DEFAULT_API_KEY_FILE,
+                 pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, prompt_for_key=True,
+                 ):
+        """
+        Configure the client; no credentials are read and no connections are made.
+
+        If api_base is None, openai.api_base (or OPENAI_API_BASE) is used at request time.
+        """
+        self.api_key = api_key
+        self.api_base = api_base
+        self.api_key_file = api_key_file
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.prompt_for_key = prompt_for_key
+        self.session = None
+        self.lock = threading.Lock()
+
+    def resolve_api_key(self):
+        """
+        Return the API key, resolving it on first use.
+
+        The key is taken from the client arguments, then openai.api_key (set from the
+        OPENAI_API_KEY environment variable), then api_key_file, then an interactive prompt.
+        """
+        if self.api_key is not None:
+            return self.api_key
+        with self.lock:
+            if self.api_key is not None:
+                return self.api_key
+            api_key_file = os.path.abspath(self.api_key_file) if self.api_key_file else None
+            if openai.api_key:
+                self.api_key = openai.api_key
+            elif api_key_file and os.path.isfile(api_key_file):
+                with open(api_key_file, 'r') as api_key_file_obj:
+                    self.api_key = api_key_file_obj.read().strip()
+            elif self.prompt_for_key:
+                self.api_key = input('\nEnter API Key:\n')
+            else:
+                raise openai.error.AuthenticationError(
+                    'No API key provided: set OPENAI_API_KEY or create: ' + str(api_key_file)
+                )
+        return self.api_key
+
+    def get_session(self):
+        """Return the shared session, creating it and its connection pool on first use."""
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    session = Keep_Alive_Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                          pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self.session = session
+                    openai.requestssession = session
+        return self.session
+
+    def create(self, **kwargs):
+        """Create a chat completion (or stream of chunks, with stream=True)."""
+        api_key = self.resolve_api_key()
+        self.get_session()
+        if self.api_base is not None:
+            kwargs.setdefault('api_base', self.api_base)
+        kwargs.setdefault('request_timeout', (self.connect_timeout, self.read_timeout))
+        return openai.ChatCompletion.create(api_key=api_key, **kwargs)
+
+    async def acreate(self, **kwargs):
+        """Create a chat completion from an asyncio task, using the shared connection pool."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(self.create, **kwargs))
+
+    def close(self):
+        """Close the connection pool (a later request opens a new one)."""
+        with self.lock:
+            if self.session is not None:
+                self.session.shutdown()
+                if openai.requestssession is self.session:
+                    openai.requestssession = None
+                self.session = None
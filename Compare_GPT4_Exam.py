@@ -0,0 +1,444 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Multi-model comparison of exam runs sharing one conversation schedule.
+
+A models file lists the model configurations to compare (a JSON list of objects), each with:
+    name: unique name of the configuration (also its output directory name)
+    model: model requested from the API (default: Query_GPT4_Exam.MODEL)
+    max_context_window: context window in tokens (default: Query_GPT4_Exam.MAX_CONTEXT_WINDOW)
+    pricing: [prompt, completion] USD per 1000 tokens (default: from MODEL_PRICING)
+    rpm, tpm: rate limit budgets of the model (default: Query_GPT4_Exam rate limits)
+    api_base, api_key_file: API endpoint and key file (default: as Query_GPT4_Exam.py)
+    mock: mock server configuration (see Mock_Server_GPT4_Exam.py); if given, a local mock
+        server is started and used as the model's endpoint
+The same exams are run against every model concurrently, each model in its own worker process
+with its own client, rate-limit governor, context window, and output directory. With
+--resets fit, the exam's reset points are kept where every segment fits a model's context
+window, and otherwise replaced with the fewest reset points that fit (as estimated by
+Planner_GPT4_Exam.py). The answers, requests, tokens, and latency of every model are then
+reported side by side for each question.
+
+Usage:
+    python Compare_GPT4_Exam.py MODELS_FILE [SETTINGS_FILE ...] [--resets fit]
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import traceback
+import contextlib
+import collections
+import concurrent.futures
+import Query_GPT4_Exam
+import Planner_GPT4_Exam
+from Client_GPT4_Exam import Chat_Client, DEFAULT_API_KEY_FILE
+from Context_GPT4_Exam import CONTEXT_POLICIES, SHORTEN_CONTEXTS
+from Governor_GPT4_Exam import Request_Governor
+from Journal_GPT4_Exam import journal_file_name, load_journal
+from Metrics_GPT4_Exam import Metrics_Sink, MODEL_PRICING, DEFAULT_METRICS_FILE_NAME, \
+                              load_metrics
+from Mock_Server_GPT4_Exam import start_mock_server
+from Postprocess_GPT4_Exam import FOLLOW_UP_RULES
+
+RESET_MODES = ('settings', 'fit')
+DEFAULT_COMPARISON_DIR_NAME = 'GPT4_Model_Comparison'
+COMPARISON_REPORT_FILE_NAME = 'GPT4_Model_Comparison.txt'
+MODEL_LOG_FILE_NAME = 'model.log'
+MODEL_NAME_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*$')
+
+
+# Load the model configurations to compare from a models file.
+def load_model_configs(models_file_name):
+    """
+    Load the model configurations to compare from a models file, filling in defaults.
+
+    Raises ValueError if a configuration has no name, an invalid name, or a repeated name.
+    Returns: list of model configuration dicts.
+    """
+    with open(models_file_name, 'r') as models_file_obj:
+        model_configs = json.load(models_file_obj)
+    names = set()
+    for model_config in model_configs:
+        name = model_config.get('name')
+        if not name or not MODEL_NAME_PATTERN.match(name):
+            raise ValueError('Invalid model configuration name: ' + str(name))
+        if name in names:
+            raise ValueError('Repeated model configuration name: ' + name)
+        names.add(name)
+        model_config.setdefault('model', Query_GPT4_Exam.MODEL)
+        model_config['max_context_window'] = int(
+            model_config.get('max_context_window', Query_GPT4_Exam.MAX_CONTEXT_WINDOW)
+        )
+        model_config['pricing'] = list(model_config.get(
+            'pricing', MODEL_PRICING.get(model_config['model'], MODEL_PRICING['gpt-4'])
+        ))
+        model_config.setdefault('rpm', Query_GPT4_Exam.RATE_LIMIT_RPM)
+        model_config.setdefault('tpm', Query_GPT4_Exam.RATE_LIMIT_TPM)
+        model_config.setdefault('api_base', None)
+        model_config.setdefault('api_key_file', DEFAULT_API_KEY_FILE)
+        model_config.setdefault('mock', None)
+    return model_configs
+
+
+# Return the reset prompt numbers of an exam fitted to the current model's context window.
+def fit_resets(exam_conversations, statistics, plan_settings):
+    """
+    Return the reset prompt numbers of an exam fitted to the current model's context window.
+
+    exam_conversations are the conversations of a single exam planned with its own reset
+    points, which are kept if every segment fits within Query_GPT4_Exam.MAX_CONTEXT_WINDOW.
+    Otherwise the fewest reset points keeping every segment within the context window are
+    returned, or the exam's own reset points if there are none (leaving the context policy to
+    keep requests within the window).
+    """
+    simulate_settings = {**plan_settings, 'context_policy': 'off'}
+    peak_context = max(
+        Planner_GPT4_Exam.simulate_conversation(c, statistics, simulate_settings)['peak_context']
+        for c in exam_conversations
+    )
+    current = sorted(set(c['segment'] for c in exam_conversations if c['segment'] != 1))
+    if peak_context <= int(Query_GPT4_Exam.MAX_CONTEXT_WINDOW):
+        return current
+    recommendation = Planner_GPT4_Exam.recommend_resets(exam_conversations, statistics,
+                                                        plan_settings)
+    return current if recommendation['fewest'] is None else recommendation['fewest']
+
+
+# Plan the conversations of every exam for the current model.
+def plan_model_conversations(settings_files, run_config, statistics):
+    """
+    Plan the conversations of every exam for the current model.
+
+    Returns: (conversations, resets), where resets maps each exam to its reset prompt numbers.
+    """
+    conversations = []
+    resets = collections.OrderedDict()
+    for settings_file in settings_files:
+        exam_conversations = Query_GPT4_Exam.plan_conversations(
+            settings_file, independent_questions=run_config['independent_questions']
+        )
+        if run_config['resets'] == 'fit' and not run_config['independent_questions']:
+            reset_prompt_numbers = fit_resets(exam_conversations, statistics, run_config)
+            exam_conversations = Query_GPT4_Exam.plan_conversations(
+                settings_file, independent_questions=False,
+                reset_prompt_numbers=reset_prompt_numbers,
+            )
+        resets[exam_conversations[0]['out_file_prefix']] = sorted(
+            set(c['segment'] for c in exam_conversations if c['segment'] != 1)
+        )
+        conversations += exam_conversations
+    return Query_GPT4_Exam.group_by_prefix(conversations), resets
+
+
+# Run every exam against a single model, writing its outputs to its own directory.
+def run_model(model_config, settings_files, run_config, out_dir):
+    """
+    Run every exam against a single model, writing its outputs to its own directory.
+
+    The client, governor, context window, and metrics of Query_GPT4_Exam are set for the model,
+    and its output is logged to MODEL_LOG_FILE_NAME in its directory.
+    run_config is a dict with keys: independent_questions, concurrency, question_concurrency,
+    context_policy, shorten_context, samples, resets, follow_up_rules, metrics_files, resume,
+    and run_id.
+    Returns: dict with keys: name, out_dir, conversations (list of dicts with keys:
+        out_file_name, exam, template), resets, seconds, and error (None if the model completed).
+    """
+    model_dir = os.path.join(out_dir, model_config['name'])
+    os.makedirs(model_dir, exist_ok=True)
+    result = {'name': model_config['name'], 'out_dir': model_dir, 'conversations': [],
+              'resets': {}, 'seconds': 0.0, 'error': None}
+    mock_server = None
+    start_time = time.perf_counter()
+    log_file_name = os.path.join(model_dir, MODEL_LOG_FILE_NAME)
+    with open(log_file_name, 'a') as log_file_obj, contextlib.redirect_stdout(log_file_obj):
+        print('Model:', model_config['name'])
+        try:
+            api_base, api_key = model_config['api_base'], None
+            if model_config['mock'] is not None:
+                mock_server, api_base = start_mock_server(**model_config['mock'])
+                api_key = 'mock'
+            Query_GPT4_Exam.MODEL = model_config['model']
+            Query_GPT4_Exam.MAX_CONTEXT_WINDOW = str(model_config['max_context_window'])
+            Query_GPT4_Exam.FOLLOW_UP_RULE_NAMES = tuple(run_config['follow_up_rules'])
+            Query_GPT4_Exam.SHORTEN_CONTEXT = run_config['shorten_context']
+            Query_GPT4_Exam.SAMPLES = run_config['samples']
+            Query_GPT4_Exam.MAX_CONCURRENT_QUESTIONS = run_config['question_concurrency']
+            Query_GPT4_Exam.CHAT_CLIENT = Chat_Client(
+                api_key=api_key,
+                api_base=api_base,
+                api_key_file=model_config['api_key_file'],
+                prompt_for_key=False,
+            )
+            Query_GPT4_Exam.REQUEST_GOVERNOR = Request_Governor(
+                requests_per_minute=model_config['rpm'],
+                tokens_per_minute=model_config['tpm'],
+                max_retries=Query_GPT4_Exam.MAX_RETRIES,
+            )
+            Query_GPT4_Exam.METRICS_SINK = Metrics_Sink(
+                os.path.join(model_dir, DEFAULT_METRICS_FILE_NAME), run_id=run_config['run_id']
+            )
+
+            statistics = Planner_GPT4_Exam.completion_statistics(
+                load_metrics([f for f in run_config['metrics_files'] if os.path.isfile(f)])
+            )
+            conversations, result['resets'] = plan_model_conversations(settings_files,
+                                                                       run_config, statistics)
+            for conversation in conversations:
+                conversation['out_file_name'] = os.path.join(
+                    model_dir, os.path.basename(conversation['out_file_name'])
+                )
+                result['conversations'].append({
+                    'out_file_name': conversation['out_file_name'],
+                    'exam': conversation['out_file_prefix'],
+                    'template': conversation['template_name'],
+                })
+            Query_GPT4_Exam.run_conversations(
+                conversations,
+                max_concurrent=run_config['concurrency'],
+                resume=run_config['resume'],
+                context_policy_mode=run_config['context_policy'],
+            )
+        except Exception:
+            result['error'] = traceback.format_exc()
+            print(result['error'])
+        finally:
+            if Query_GPT4_Exam.METRICS_SINK is not None:
+                Query_GPT4_Exam.METRICS_SINK.close()
+                Query_GPT4_Exam.METRICS_SINK = None
+            Query_GPT4_Exam.CHAT_CLIENT.close()
+            if mock_server is not None:
+                mock_server.shutdown()
+    result['seconds'] = round(time.perf_counter() - start_time, 3)
+    return result
+
+
+# Run every exam against every model concurrently, one worker process per model.
+def run_models(model_configs, settings_files, run_config, out_dir):
+    """
+    Run every exam against every model concurrently, one worker process per model.
+
+    Returns: list of run_model results, in model configuration order.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(model_configs)) as executor:
+        futures = [executor.submit(run_model, model_config, settings_files, run_config, out_dir)
+                   for model_config in model_configs]
+        return [future.result() for future in futures]
+
+
+# Collect the answers, requests, tokens, and latency of every model for each question.
+def collect_comparison(model_results):
+    """
+    Collect the answers, requests, tokens, and latency of every model for each question.
+
+    Each model's journals hold every completed turn of its conversations; the turns of each
+    question are summed, and its final response is the model's answer.
+    Returns: ordered dict of (exam, template, prompt_i): dict with keys: question, and models
+        (dict of model name: dict with keys: answer, requests, prompt_tokens,
+        completion_tokens, latency_seconds).
+    """
+    template_order = {name: i for i, name in enumerate(Query_GPT4_Exam.PROMPT_TEMPLATES)}
+    comparison = {}
+    for model_result in model_results:
+        for conversation in model_result['conversations']:
+            journal = load_journal(journal_file_name(conversation['out_file_name']))
+            for turn in (journal or {}).get('turns', []):
+                key = (conversation['exam'], conversation['template'], turn['prompt_i'])
+                question = comparison.setdefault(key, {'question': None, 'models': {}})
+                if question['question'] is None:
+                    question['question'] = turn['messages'][0]['content']
+                answer = question['models'].setdefault(model_result['name'], {
+                    'answer': None, 'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                    'latency_seconds': 0.0,
+                })
+                answer['answer'] = turn['messages'][1]['content']
+                answer['requests'] += 1
+                answer['prompt_tokens'] += (turn['usage'] or {}).get('prompt_tokens') or 0
+                answer['completion_tokens'] += (turn['usage'] or {}).get('completion_tokens') or 0
+                answer['latency_seconds'] += (turn['timing'] or {}).get('latency_seconds') or 0.0
+    return collections.OrderedDict(
+        (key, comparison[key])
+        for key in sorted(comparison, key=lambda k: (k[0], template_order.get(k[1], 0), k[2]))
+    )
+
+
+# Summarize the totals and cost of each model over all compared questions.
+def summarize_models(model_configs, model_results, comparison):
+    """
+    Summarize the totals and cost of each model over all compared questions.
+
+    Returns: list of dicts with keys: name, model, max_context_window, questions, requests,
+        prompt_tokens, completion_tokens, mean_latency_seconds, cost, seconds, resets, error.
+    """
+    summaries = []
+    for model_config, model_result in zip(model_configs, model_results):
+        answers = [q['models'][model_config['name']] for q in comparison.values()
+                   if model_config['name'] in q['models']]
+        prompt_tokens = sum(a['prompt_tokens'] for a in answers)
+        completion_tokens = sum(a['completion_tokens'] for a in answers)
+        prompt_price, completion_price = model_config['pricing']
+        summaries.append({
+            'name': model_config['name'],
+            'model': model_config['model'],
+            'max_context_window': model_config['max_context_window'],
+            'questions': len(answers),
+            'requests': sum(a['requests'] for a in answers),
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'mean_latency_seconds': ((sum(a['latency_seconds'] for a in answers) / len(answers))
+                                     if answers else None),
+            'cost': ((prompt_tokens * prompt_price) + (completion_tokens * completion_price))
+            / 1000.0,
+            'seconds': model_result['seconds'],
+            'resets': model_result['resets'],
+            'error': model_result['error'],
+        })
+    return summaries
+
+
+# Create the string of the model summary table.
+def summary_str(summaries):
+    """Create the string of the model summary table."""
+    report = 'Model Comparison:\n'
+    row = '    {:<20} {:<16} {:>8} {:>9} {:>8} {:>13} {:>17} {:>11} {:>9} {:>10}\n'
+    report += row.format('Name', 'Model', 'Window', 'Questions', 'Requests', 'Prompt Tokens',
+                         'Completion Tokens', 'Latency (s)', 'Cost', 'Run Time')
+    for summary in summaries:
+        report += row.format(
+            summary['name'], summary['model'], summary['max_context_window'],
+            summary['questions'], summary['requests'], summary['prompt_tokens'],
+            summary['completion_tokens'],
+            '-' if summary['mean_latency_seconds'] is None
+            else '%.2f' % summary['mean_latency_seconds'],
+            '$%.2f' % summary['cost'], Planner_GPT4_Exam.format_seconds(summary['seconds']),
+        )
+    report += '\nReset Points:\n'
+    for summary in summaries:
+        for exam, resets in summary['resets'].items():
+            report += '    ' + summary['name'] + ' / ' + exam + ': ' + str(resets) + '\n'
+    for summary in summaries:
+        if summary['error'] is not None:
+            report += ('\nFailed: ' + summary['name'] + ' (see '
+                       + os.path.join(summary['name'], MODEL_LOG_FILE_NAME) + ')\n')
+    return report
+
+
+# Create the string of the side-by-side comparison of every question.
+def comparison_str(comparison, model_names):
+    """Create the string of the side-by-side comparison of every question."""
+    report = ''
+    row = '    {:<20} {:>8} {:>13} {:>17} {:>11}\n'
+    for (exam, template, prompt_i), question in comparison.items():
+        report += '\n' + '=' * 80 + '\n'
+        report += exam + ' | ' + template + ' | Prompt ' + str(prompt_i) + '\n'
+        report += '=' * 80 + '\n'
+        report += question['question'].rstrip() + '\n\n'
+        report += row.format('Model', 'Requests', 'Prompt Tokens', 'Completion Tokens',
+                             'Latency (s)')
+        for name in model_names:
+            answer = question['models'].get(name)
+            if answer is None:
+                report += row.format(name, '-', '-', '-', '-')
+            else:
+                report += row.format(name, answer['requests'], answer['prompt_tokens'],
+                                     answer['completion_tokens'],
+                                     '%.2f' % answer['latency_seconds'])
+        for name in model_names:
+            answer = question['models'].get(name)
+            report += '\n ----- ' + name + ' ----- \n'
+            report += (answer['answer'].rstrip() if answer is not None else '(no answer)') + '\n'
+    return report
+
+
+# Write the comparison report to the comparison directory.
+def write_comparison_report(out_dir, summaries, comparison):
+    """
+    Write the comparison report to the comparison directory.
+
+    Returns: the comparison report file name.
+    """
+    out_file_name = os.path.join(out_dir, COMPARISON_REPORT_FILE_NAME)
+    with open(out_file_name, 'w') as out_file_obj:
+        out_file_obj.write(summary_str(summaries))
+        out_file_obj.write(comparison_str(comparison, [s['name'] for s in summaries]))
+    return out_file_name
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('models_file', help='JSON file of the model configurations to compare')
+    parser.add_argument('settings_files', nargs='*', default=['Example_Course_settings.json'],
+                        help='Course settings json file(s) of the exams (default: %(default)s)')
+    parser.add_argument('--out-dir',
+                        default=os.path.join(Query_GPT4_Exam.IO_DIR, DEFAULT_COMPARISON_DIR_NAME),
+                        help='Directory of the outputs of every model (default: %(default)s)')
+    parser.add_argument('--resets', choices=RESET_MODES, default='fit',
+                        help=('Reset points of each model: the exam settings\' reset points, or '
+                              'reset points fitted to the model\'s context window '
+                              '(default: %(default)s)'))
+    parser.add_argument('--metrics-files', nargs='*',
+                        default=[os.path.join(Query_GPT4_Exam.IO_DIR, DEFAULT_METRICS_FILE_NAME)],
+                        help=('Historical metrics files used to estimate the context of each '
+                              'segment when fitting reset points (default: %(default)s)'))
+    parser.add_argument('--concurrency', type=int,
+                        default=Query_GPT4_Exam.MAX_CONCURRENT_CONVERSATIONS,
+                        help=('Maximum number of conversations each model runs at once '
+                              '(default: %(default)s)'))
+    parser.add_argument('--independent-questions', action='store_true',
+                        help='Ask each question from its own fresh initial prompt')
+    parser.add_argument('--question-concurrency', type=int,
+                        default=Query_GPT4_Exam.MAX_CONCURRENT_QUESTIONS,
+                        help=('Maximum questions queried at once per conversation with '
+                              '--independent-questions (default: %(default)s)'))
+    parser.add_argument('--context-policy', choices=CONTEXT_POLICIES,
+                        default=Query_GPT4_Exam.CONTEXT_POLICY,
+                        help=('Action taken when a request would exceed a model\'s context '
+                              'window (default: %(default)s)'))
+    parser.add_argument('--shorten-context', choices=SHORTEN_CONTEXTS,
+                        default=Query_GPT4_Exam.SHORTEN_CONTEXT,
+                        help='Context of Expert_Short shortening requests (default: %(default)s)')
+    parser.add_argument('--follow-up-rules', nargs='*', choices=list(FOLLOW_UP_RULES),
+                        default=list(Query_GPT4_Exam.FOLLOW_UP_RULE_NAMES),
+                        help=('Rules for which Expert answers found in violation receive a '
+                              'follow-up request (default: %(default)s)'))
+    parser.add_argument('--resume', action='store_true',
+                        help=('Resume each model from its conversation journals, skipping '
+                              'completed turns and conversations'))
+    args = parser.parse_args()
+
+    comparison_model_configs = load_model_configs(args.models_file)
+    comparison_run_config = {
+        'independent_questions': args.independent_questions,
+        'concurrency': args.concurrency,
+        'question_concurrency': args.question_concurrency,
+        'context_policy': args.context_policy,
+        'shorten_context': args.shorten_context,
+        'samples': 1,
+        'resets': args.resets,
+        'follow_up_rules': args.follow_up_rules,
+        'metrics_files': [os.path.abspath(f) for f in args.metrics_files],
+        'resume': args.resume,
+        'run_id': 'compare-' + time.strftime('%Y%m%d-%H%M%S'),
+    }
+    comparison_settings_files = [os.path.abspath(os.path.join(Query_GPT4_Exam.IO_DIR, f))
+                                 for f in args.settings_files]
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    print('Comparing', len(comparison_model_configs), 'models:',
+          ', '.join(c['name'] for c in comparison_model_configs))
+    comparison_results = run_models(comparison_model_configs, comparison_settings_files,
+                                    comparison_run_config, args.out_dir)
+    question_comparison = collect_comparison(comparison_results)
+    model_summaries = summarize_models(comparison_model_configs, comparison_results,
+                                       question_comparison)
+    print(summary_str(model_summaries))
+    print('Comparison written to:',
+          write_comparison_report(args.out_dir, model_summaries, question_comparison))
+
+    print('\nDone.\n')
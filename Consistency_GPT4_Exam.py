@@ -0,0 +1,248 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Consistency scoring of multiple sampled answers to each exam question.
+
+When Query_GPT4_Exam.py is run with --samples N, the N sampled answers to each question are
+written to a "_samples.jsonl" file next to the report. This module scores the agreement between
+the samples of each question as the pairwise cosine similarity of their TF-IDF vectors (with
+inverse document frequencies computed over all samples in the file), and writes the mean and
+minimum pairwise agreement of each question to a "_consistency.txt" file next to the report.
+If NumPy is installed, all questions are scored at once as a batch of padded TF-IDF matrices;
+otherwise an equivalent pure-Python implementation is used.
+
+Usage:
+    python Consistency_GPT4_Exam.py SAMPLES_FILE [SAMPLES_FILE ...]
+"""
+
+import re
+import json
+import math
+import argparse
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SAMPLES_SUFFIX = '_samples.jsonl'
+CONSISTENCY_SUFFIX = '_consistency.txt'
+# Maximum number of questions scored in each NumPy batch.
+SCORE_BATCH_SIZE = 1024
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+# Split text into lowercase word tokens.
+def tokenize(text):
+    """Split text into lowercase word tokens."""
+    return WORD_PATTERN.findall(text.lower())
+
+
+# Load the samples of each question from a samples file.
+def load_samples(samples_file_name):
+    """
+    Load the samples of each question from a samples file.
+
+    Returns: list of (prompt_i, samples) in question order.
+    """
+    question_samples = collections.OrderedDict()
+    with open(samples_file_name, 'r') as samples_file_obj:
+        for line in samples_file_obj:
+            if line.strip():
+                record = json.loads(line)
+                question_samples[record['prompt_i']] = record['samples']
+    return list(question_samples.items())
+
+
+# Return the smoothed inverse document frequency of each token over all samples.
+def inverse_document_frequencies(token_counts):
+    """Return the smoothed inverse document frequency of each token over all samples."""
+    document_frequencies = collections.Counter()
+    for counts in token_counts:
+        document_frequencies.update(counts.keys())
+    num_documents = len(token_counts)
+    return {token: math.log((1 + num_documents) / (1 + frequency)) + 1
+            for token, frequency in document_frequencies.items()}
+
+
+# Score the pairwise agreement of the samples of each question with NumPy.
+def score_agreement_numpy(question_counts, idf):
+    """
+    Score the pairwise agreement of the samples of each question with NumPy.
+
+    The TF-IDF vectors of each batch of questions are stored in a single array of shape
+    (questions, samples, tokens), padded to the largest number of samples and distinct tokens
+    of any question in the batch, and all pairwise cosine similarities are computed with one
+    batched matrix product.
+    Returns: list of (num_samples, mean_agreement, min_agreement) per question.
+    """
+    scores = []
+    for batch_start in range(0, len(question_counts), SCORE_BATCH_SIZE):
+        batch = question_counts[batch_start:batch_start + SCORE_BATCH_SIZE]
+        vocabularies = [sorted(set().union(*sample_counts)) if sample_counts else []
+                        for sample_counts in batch]
+        max_samples = max(len(sample_counts) for sample_counts in batch)
+        max_tokens = max(1, max(len(vocabulary) for vocabulary in vocabularies))
+
+        # Gather (question, sample, token, tf-idf) entries, then fill the array at once.
+        question_indexes, sample_indexes, token_indexes, values = [], [], [], []
+        for question_i, (sample_counts, vocabulary) in enumerate(zip(batch, vocabularies)):
+            token_index = {token: i for i, token in enumerate(vocabulary)}
+            for sample_i, counts in enumerate(sample_counts):
+                question_indexes += [question_i] * len(counts)
+                sample_indexes += [sample_i] * len(counts)
+                token_indexes += [token_index[token] for token in counts]
+                values += [count * idf[token] for token, count in counts.items()]
+        vectors = numpy.zeros((len(batch), max_samples, max_tokens))
+        vectors[question_indexes, sample_indexes, token_indexes] = values
+
+        norms = numpy.linalg.norm(vectors, axis=2, keepdims=True)
+        vectors = numpy.divide(vectors, norms, out=numpy.zeros_like(vectors), where=norms > 0)
+        similarities = numpy.matmul(vectors, numpy.transpose(vectors, (0, 2, 1)))
+
+        sample_counts = numpy.array([len(sample_counts) for sample_counts in batch])
+        present = numpy.arange(max_samples)[None, :] < sample_counts[:, None]
+        pair_mask = present[:, :, None] & present[:, None, :]
+        pair_mask &= ~numpy.eye(max_samples, dtype=bool)[None, :, :]
+        num_pairs = pair_mask.sum(axis=(1, 2))
+        means = numpy.where(pair_mask, similarities, 0.0).sum(axis=(1, 2))
+        means = numpy.divide(means, num_pairs, out=numpy.zeros_like(means), where=num_pairs > 0)
+        mins = numpy.where(pair_mask, similarities, numpy.inf).min(axis=(1, 2))
+        for num_samples, num_pair, mean, minimum in zip(sample_counts, num_pairs, means, mins):
+            if num_pair:
+                scores.append((int(num_samples), float(mean), float(minimum)))
+            else:
+                scores.append((int(num_samples), None, None))
+    return scores
+
+
+# Score the pairwise agreement of the samples of each question without NumPy.
+def score_agreement_python(question_counts, idf):
+    """
+    Score the pairwise agreement of the samples of each question without NumPy.
+
+    Returns: list of (num_samples, mean_agreement, min_agreement) per question.
+    """
+    scores = []
+    for sample_counts in question_counts:
+        vectors = []
+        for counts in sample_counts:
+            vector = {token: count * idf[token] for token, count in counts.items()}
+            norm = math.sqrt(sum(value * value for value in vector.values()))
+            vectors.append({token: value / norm for token, value in vector.items()} if norm
+                           else {})
+        similarities = []
+        for i in range(len(vectors)):
+            for j in range(len(vectors)):
+                if i != j:
+                    similarities.append(sum(value * vectors[j].get(token, 0.0)
+                                            for token, value in vectors[i].items()))
+        if similarities:
+            scores.append((len(vectors), sum(similarities) / len(similarities), min(similarities)))
+        else:
+            scores.append((len(vectors), None, None))
+    return scores
+
+
+# Score the pairwise agreement of the samples of each question.
+def score_agreement(question_samples, use_numpy=None):
+    """
+    Score the pairwise agreement of the samples of each question.
+
+    question_samples is a list of lists of sampled answers (one list per question).
+    If use_numpy is None, NumPy is used if installed.
+    Returns: list of (num_samples, mean_agreement, min_agreement) per question, with None
+        agreements for questions with fewer than two samples.
+    """
+    question_counts = [[collections.Counter(tokenize(sample)) for sample in samples]
+                       for samples in question_samples]
+    if not question_counts:
+        return []
+    idf = inverse_document_frequencies([c for counts in question_counts for c in counts])
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        return score_agreement_numpy(question_counts, idf)
+    return score_agreement_python(question_counts, idf)
+
+
+# Score the samples file of a report.
+def score_samples_file(samples_file_name):
+    """
+    Score the samples file of a report.
+
+    Returns: dict with keys: samples_file, method, questions (list of dicts with keys:
+        prompt_i, samples, mean_agreement, min_agreement), and mean_agreement (over questions).
+    """
+    loaded = load_samples(samples_file_name)
+    scores = score_agreement([samples for prompt_i, samples in loaded])
+    questions = []
+    for (prompt_i, samples), (num_samples, mean_agreement, min_agreement) in zip(loaded, scores):
+        questions.append({
+            'prompt_i': prompt_i,
+            'samples': num_samples,
+            'mean_agreement': mean_agreement,
+            'min_agreement': min_agreement,
+        })
+    agreements = [q['mean_agreement'] for q in questions if q['mean_agreement'] is not None]
+    return {
+        'samples_file': samples_file_name,
+        'method': 'TF-IDF cosine (' + ('numpy' if numpy is not None else 'python') + ')',
+        'questions': questions,
+        'mean_agreement': (sum(agreements) / len(agreements)) if agreements else None,
+    }
+
+
+# Format an agreement score for the consistency report.
+def format_agreement(value):
+    """Format an agreement score for the consistency report."""
+    return '-' if value is None else '{:.4f}'.format(value)
+
+
+# Create the consistency report string.
+def consistency_str(results):
+    """Create the consistency report string."""
+    report = 'Sample Consistency:\n'
+    report += '    Samples File: ' + results['samples_file'] + '\n'
+    report += '    Method: ' + results['method'] + '\n'
+    report += '    Questions: ' + str(len(results['questions'])) + '\n'
+    report += '    Mean Agreement: ' + format_agreement(results['mean_agreement']) + '\n\n'
+    row = '{:>8} {:>8} {:>15} {:>14}\n'
+    report += row.format('Prompt', 'Samples', 'Mean Agreement', 'Min Agreement')
+    for question in results['questions']:
+        report += row.format(question['prompt_i'], question['samples'],
+                             format_agreement(question['mean_agreement']),
+                             format_agreement(question['min_agreement']))
+    return report
+
+
+# Score a samples file and write the consistency report next to it.
+def write_consistency_report(samples_file_name):
+    """
+    Score a samples file and write the consistency report next to it.
+
+    Returns: the consistency report file name.
+    """
+    results = score_samples_file(samples_file_name)
+    if samples_file_name.endswith(SAMPLES_SUFFIX):
+        out_file_name = samples_file_name[:-len(SAMPLES_SUFFIX)] + CONSISTENCY_SUFFIX
+    else:
+        out_file_name = samples_file_name + CONSISTENCY_SUFFIX
+    with open(out_file_name, 'w') as out_file_obj:
+        out_file_obj.write(consistency_str(results))
+    return out_file_name
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('samples_files', nargs='+', help='Samples JSONL file(s) to score')
+    args = parser.parse_args()
+
+    for samples_file_name in args.samples_files:
+        print('Wrote:', write_consistency_report(samples_file_name))
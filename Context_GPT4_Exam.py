@@ -0,0 +1,194 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Local token counting and context-window management for GPT4 exam conversations.
+
+Prompt sizes are estimated locally before each request, with tiktoken where available (and an
+approximation of 4 characters per token otherwise). Token counts of recent messages are memoized
+in a bounded LRU cache, so a message is tokenized once however many requests of a conversation
+it is sent in, while memory stays bounded over long runs. A Context_Policy then decides, before
+a request is sent, whether the conversation must be reset to its initial prompt or have its
+oldest question turns trimmed to fit within the context window.
+Shortening requests may instead be sent with a minimal context (the system prompt and the answer
+to shorten) and a completion budget computed from the length of the answer.
+"""
+
+import math
+import threading
+import functools
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Token overhead per message and for priming the reply, as documented for gpt-4 chat models.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+CONTEXT_POLICIES = ('reset', 'trim', 'prompt', 'off')
+SHORTEN_CONTEXTS = ('full', 'minimal')
+# Completion budget of a minimal-context shortening request, as a fraction of the answer length
+#   (the request asks for approximately 65%, so some headroom is allowed).
+SHORTEN_MAX_TOKENS_RATIO = 0.8
+# Number of distinct texts whose token counts are memoized (least-recently used are dropped).
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+# Return the tiktoken encoding for gpt-4, or None if unavailable.
+def get_encoding(model='gpt-4'):
+    """Return the tiktoken encoding for the model, or None if unavailable."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                if tiktoken is not None:
+                    try:
+                        _encoding = tiktoken.encoding_for_model(model)
+                    except Exception:
+                        # e.g. encoding files cannot be downloaded; fall back to approximation.
+                        _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+# Count the tokens in a text string.
+@functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def count_text_tokens(text):
+    """Count the tokens in a text string (memoized for TOKEN_COUNT_CACHE_SIZE texts)."""
+    encoding = get_encoding()
+    if encoding is None:
+        return int(math.ceil(len(text) / 4.0))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+# Count the tokens used by a single message, including per-message overhead.
+def count_message_tokens(message):
+    """Count the tokens used by a single message, including per-message overhead."""
+    return (TOKENS_PER_MESSAGE + count_text_tokens(message['role'])
+            + count_text_tokens(message['content']))
+
+
+# Count the prompt tokens for a conversation or list of messages.
+def count_prompt_tokens(messages):
+    """Count the prompt tokens for a conversation or list of messages."""
+    return sum(count_message_tokens(message) for message in messages) + TOKENS_PER_REPLY
+
+
+# Split conversation history into question groups.
+def split_question_groups(messages, follow_up_requests):
+    """
+    Split conversation history into question groups.
+
+    Each group begins with a user message that is not a follow-up request, and contains all
+    messages until the next such user message.
+    """
+    groups = []
+    for message in messages:
+        if (not groups or (message['role'] == 'user'
+                           and message['content'] not in follow_up_requests)):
+            groups.append([])
+        groups[-1].append(message)
+    return groups
+
+
+# Policy deciding how to keep each request within the context window.
+class Context_Policy():
+    """
+    Policy deciding how to keep each request within the context window.
+
+    Modes:
+        reset: restart from the initial prompt, keeping only the current question.
+        trim: remove the oldest question turns until the request fits.
+        prompt: take no action before the request (the previous behavior of asking for
+            confirmation after a response nears the maximum).
+        off: take no action.
+    """
+
+    def __init__(self, mode, max_context_window, reserve_tokens=1024, follow_up_requests=()):
+        """Create the policy for a context window, reserving tokens for the completion."""
+        if mode not in CONTEXT_POLICIES:
+            raise ValueError('Context policy must be one of: ' + ', '.join(CONTEXT_POLICIES))
+        self.mode = mode
+        self.max_context_window = int(max_context_window)
+        self.reserve_tokens = reserve_tokens
+        self.follow_up_requests = set(follow_up_requests)
+
+    def observe(self, usage):
+        """Increase the completion reserve if a completion longer than the reserve is seen."""
+        if usage and usage.get('completion_tokens', 0) > self.reserve_tokens:
+            self.reserve_tokens = usage['completion_tokens']
+
+    def limit(self):
+        """Return the maximum prompt tokens allowed for a request."""
+        return self.max_context_window - self.reserve_tokens
+
+    def apply(self, conversation, initial_length):
+        """
+        Apply the policy to the conversation about to be sent.
+
+        initial_length is the number of messages in the initial prompt, which are always kept.
+        Returns: (conversation to send, decision dict or None if no action was taken).
+        """
+        prompt_tokens = count_prompt_tokens(conversation)
+        if self.mode in ('prompt', 'off') or prompt_tokens <= self.limit():
+            return conversation, None
+
+        messages = list(conversation)
+        prefix = messages[:initial_length]
+        groups = split_question_groups(messages[initial_length:], self.follow_up_requests)
+        if self.mode == 'reset':
+            removed_groups = len(groups) - 1
+        else:
+            removed_groups = 0
+            remaining_tokens = prompt_tokens
+            while removed_groups < len(groups) - 1 and remaining_tokens > self.limit():
+                remaining_tokens -= sum(count_message_tokens(m) for m in groups[removed_groups])
+                removed_groups += 1
+
+        new_conversation = conversation.__class__()
+        kept_messages = prefix + [m for group in groups[removed_groups:] for m in group]
+        for message in kept_messages:
+            new_conversation = new_conversation.add(message['role'], message['content'])
+        new_prompt_tokens = count_prompt_tokens(new_conversation)
+
+        decision = {
+            'action': self.mode,
+            'estimated_prompt_tokens': prompt_tokens,
+            'reserved_completion_tokens': self.reserve_tokens,
+            'max_context_window': self.max_context_window,
+            'removed_questions': removed_groups,
+            'removed_messages': len(messages) - len(kept_messages),
+            'new_estimated_prompt_tokens': new_prompt_tokens,
+        }
+        if new_prompt_tokens > self.limit():
+            print('Warning: request still exceeds context limit after context policy:',
+                  new_prompt_tokens, 'tokens.')
+        return new_conversation, decision
+
+
+# Build the minimal context of a shortening request from the conversation it follows.
+def minimal_shorten_context(conversation, request):
+    """
+    Build the minimal context of a shortening request from the conversation it follows.
+
+    Only the system prompt (the first message) and the answer to shorten (the last message) of
+    the conversation are kept, followed by the shortening request.
+    """
+    messages = list(conversation)
+    minimal_conversation = conversation.__class__()
+    for message in (messages[0], messages[-1]):
+        minimal_conversation = minimal_conversation.add(message['role'], message['content'])
+    return minimal_conversation.add('user', request)
+
+
+# Return the completion token budget of a shortening request for an answer.
+def shorten_max_tokens(answer, ratio=SHORTEN_MAX_TOKENS_RATIO):
+    """Return the completion token budget of a shortening request for an answer."""
+    return max(1, int(math.ceil(count_text_tokens(answer) * ratio)))
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Persistent conversation history for GPT4 exam conversations.
+
+A Conversation is an immutable linked list of frozen Message records. Adding a message returns
+a new Conversation that shares every prior message with the original, so building the history
+of a conversation is linear in its length rather than quadratic, and earlier versions of the
+conversation cost only one node each. The message list required by the API is created only when
+a request is sent, with to_messages().
+
+When run as a script, compares the cost of building conversations of 10, 100, and 1000 turns
+with this type against the previous deepcopy-based add_to_prompt.
+"""
+
+import copy
+import time
+import tracemalloc
+
+
+# Frozen record of a single conversation message.
+class Message():
+    """Frozen record of a single conversation message."""
+
+    __slots__ = ('role', 'content')
+
+    def __init__(self, role, content):
+        """Create the message record."""
+        object.__setattr__(self, 'role', role)
+        object.__setattr__(self, 'content', content)
+
+    def __setattr__(self, name, value):
+        """Prevent modification of the message record."""
+        raise AttributeError('Message records are immutable.')
+
+    def __getitem__(self, key):
+        """Return the role or content of the message, as for a message dict."""
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        """Compare messages by role and content."""
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.role == other.role and self.content == other.content
+
+    def __hash__(self):
+        """Hash messages by role and content."""
+        return hash((self.role, self.content))
+
+    def __repr__(self):
+        """Represent the message record."""
+        return 'Message(' + repr(self.role) + ', ' + repr(self.content) + ')'
+
+    def to_dict(self):
+        """Return the message as a dict, as used by the API."""
+        return {'role': self.role, 'content': self.content}
+
+
+# Immutable conversation that shares its prefix with the conversation it was created from.
+class Conversation():
+    """
+    Immutable conversation that shares its prefix with the conversation it was created from.
+
+    Each Conversation holds its final message and a reference to the Conversation of all prior
+    messages. The empty conversation is Conversation().
+    """
+
+    __slots__ = ('message', 'parent', 'length')
+
+    def __init__(self, message=None, parent=None):
+        """Create a conversation of parent followed by message (or an empty conversation)."""
+        object.__setattr__(self, 'message', message)
+        object.__setattr__(self, 'parent', parent)
+        if message is None:
+            object.__setattr__(self, 'length', 0)
+        else:
+            object.__setattr__(self, 'length', (parent.length if parent is not None else 0) + 1)
+
+    def __setattr__(self, name, value):
+        """Prevent modification of the conversation."""
+        raise AttributeError('Conversations are immutable.')
+
+    @classmethod
+    def from_messages(cls, messages):
+        """Create a conversation from a list of message dicts."""
+        conversation = cls()
+        for message in messages:
+            conversation = conversation.add(message['role'], message['content'])
+        return conversation
+
+    def add(self, role, content):
+        """Return a new conversation with a message added, sharing all prior messages."""
+        return Conversation(Message(role, content), self if self.length else None)
+
+    def __len__(self):
+        """Return the number of messages in the conversation."""
+        return self.length
+
+    def __iter__(self):
+        """Iterate over the messages of the conversation in order."""
+        messages = []
+        node = self
+        while node is not None and node.message is not None:
+            messages.append(node.message)
+            node = node.parent
+        return reversed(messages)
+
+    def __getitem__(self, index):
+        """Return the message at index."""
+        return list(self)[index]
+
+    def __eq__(self, other):
+        """Compare conversations by their messages."""
+        if not isinstance(other, Conversation):
+            return NotImplemented
+        return self.length == other.length and list(self) == list(other)
+
+    def __hash__(self):
+        """Hash conversations by their messages."""
+        return hash(tuple(self))
+
+    def __repr__(self):
+        """Represent the conversation."""
+        return 'Conversation(' + repr(list(self)) + ')'
+
+    def last(self):
+        """Return the final message of the conversation (or None if empty)."""
+        return self.message
+
+    def to_messages(self):
+        """Return the conversation as a new list of message dicts, as sent to the API."""
+        return [message.to_dict() for message in self]
+
+
+# Previous implementation of add_to_prompt, retained for benchmarking.
+def deepcopy_add_to_prompt(initial_prompt, role, content):
+    """Add to the list of prompt componenents with a specified role and content (deepcopy)."""
+    ret_prompt = []
+    for item in initial_prompt:
+        ret_prompt.append(copy.deepcopy(item))
+    ret_prompt.append({'role': role, 'content': content})
+    return ret_prompt
+
+
+# Build a conversation of num_turns turns, as done by the exam loop.
+def build_conversation(num_turns, add_func, start, to_messages):
+    """
+    Build a conversation of num_turns turns, as done by the exam loop.
+
+    Each turn adds a user message, serializes the conversation to be sent, and then adds the
+    assistant response. All versions of the conversation are kept alive, as for reports and
+    follow-up requests. Returns: list of all conversation versions.
+    """
+    question = 'Question: (1/2 page)\n' + ('Why is the sky blue? ' * 10) + '\n'
+    answer = 'The sky is blue because of Rayleigh scattering. ' * 20
+    versions = [start]
+    conversation = start
+    for _ in range(num_turns):
+        conversation = add_func(conversation, 'user', question)
+        to_messages(conversation)
+        conversation = add_func(conversation, 'assistant', answer)
+        versions.append(conversation)
+    return versions
+
+
+# Time and measure peak memory of building a conversation.
+def measure(num_turns, add_func, start, to_messages):
+    """Return seconds and peak traced memory (bytes) for building a conversation."""
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    versions = build_conversation(num_turns, add_func, start, to_messages)
+    elapsed = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del versions
+    return elapsed, peak
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    print('\nConversation history benchmark (all versions kept alive):\n')
+    print('{:>6}  {:>14}  {:>14}  {:>14}  {:>14}'.format(
+        'Turns', 'Deepcopy (s)', 'Shared (s)', 'Deepcopy (MB)', 'Shared (MB)'))
+    for use_num_turns in (10, 100, 1000):
+        deepcopy_time, deepcopy_peak = measure(
+            use_num_turns, deepcopy_add_to_prompt, [], lambda prompt: prompt
+        )
+        shared_time, shared_peak = measure(
+            use_num_turns, Conversation.add, Conversation(), Conversation.to_messages
+        )
+        print('{:>6}  {:>14.4f}  {:>14.4f}  {:>14.2f}  {:>14.2f}'.format(
+            use_num_turns, deepcopy_time, shared_time,
+            deepcopy_peak / 1e6, shared_peak / 1e6))
+    print()
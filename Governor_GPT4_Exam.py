@@ -0,0 +1,190 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Request governor for OpenAI API calls.
+
+Every API call made by Query_GPT4_Exam.py passes through a Request_Governor, which keeps
+requests-per-minute and tokens-per-minute budgets with token buckets, retries rate-limit,
+timeout, and server errors with jittered exponential backoff, and keeps counters of throttled
+time and retries that can be used to size concurrency to the available quota.
+"""
+
+import time
+import random
+import threading
+import openai
+import requests
+from Context_GPT4_Exam import count_prompt_tokens
+
+# Errors that are safe to retry. Chat completion requests do not modify any server-side state,
+# so re-sending an identical request is idempotent. Connection errors raised by requests are
+# not wrapped by openai while a streamed response is being read.
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+)
+
+
+# Token bucket refilled continuously at a per-minute rate.
+class Token_Bucket():
+    """Token bucket refilled continuously at a per-minute rate."""
+
+    def __init__(self, per_minute):
+        """Create a full bucket holding per_minute units."""
+        self.capacity = float(per_minute)
+        self.rate = float(per_minute) / 60.0
+        self.level = float(per_minute)
+        self.last_refill = time.monotonic()
+
+    def refill(self):
+        """Add units accrued since the last refill, up to capacity."""
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + ((now - self.last_refill) * self.rate))
+        self.last_refill = now
+
+    def wait_time(self, amount):
+        """Return seconds until amount units are available (0 if available now)."""
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        """Remove amount units from the bucket (level may become negative as debt)."""
+        self.level -= amount
+
+
+# Govern API requests with rate-limit budgets, retries, and backoff.
+class Request_Governor():
+    """
+    Govern API requests with rate-limit budgets, retries, and backoff.
+
+    A single governor is shared by all concurrent conversations so that the combined request
+    rate stays within the account quota. All methods are thread-safe.
+    """
+
+    def __init__(self,
+                 requests_per_minute=200,
+                 tokens_per_minute=40000,
+                 max_retries=6,
+                 base_delay=1.0,
+                 max_delay=60.0,
+                 ):
+        """Create governor with the specified budgets and retry policy."""
+        self.request_bucket = Token_Bucket(requests_per_minute)
+        self.token_bucket = Token_Bucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.counters = {
+            'requests': 0,
+            'retries': 0,
+            'failures': 0,
+            'throttled_seconds': 0.0,
+            'backoff_seconds': 0.0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+        }
+
+    def acquire(self, estimated_tokens):
+        """
+        Block until one request and estimated_tokens tokens are available in the budgets.
+
+        Returns: seconds spent waiting for budget.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                wait = max(self.request_bucket.wait_time(1),
+                           self.token_bucket.wait_time(estimated_tokens))
+                if wait <= 0:
+                    self.request_bucket.take(1)
+                    self.token_bucket.take(estimated_tokens)
+                    self.counters['requests'] += 1
+                    return waited
+                self.counters['throttled_seconds'] += wait
+            time.sleep(wait)
+            waited += wait
+
+    def record_usage(self, messages, usage):
+        """Correct the token budget for messages using the actual usage returned by the API."""
+        if not usage:
+            return
+        with self.lock:
+            self.token_bucket.take(usage['total_tokens'] - count_prompt_tokens(messages))
+            self.counters['prompt_tokens'] += usage.get('prompt_tokens', 0)
+            self.counters['completion_tokens'] += usage.get('completion_tokens', 0)
+
+    def backoff_delay(self, attempt, error):
+        """Return delay before retry attempt, honoring any Retry-After header from the server."""
+        headers = getattr(error, 'headers', None) or {}
+        retry_after = headers.get('retry-after') or headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(self.max_delay, float(retry_after))
+            except ValueError:
+                pass
+        # Full jitter: uniform between 0 and the exponential ceiling.
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def call(self, request_func, messages, call_stats=None, **kwargs):
+        """
+        Call request_func(messages=messages, **kwargs) within budget, retrying on failure.
+
+        If call_stats is a dict, the retries, throttled seconds, and backoff seconds of this
+        call are stored in it.
+        Returns: the response of request_func.
+        Raises: the last error if all retries are exhausted.
+        """
+        if call_stats is None:
+            call_stats = {}
+        call_stats.update({'retries': 0, 'throttled_seconds': 0.0, 'backoff_seconds': 0.0})
+        estimated_tokens = count_prompt_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            call_stats['throttled_seconds'] += self.acquire(estimated_tokens)
+            try:
+                return request_func(messages=messages, **kwargs)
+            except RETRYABLE_ERRORS as error:
+                if attempt >= self.max_retries:
+                    with self.lock:
+                        self.counters['failures'] += 1
+                    raise
+                delay = self.backoff_delay(attempt, error)
+                call_stats['retries'] += 1
+                call_stats['backoff_seconds'] += delay
+                with self.lock:
+                    self.counters['retries'] += 1
+                    self.counters['backoff_seconds'] += delay
+                print('API error (' + type(error).__name__ + '), retry',
+                      attempt + 1, 'of', self.max_retries, 'in', '%.1f' % delay, 'seconds...')
+                time.sleep(delay)
+
+    def stats(self):
+        """Return a copy of the governor counters."""
+        with self.lock:
+            return dict(self.counters)
+
+    def stats_str(self):
+        """Return a report string of the governor counters."""
+        stats = self.stats()
+        stats_str = 'Request Governor:\n'
+        stats_str += '    Requests: ' + str(stats['requests']) + '\n'
+        stats_str += '    Retries: ' + str(stats['retries']) + '\n'
+        stats_str += '    Failures: ' + str(stats['failures']) + '\n'
+        stats_str += '    Throttled Seconds: ' + '%.1f' % stats['throttled_seconds'] + '\n'
+        stats_str += '    Backoff Seconds: ' + '%.1f' % stats['backoff_seconds'] + '\n'
+        stats_str += '    Prompt Tokens: ' + str(stats['prompt_tokens']) + '\n'
+        stats_str += '    Completion Tokens: ' + str(stats['completion_tokens']) + '\n'
+        return stats_str
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Append-only checkpoint journal for GPT4 exam conversations.
+
+Each conversation writes a journal next to its report file. The journal records the initial
+prompt and then every completed turn (request and response messages, details, usage), along
+with the size of the report file after that turn was written. On resume, the journal is used to
+rebuild the conversation history and truncate the report to the end of the last completed turn,
+so that no answer that has already been paid for is requested again. The journal itself is
+truncated to the end of its last complete record, so that records appended on resume never
+follow a partial line.
+"""
+
+import os
+import json
+from Profile_GPT4_Exam import span
+
+JOURNAL_SUFFIX = '_journal.jsonl'
+
+
+# Return the journal file name for a report output file.
+def journal_file_name(out_file_name):
+    """Return the journal file name for a report output file."""
+    return os.path.splitext(out_file_name)[0] + JOURNAL_SUFFIX
+
+
+# Load a conversation journal.
+def load_journal(file_name):
+    """
+    Load a conversation journal.
+
+    Returns: dict with keys: initial_prompt, turns, report_offset, journal_offset (size of the
+        journal through its last complete record), complete;
+        or None if the journal does not exist or has no start record.
+    """
+    if not os.path.isfile(file_name):
+        return None
+    journal = None
+    journal_offset = 0
+    with open(file_name, 'rb') as journal_file_obj:
+        for line in journal_file_obj:
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError('Partial record')
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # A partial final line from an interrupted write is ignored.
+                break
+            journal_offset += len(line)
+            if record['type'] == 'start':
+                journal = {
+                    'initial_prompt': record['initial_prompt'],
+                    'turns': [],
+                    'report_offset': record['report_offset'],
+                    'complete': False,
+                }
+            elif journal is None:
+                continue
+            elif record['type'] == 'turn':
+                journal['turns'].append(record)
+                journal['report_offset'] = record['report_offset']
+            elif record['type'] == 'complete':
+                journal['complete'] = True
+            if journal is not None:
+                journal['journal_offset'] = journal_offset
+    return journal
+
+
+# Append-only journal of completed conversation turns.
+class Conversation_Journal():
+    """Append-only journal of completed conversation turns."""
+
+    def __init__(self, file_name, resume_offset=None):
+        """
+        Open the journal, truncating it.
+
+        If resume_offset is given (the journal_offset of load_journal()), the journal is
+        truncated to that size and appended to, discarding any partial final record.
+        """
+        self.file_name = file_name
+        if resume_offset is None:
+            self.file_obj = open(self.file_name, 'w')
+        else:
+            os.truncate(self.file_name, resume_offset)
+            self.file_obj = open(self.file_name, 'a')
+
+    def write_record(self, record):
+        """Append a record and force it to disk."""
+        with span('journal', type=record['type']):
+            self.file_obj.write(json.dumps(record) + '\n')
+            self.file_obj.flush()
+            os.fsync(self.file_obj.fileno())
+
+    def start(self, initial_prompt, report_offset):
+        """Record the initial prompt of the conversation."""
+        self.write_record({
+            'type': 'start',
+            'initial_prompt': initial_prompt,
+            'report_offset': report_offset,
+        })
+
+    def record_turn(self, prompt_i, messages, details, usage, report_offset, timing=None,
+                    samples=None,
+                    ):
+        """
+        Record a completed turn (request and response messages, details, usage, timing).
+
+        If the request was sampled more than once, samples holds the content of every sample.
+        """
+        record = {
+            'type': 'turn',
+            'prompt_i': prompt_i,
+            'messages': messages,
+            'details': details,
+            'usage': usage,
+            'timing': timing,
+            'report_offset': report_offset,
+        }
+        if samples is not None:
+            record['samples'] = samples
+        self.write_record(record)
+
+    def complete(self):
+        """Record completion of the conversation."""
+        self.write_record({'type': 'complete'})
+
+    def close(self):
+        """Close the file handle."""
+        self.file_obj.close()
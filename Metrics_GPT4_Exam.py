@@ -0,0 +1,211 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Per-turn metrics stream and run-level performance report.
+
+Query_GPT4_Exam.py appends one JSON line per API call to a metrics file, carrying the run,
+exam, template, prompt index, segment, request kind, latency, token usage, retries, and whether
+the response was served from the cache. When run as a script, summarizes one or more metrics
+files: latency percentiles, throughput in questions per minute, tokens per template, and cost
+estimates, per template and per request kind.
+
+Usage:
+    python Metrics_GPT4_Exam.py METRICS_FILE [METRICS_FILE ...]
+"""
+
+import json
+import time
+import argparse
+import threading
+import collections
+
+DEFAULT_METRICS_FILE_NAME = 'GPT4_Metrics.jsonl'
+
+# Pricing in USD per 1000 tokens: (prompt, completion).
+MODEL_PRICING = {
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-0314': (0.03, 0.06),
+    'gpt-4-0613': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+    'gpt-3.5-turbo': (0.0015, 0.002),
+}
+
+
+# Thread-safe append-only sink of per-call metrics records.
+class Metrics_Sink():
+    """Thread-safe append-only sink of per-call metrics records."""
+
+    def __init__(self, file_name, run_id=None):
+        """Open the metrics file for appending, identifying records with run_id."""
+        self.file_name = file_name
+        self.run_id = run_id or time.strftime('%Y%m%d-%H%M%S')
+        self.lock = threading.Lock()
+        self.file_obj = open(self.file_name, 'a')
+
+    def record(self, record):
+        """Append a metrics record."""
+        record = {'run_id': self.run_id, 'timestamp': round(time.time(), 3), **record}
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.file_obj.write(line)
+            self.file_obj.flush()
+
+    def close(self):
+        """Close the file handle."""
+        with self.lock:
+            self.file_obj.close()
+
+
+# Load metrics records from one or more metrics files.
+def load_metrics(file_names):
+    """Load metrics records from one or more metrics files."""
+    records = []
+    for file_name in file_names:
+        with open(file_name, 'r') as metrics_file_obj:
+            for line in metrics_file_obj:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+
+# Return the percentile of a list of values (linear interpolation between ranks).
+def percentile(values, percent):
+    """Return the percentile of a list of values (linear interpolation between ranks)."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * (percent / 100.0)
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + ((values[upper] - values[lower]) * (rank - lower))
+
+
+# Estimate the cost of a metrics record in USD.
+def estimate_cost(record):
+    """Estimate the cost of a metrics record in USD (zero for cache hits)."""
+    if record.get('cache_hit'):
+        return 0.0
+    prompt_price, completion_price = MODEL_PRICING.get(record.get('model'), MODEL_PRICING['gpt-4'])
+    return (((record.get('prompt_tokens') or 0) * prompt_price)
+            + ((record.get('completion_tokens') or 0) * completion_price)) / 1000.0
+
+
+# Summarize a group of metrics records.
+def summarize_group(records):
+    """Summarize a group of metrics records."""
+    api_records = [r for r in records if not r.get('cache_hit')]
+    latencies = [r['latency_seconds'] for r in api_records if r.get('latency_seconds') is not None]
+    questions = sum(1 for r in records if r.get('request') == 'question')
+    return {
+        'calls': len(records),
+        'cache_hits': len(records) - len(api_records),
+        'questions': questions,
+        'retries': sum(r.get('retries') or 0 for r in records),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'prompt_tokens': sum(r.get('prompt_tokens') or 0 for r in records),
+        'completion_tokens': sum(r.get('completion_tokens') or 0 for r in records),
+        'cost': sum(estimate_cost(r) for r in records),
+    }
+
+
+# Summarize metrics records overall, by template, and by template and request kind.
+def summarize(records):
+    """
+    Summarize metrics records overall, by template, and by template and request kind.
+
+    Throughput is computed from the wall-clock span of each run (from the start of its first
+    call to the end of its last call), summed over runs.
+    Returns: dict with keys: overall, runs, wall_minutes, questions_per_minute,
+        by_template, by_request.
+    """
+    run_spans = {}
+    for record in records:
+        end = record['timestamp']
+        start = end - (record.get('latency_seconds') or 0)
+        span = run_spans.setdefault(record['run_id'], [start, end])
+        span[0] = min(span[0], start)
+        span[1] = max(span[1], end)
+    wall_minutes = sum((end - start) for start, end in run_spans.values()) / 60.0
+
+    by_template = collections.OrderedDict()
+    by_request = collections.OrderedDict()
+    for record in records:
+        by_template.setdefault(record.get('template'), []).append(record)
+        by_request.setdefault((record.get('template'), record.get('request')), []).append(record)
+
+    overall = summarize_group(records)
+    return {
+        'overall': overall,
+        'runs': len(run_spans),
+        'wall_minutes': wall_minutes,
+        'questions_per_minute': (overall['questions'] / wall_minutes) if wall_minutes else None,
+        'by_template': {k: summarize_group(v) for k, v in by_template.items()},
+        'by_request': {k: summarize_group(v) for k, v in by_request.items()},
+    }
+
+
+# Format a number for the summary report.
+def format_value(value, digits=2):
+    """Format a number for the summary report."""
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{:.{}f}'.format(value, digits)
+    return str(value)
+
+
+# Create the summary report string.
+def summary_str(summary):
+    """Create the summary report string."""
+    overall = summary['overall']
+    report = 'Metrics Summary:\n'
+    report += '    Runs: ' + str(summary['runs']) + '\n'
+    report += '    API Calls: ' + str(overall['calls']) + '\n'
+    report += '    Cache Hits: ' + str(overall['cache_hits']) + '\n'
+    report += '    Retries: ' + str(overall['retries']) + '\n'
+    report += '    Wall Minutes: ' + format_value(summary['wall_minutes']) + '\n'
+    report += '    Questions / Minute: ' + format_value(summary['questions_per_minute']) + '\n'
+    report += '    Latency p50 / p95 / p99 (s): ' + ' / '.join(
+        format_value(overall[key]) for key in ('latency_p50', 'latency_p95', 'latency_p99')
+    ) + '\n'
+    report += '    Estimated Cost (USD): ' + format_value(overall['cost'], 4) + '\n\n'
+
+    header = '{:<24} {:>6} {:>9} {:>8} {:>8} {:>8} {:>11} {:>11} {:>10} {:>10}\n'
+    row = '{:<24} {:>6} {:>9} {:>8} {:>8} {:>8} {:>11} {:>11} {:>10} {:>10}\n'
+    columns = ('Group', 'Calls', 'Questions', 'p50 (s)', 'p95 (s)', 'p99 (s)',
+               'Prompt Tok', 'Compl. Tok', 'Cost', 'Cost / Q')
+    for title, groups in (('By Template:', summary['by_template']),
+                          ('By Template and Request:', summary['by_request'])):
+        report += title + '\n'
+        report += header.format(*columns)
+        for key, group in groups.items():
+            name = key if not isinstance(key, tuple) else ' / '.join(str(k) for k in key)
+            report += row.format(
+                str(name)[:24],
+                group['calls'],
+                group['questions'],
+                format_value(group['latency_p50']),
+                format_value(group['latency_p95']),
+                format_value(group['latency_p99']),
+                group['prompt_tokens'],
+                group['completion_tokens'],
+                format_value(group['cost'], 4),
+                format_value((group['cost'] / group['questions']) if group['questions'] else None,
+                             4),
+            )
+        report += '\n'
+    return report
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('metrics_files', nargs='+', help='Metrics JSONL file(s) to summarize')
+    args = parser.parse_args()
+
+    print('\n' + summary_str(summarize(load_metrics(args.metrics_files))))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Serves POST /v1/chat/completions (streamed or not) with deterministic responses generated from
+a hash of the request messages, so that Query_GPT4_Exam.py can be exercised and benchmarked
+without an API key. Latency, completion length, streaming speed, and the rates of injected 429
+rate-limit and 500 server errors are configurable. Usage is reported from local token counts.
+
+Usage:
+    python Mock_Server_GPT4_Exam.py [--port 8000] [--latency 0.5] [--rate-limit-rate 0.05] ...
+Then run Query_GPT4_Exam.py with: OPENAI_API_BASE=http://127.0.0.1:8000/v1
+"""
+
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from Context_GPT4_Exam import count_prompt_tokens, count_text_tokens
+
+# Words used to build deterministic responses.
+RESPONSE_WORDS = (
+    'cell membrane protein signaling receptor kinase transcription expression pathway '
+    'mitochondria nucleus cytoskeleton vesicle transport regulation binding domain enzyme '
+    'substrate gradient phosphorylation ligand complex structure function mechanism the of '
+    'and in to is by which that through'
+).split()
+
+DEFAULT_MOCK_CONFIG = {
+    'latency': 0.0,
+    'latency_jitter': 0.0,
+    'completion_words': 80,
+    'stream_tokens_per_second': 0.0,
+    'rate_limit_rate': 0.0,
+    'error_rate': 0.0,
+    'list_rate': 0.0,
+    'seed': 0,
+}
+
+
+# Generate a deterministic response for a list of messages.
+def generate_response(messages, config, choice_index=0):
+    """Generate a deterministic response for a list of messages (and choice, if n > 1)."""
+    seed = str(config['seed']) + (('/' + str(choice_index)) if choice_index else '')
+    digest = hashlib.sha256(
+        (seed + json.dumps(messages, sort_keys=True)).encode('utf-8')
+    ).hexdigest()
+    rng = random.Random(digest)
+    words = [rng.choice(RESPONSE_WORDS) for _ in range(config['completion_words'])]
+    response = 'Mock answer ' + digest[:8] + ': ' + ' '.join(words) + '.'
+    if rng.random() < config['list_rate']:
+        response += '\n1. ' + ' '.join(words[:5]) + '.\n2. ' + ' '.join(words[5:10]) + '.'
+    return response, digest
+
+
+# Truncate a response to at most max_tokens tokens.
+def truncate_response(content, max_tokens):
+    """
+    Truncate a response to at most max_tokens tokens, at a word boundary.
+
+    Returns: (content, finish_reason), with finish_reason "length" if truncated, else "stop".
+    """
+    if max_tokens is None or count_text_tokens(content) <= max_tokens:
+        return content, 'stop'
+    words = content.split(' ')
+    while len(words) > 1 and count_text_tokens(' '.join(words)) > max_tokens:
+        words.pop()
+    return ' '.join(words), 'length'
+
+
+# Request handler implementing the chat completions endpoint.
+class Mock_Handler(BaseHTTPRequestHandler):
+    """Request handler implementing the chat completions endpoint."""
+
+    protocol_version = 'HTTP/1.1'
+    # Responses are written in several pieces (headers, body, and stream chunks); without
+    #   TCP_NODELAY, Nagle's algorithm and delayed ACKs hold back the last piece of each response
+    #   on a kept-alive connection by ~40 ms.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        """Suppress per-request logging."""
+
+    def send_json(self, status, obj, headers=None):
+        """Send a JSON response."""
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, obj):
+        """Send one server-sent event of a streamed response."""
+        data = b'data: ' + (obj if isinstance(obj, bytes) else json.dumps(obj).encode('utf-8'))
+        data += b'\n\n'
+        self.wfile.write(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_POST(self):
+        """Respond to a chat completions request."""
+        config = self.server.mock_config
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': 'Unknown path: ' + self.path}})
+            return
+
+        with self.server.mock_lock:
+            self.server.mock_requests += 1
+            draw = self.server.mock_random.random()
+        if draw < config['rate_limit_rate']:
+            self.send_json(429, {'error': {'message': 'Mock rate limit reached.',
+                                           'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                           headers={'Retry-After': '0.1'})
+            return
+        if draw < config['rate_limit_rate'] + config['error_rate']:
+            self.send_json(500, {'error': {'message': 'Mock server error.',
+                                           'type': 'server_error'}})
+            return
+
+        delay = config['latency'] + random.uniform(0, config['latency_jitter'])
+        if delay > 0:
+            time.sleep(delay)
+
+        messages = request['messages']
+        content, digest = generate_response(messages, config)
+        choice_contents = [content] + [generate_response(messages, config, choice_index)[0]
+                                       for choice_index in range(1, int(request.get('n', 1)))]
+        choices = [truncate_response(choice_content, request.get('max_tokens'))
+                   for choice_content in choice_contents]
+        choice_contents = [choice_content for choice_content, finish_reason in choices]
+        content, finish_reason = choices[0]
+        prompt_tokens = count_prompt_tokens(messages)
+        completion_tokens = sum(count_text_tokens(c) for c in choice_contents)
+        response_id = 'chatcmpl-mock-' + digest[:24]
+        created = int(time.time())
+        model = request.get('model', 'mock')
+
+        if not request.get('stream'):
+            self.send_json(200, {
+                'id': response_id,
+                'object': 'chat.completion',
+                'created': created,
+                'model': model,
+                'choices': [{
+                    'index': choice_index,
+                    'message': {'role': 'assistant', 'content': choice_content},
+                    'finish_reason': choice_finish_reason,
+                } for choice_index, (choice_content, choice_finish_reason) in enumerate(choices)],
+                'usage': {
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': completion_tokens,
+                    'total_tokens': prompt_tokens + completion_tokens,
+                },
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        chunk = {'id': response_id, 'object': 'chat.completion.chunk', 'created': created,
+                 'model': model}
+        pieces = [{'role': 'assistant'}] + [{'content': word} for word in
+                                            content.replace(' ', '\0 ').split('\0')]
+        for delta in pieces:
+            self.send_chunk({**chunk, 'choices': [{'index': 0, 'delta': delta,
+                                                   'finish_reason': None}]})
+            if config['stream_tokens_per_second'] > 0:
+                time.sleep(1.0 / config['stream_tokens_per_second'])
+        self.send_chunk({**chunk, 'choices': [{'index': 0, 'delta': {},
+                                               'finish_reason': finish_reason}]})
+        self.send_chunk(b'[DONE]')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+
+# Start the mock server in a background thread.
+def start_mock_server(host='127.0.0.1', port=0, **config):
+    """
+    Start the mock server in a background thread.
+
+    Returns: (server, api_base), where api_base is the URL to use as openai.api_base.
+        Stop the server with server.shutdown().
+    """
+    server = ThreadingHTTPServer((host, port), Mock_Handler)
+    server.daemon_threads = True
+    server.mock_config = {**DEFAULT_MOCK_CONFIG, **config}
+    server.mock_lock = threading.Lock()
+    server.mock_random = random.Random(server.mock_config['seed'])
+    server.mock_requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    api_base = 'http://' + host + ':' + str(server.server_address[1]) + '/v1'
+    return server, api_base
+
+
+# Add arguments for the mock server configuration to an argument parser.
+def add_mock_arguments(parser):
+    """Add arguments for the mock server configuration to an argument parser."""
+    parser.add_argument('--latency', type=float, default=DEFAULT_MOCK_CONFIG['latency'],
+                        help='Seconds of latency per request (default: %(default)s)')
+    parser.add_argument('--latency-jitter', type=float,
+                        default=DEFAULT_MOCK_CONFIG['latency_jitter'],
+                        help='Maximum additional random latency (default: %(default)s)')
+    parser.add_argument('--completion-words', type=int,
+                        default=DEFAULT_MOCK_CONFIG['completion_words'],
+                        help='Words per generated response (default: %(default)s)')
+    parser.add_argument('--stream-tokens-per-second', type=float,
+                        default=DEFAULT_MOCK_CONFIG['stream_tokens_per_second'],
+                        help='Pace of streamed responses, 0 for unpaced (default: %(default)s)')
+    parser.add_argument('--rate-limit-rate', type=float,
+                        default=DEFAULT_MOCK_CONFIG['rate_limit_rate'],
+                        help='Fraction of requests answered with 429 (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=DEFAULT_MOCK_CONFIG['error_rate'],
+                        help='Fraction of requests answered with 500 (default: %(default)s)')
+    parser.add_argument('--list-rate', type=float, default=DEFAULT_MOCK_CONFIG['list_rate'],
+                        help=('Fraction of responses containing a numbered list '
+                              '(default: %(default)s)'))
+    parser.add_argument('--seed', type=int, default=DEFAULT_MOCK_CONFIG['seed'],
+                        help=('Seed for generated responses and injected errors '
+                              '(default: %(default)s)'))
+
+
+# Return the mock server configuration from parsed arguments.
+def mock_config_from_args(args):
+    """Return the mock server configuration from parsed arguments."""
+    return {key: getattr(args, key) for key in DEFAULT_MOCK_CONFIG}
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1', help='Host to bind (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port to bind (default: %(default)s)')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mock_server, mock_api_base = start_mock_server(args.host, args.port,
+                                                   **mock_config_from_args(args))
+    print('Mock OpenAI server listening at:', mock_api_base)
+    print('Run with: OPENAI_API_BASE=' + mock_api_base + ' OPENAI_API_KEY=mock')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock_server.shutdown()
+        print('\nDone.\n')
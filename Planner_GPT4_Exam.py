@@ -0,0 +1,575 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Dry-run planner estimating the requests, tokens, cost, and duration of a run.
+
+Without querying the API, the conversations of a run are planned exactly as Query_GPT4_Exam.py
+plans them (the same settings files, prompt templates, question selection, reset segments, and
+follow-up rules), and each conversation is simulated turn by turn. Prompt sizes are counted
+locally from the actual initial prompts and questions; completion lengths, follow-up request
+rates, and latencies are taken from historical metrics files (or defaults if there are none).
+Follow-up requests are counted at their expected rate, and the context policy and Expert_Short
+shortening requests are applied as in a run. The plan reports the expected requests, prompt and
+completion tokens, cost, peak context size of each conversation, and wall-clock time at the
+given concurrency and rate limits. For each exam, it also recommends the reset points that
+minimize total prompt tokens for the same number of resets, and the fewest resets keeping every
+segment within the context window.
+
+Usage:
+    python Planner_GPT4_Exam.py [SETTINGS_FILE ...] [--metrics-files METRICS_FILE ...]
+"""
+
+import os
+import math
+import heapq
+import argparse
+import collections
+import Query_GPT4_Exam
+from Context_GPT4_Exam import CONTEXT_POLICIES, SHORTEN_CONTEXTS, SHORTEN_MAX_TOKENS_RATIO, \
+                              TOKENS_PER_MESSAGE, TOKENS_PER_REPLY, count_prompt_tokens, \
+                              count_message_tokens, count_text_tokens
+from Metrics_GPT4_Exam import MODEL_PRICING, DEFAULT_METRICS_FILE_NAME, load_metrics
+from Postprocess_GPT4_Exam import FOLLOW_UP_RULES
+from Questions_GPT4_Exam import DRAWING_PATTERN, add_question_store_arguments, \
+                                question_store_from_args
+from Settings_GPT4_Grad_Exam import SHORTEN_REQUEST
+
+# Completion tokens of each request kind without historical metrics (shortened answers are
+#   requested at approximately 65% of the answer length).
+DEFAULT_COMPLETION_TOKENS = {'question': 350, 'shorten': 230}
+DEFAULT_FOLLOW_UP_COMPLETION_TOKENS = 350
+# Fraction of answers violating each follow-up rule without historical metrics.
+DEFAULT_FOLLOW_UP_RATES = {
+    'numbered_list': 0.25,
+    'markdown': 0.1,
+    'bold_count': 0.5,
+    'drawing_instructions': 0.5,
+}
+# Latency of each request without historical metrics: a fixed overhead plus completion time.
+DEFAULT_REQUEST_SECONDS = 1.5
+DEFAULT_TOKENS_PER_SECOND = 20.0
+
+
+# Return the mean of a list of values, or None if empty.
+def mean(values):
+    """Return the mean of a list of values, or None if empty."""
+    return (sum(values) / len(values)) if values else None
+
+
+# Compute completion-length, latency, and follow-up statistics from historical metrics records.
+def completion_statistics(records):
+    """
+    Compute completion-length, latency, and follow-up statistics from historical metrics records.
+
+    Completion tokens of multi-sample requests are divided by the number of samples. The rate of
+    each follow-up rule is the number of its follow-up requests per question asked with the rule
+    enabled (from the follow_up_rules of each record); rules never enabled in the records use
+    the default rates.
+    Returns: dict with keys: records, completion_tokens and latency_seconds (mean per request
+        kind), and follow_up_rates (per follow-up rule).
+    """
+    completion_tokens = collections.defaultdict(list)
+    latency_seconds = collections.defaultdict(list)
+    request_counts = collections.Counter()
+    enabled_questions = collections.Counter()
+    for record in records:
+        request_kind = record.get('request')
+        if request_kind is None:
+            continue
+        request_counts[request_kind] += 1
+        if request_kind == 'question':
+            enabled_questions.update(record.get('follow_up_rules') or [])
+        if record.get('completion_tokens') is not None:
+            completion_tokens[request_kind].append(
+                record['completion_tokens'] / (record.get('samples') or 1)
+            )
+        if not record.get('cache_hit') and record.get('latency_seconds') is not None:
+            latency_seconds[request_kind].append(record['latency_seconds'])
+
+    follow_up_rates = dict(DEFAULT_FOLLOW_UP_RATES)
+    for rule_name, rule in FOLLOW_UP_RULES.items():
+        if enabled_questions[rule_name]:
+            follow_up_rates[rule_name] = min(
+                1.0, request_counts[rule['request_kind']] / enabled_questions[rule_name]
+            )
+    return {
+        'records': len(records),
+        'completion_tokens': {k: mean(v) for k, v in completion_tokens.items()},
+        'latency_seconds': {k: mean(v) for k, v in latency_seconds.items()},
+        'follow_up_rates': follow_up_rates,
+    }
+
+
+# Return the expected turns of a question in a conversation.
+def question_turns(conversation, exam_prompt, statistics):
+    """
+    Return the expected turns of a question in a conversation, as asked by ask_question.
+
+    Returns: list of (request, request_kind, probability) tuples.
+    """
+    turns = [(exam_prompt, 'question', 1.0)]
+    for rule_name in conversation['follow_up_rules']:
+        if rule_name == 'drawing_instructions' and DRAWING_PATTERN.search(exam_prompt) is None:
+            continue
+        rule = FOLLOW_UP_RULES[rule_name]
+        turns.append((rule['request'], rule['request_kind'],
+                      statistics['follow_up_rates'][rule_name]))
+    if conversation['shorten_all_answers']:
+        turns.append((SHORTEN_REQUEST, 'shorten', 1.0))
+    return turns
+
+
+# Return the makespan of durations run in order on a number of workers.
+def makespan(durations, workers):
+    """Return the makespan of durations started in order on the first free of workers."""
+    finish_times = [0.0] * max(1, workers)
+    for duration in durations:
+        heapq.heapreplace(finish_times, finish_times[0] + duration)
+    return max(finish_times)
+
+
+# Turn-by-turn simulation of the expected token usage of a conversation.
+class Conversation_Simulator():
+    """
+    Turn-by-turn simulation of the expected token usage of a conversation.
+
+    The conversation history is tracked as the expected prompt tokens of each question group
+    (a question and its follow-up turns), so the context policy can reset or trim it as
+    Context_Policy does. Follow-up turns count at the probability they are requested.
+    """
+
+    def __init__(self, conversation, statistics, context_policy='off', max_context_window=None,
+                 reserve_tokens=None, shorten_context='full', samples=1,
+                 ):
+        """Prepare the simulation of a conversation from its initial prompt."""
+        self.conversation = conversation
+        self.statistics = statistics
+        self.context_policy = context_policy
+        self.max_context_window = int(max_context_window or Query_GPT4_Exam.MAX_CONTEXT_WINDOW)
+        if reserve_tokens is None:
+            reserve_tokens = Query_GPT4_Exam.CONTEXT_RESERVE_TOKENS
+        self.reserve_tokens = reserve_tokens
+        self.shorten_context = shorten_context
+        self.samples = samples
+        self.initial_tokens = count_prompt_tokens(conversation['initial_prompt'])
+        self.system_tokens = count_message_tokens(list(conversation['initial_prompt'])[0])
+        self.assistant_overhead = TOKENS_PER_MESSAGE + count_text_tokens('assistant')
+        self.groups = []
+        self.totals = {
+            'requests': 0.0,
+            'prompt_tokens': 0.0,
+            'completion_tokens': 0.0,
+            'seconds': 0.0,
+            'peak_context': 0,
+            'context_actions': 0,
+        }
+
+    def completion_tokens(self, request_kind):
+        """Return the expected completion tokens of a single response to a request kind."""
+        completion_tokens = self.statistics['completion_tokens'].get(request_kind)
+        if completion_tokens is None:
+            completion_tokens = DEFAULT_COMPLETION_TOKENS.get(
+                request_kind, DEFAULT_FOLLOW_UP_COMPLETION_TOKENS
+            )
+        return completion_tokens
+
+    def latency_seconds(self, request_kind, completion_tokens):
+        """Return the expected latency of a request."""
+        latency_seconds = self.statistics['latency_seconds'].get(request_kind)
+        if latency_seconds is None:
+            latency_seconds = (DEFAULT_REQUEST_SECONDS
+                               + (completion_tokens / DEFAULT_TOKENS_PER_SECOND))
+        return latency_seconds
+
+    def apply_policy(self, request_tokens):
+        """Apply the context policy to the history before a request, returning prompt tokens."""
+        prompt_tokens = self.initial_tokens + sum(self.groups) + request_tokens
+        limit = self.max_context_window - self.reserve_tokens
+        if self.context_policy in ('prompt', 'off') or prompt_tokens <= limit:
+            return prompt_tokens
+        if self.context_policy == 'reset':
+            self.groups = self.groups[-1:]
+        else:
+            while len(self.groups) > 1 and prompt_tokens > limit:
+                prompt_tokens -= self.groups.pop(0)
+        self.totals['context_actions'] += 1
+        return self.initial_tokens + sum(self.groups) + request_tokens
+
+    def ask(self, exam_prompt):
+        """Simulate a question and its follow-up turns, returning the question's seconds."""
+        self.groups.append(0.0)
+        question_seconds = 0.0
+        answer_tokens = 0.0
+        for request, request_kind, probability in question_turns(
+                self.conversation, exam_prompt, self.statistics):
+            request_tokens = count_message_tokens({'role': 'user', 'content': request})
+            completion_tokens = self.completion_tokens(request_kind)
+            prompt_tokens = self.apply_policy(request_tokens)
+            if request_kind == 'shorten' and self.shorten_context == 'minimal':
+                prompt_tokens = (self.system_tokens + self.assistant_overhead + answer_tokens
+                                 + request_tokens + TOKENS_PER_REPLY)
+                completion_tokens = min(completion_tokens,
+                                        math.ceil(answer_tokens * SHORTEN_MAX_TOKENS_RATIO))
+            samples = self.samples if request_kind == 'question' else 1
+            seconds = self.latency_seconds(request_kind, completion_tokens * samples)
+
+            self.totals['requests'] += probability
+            self.totals['prompt_tokens'] += probability * prompt_tokens
+            self.totals['completion_tokens'] += probability * completion_tokens * samples
+            self.totals['seconds'] += probability * seconds
+            self.totals['peak_context'] = max(self.totals['peak_context'],
+                                              int(math.ceil(prompt_tokens + completion_tokens)))
+            question_seconds += probability * seconds
+
+            # The answer (and history) after the turn is the expected answer at its probability.
+            answer_tokens = ((1 - probability) * answer_tokens) + (probability * completion_tokens)
+            self.groups[-1] += probability * (request_tokens + self.assistant_overhead
+                                              + completion_tokens)
+            self.reserve_tokens = max(self.reserve_tokens, completion_tokens)
+        return question_seconds
+
+
+# Simulate a planned conversation, as run by run_conversation.
+def simulate_conversation(conversation, statistics, settings):
+    """
+    Simulate a planned conversation, as run by run_conversation.
+
+    settings is a dict with keys: context_policy, shorten_context, samples, question_concurrency.
+    Returns: dict with keys: out_file_name, template_name, questions, requests, prompt_tokens,
+        completion_tokens, peak_context, context_actions, and seconds.
+    """
+    simulator = Conversation_Simulator(
+        conversation,
+        statistics,
+        context_policy=settings['context_policy'],
+        shorten_context=settings['shorten_context'],
+        samples=settings['samples'],
+    )
+    question_seconds = []
+    for prompt_i, exam_prompt in conversation['prompts']:
+        if conversation['independent_questions']:
+            simulator.groups = []
+        question_seconds.append(simulator.ask(exam_prompt))
+    if conversation['independent_questions']:
+        seconds = makespan(question_seconds, settings['question_concurrency'])
+    else:
+        seconds = sum(question_seconds)
+    return {
+        'out_file_name': conversation['out_file_name'],
+        'template_name': conversation['template_name'],
+        'questions': len(conversation['prompts']),
+        **simulator.totals,
+        'seconds': seconds,
+    }
+
+
+# Simulate all planned conversations of a run.
+def plan_run(conversations, statistics, settings):
+    """
+    Simulate all planned conversations of a run.
+
+    settings is a dict with keys: context_policy, shorten_context, samples, concurrency,
+    question_concurrency, rpm, and tpm. The wall-clock time is the longer of the schedule of
+    conversations on concurrency workers (in run order) and the time the rate limits allow.
+    Returns: dict with keys: conversations (per-conversation results), requests, prompt_tokens,
+        completion_tokens, cost, schedule_seconds, rate_limit_seconds, and wall_clock_seconds.
+    """
+    results = [simulate_conversation(c, statistics, settings) for c in conversations]
+    requests = sum(r['requests'] for r in results)
+    prompt_tokens = sum(r['prompt_tokens'] for r in results)
+    completion_tokens = sum(r['completion_tokens'] for r in results)
+    prompt_price, completion_price = MODEL_PRICING.get(Query_GPT4_Exam.MODEL,
+                                                       MODEL_PRICING['gpt-4'])
+    schedule_seconds = makespan([r['seconds'] for r in results], settings['concurrency'])
+    rate_limit_seconds = max(60.0 * requests / settings['rpm'],
+                             60.0 * (prompt_tokens + completion_tokens) / settings['tpm'])
+    return {
+        'conversations': results,
+        'requests': requests,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cost': ((prompt_tokens * prompt_price) + (completion_tokens * completion_price)) / 1000.0,
+        'schedule_seconds': schedule_seconds,
+        'rate_limit_seconds': rate_limit_seconds,
+        'wall_clock_seconds': max(schedule_seconds, rate_limit_seconds),
+    }
+
+
+# Compute the prompt tokens and peak context of every possible segment of an exam.
+def segment_costs(template_conversations, exam_prompts, statistics, settings):
+    """
+    Compute the prompt tokens and peak context of every possible segment of an exam.
+
+    Each segment (questions i through j, starting from the initial prompt) is simulated
+    without a context policy, for each template's conversation.
+    Returns: (costs, peaks), where costs[i][j] is the total prompt tokens of the segment over all
+        templates, and peaks[i][j] is its largest peak context.
+    """
+    num_prompts = len(exam_prompts)
+    costs = [[0.0] * num_prompts for _ in range(num_prompts)]
+    peaks = [[0] * num_prompts for _ in range(num_prompts)]
+    for conversation in template_conversations:
+        for start in range(num_prompts):
+            simulator = Conversation_Simulator(conversation, statistics,
+                                               shorten_context=settings['shorten_context'],
+                                               samples=settings['samples'])
+            for end in range(start, num_prompts):
+                simulator.ask(exam_prompts[end])
+                costs[start][end] += simulator.totals['prompt_tokens']
+                peaks[start][end] = max(peaks[start][end], simulator.totals['peak_context'])
+    return costs, peaks
+
+
+# Recommend the reset points of an exam minimizing total prompt tokens.
+def recommend_resets(exam_conversations, statistics, settings, num_resets=None):
+    """
+    Recommend the reset points of an exam minimizing total prompt tokens.
+
+    exam_conversations are the planned (non-independent) conversations of a single exam. Every
+    segment must fit within the context window. Resets are chosen by dynamic programming over
+    the simulated prompt tokens of each possible segment: for num_resets, over plans with
+    exactly num_resets resets (one layer per segment); for the fewest resets, over plans ranked
+    by number of segments and then prompt tokens (a single pass).
+    Returns: dict with keys: current (current reset prompt numbers), current_prompt_tokens,
+        num_resets, recommended (reset prompt numbers for num_resets resets, by default the
+        current number), recommended_prompt_tokens, fewest (fewest reset prompt numbers keeping
+        segments within the context window), and fewest_prompt_tokens. Recommendations are None
+        if no such resets exist.
+    """
+    template_conversations = {}
+    exam_prompts = {}
+    current = []
+    for conversation in exam_conversations:
+        template_conversations.setdefault(conversation['template_name'], conversation)
+        if conversation['segment'] != 1 and conversation['segment'] not in current:
+            current.append(conversation['segment'])
+        for prompt_i, exam_prompt in conversation['prompts']:
+            exam_prompts[prompt_i] = exam_prompt
+    prompt_numbers = sorted(exam_prompts)
+    num_prompts = len(prompt_numbers)
+    costs, peaks = segment_costs(list(template_conversations.values()),
+                                 [exam_prompts[i] for i in prompt_numbers], statistics, settings)
+    max_context_window = int(Query_GPT4_Exam.MAX_CONTEXT_WINDOW)
+    fits = [[peaks[start][end] <= max_context_window for end in range(num_prompts)]
+            for start in range(num_prompts)]
+
+    # Return the reset prompt numbers of a plan from the start of its last segment ending at
+    #   each prompt.
+    def resets_from(last_starts, end):
+        starts = []
+        while end >= 0:
+            starts.append(last_starts[end])
+            end = last_starts[end] - 1
+        return [prompt_numbers[start] for start in reversed(starts[:-1])]
+
+    # Return the reset prompt numbers and prompt tokens of the best plan with num_segments,
+    #   computing only the layers up to num_segments.
+    def plan_for(num_segments):
+        if not 1 <= num_segments <= num_prompts:
+            return None, None
+        # best[j]: prompt tokens of the best plan (of the current number of segments) covering
+        #   prompts 0..j; starts[s][j]: start of its last segment.
+        best = [costs[0][end] if fits[0][end] else None for end in range(num_prompts)]
+        starts = [[0] * num_prompts]
+        for _ in range(num_segments - 1):
+            layer_best = [None] * num_prompts
+            layer_starts = [None] * num_prompts
+            for end in range(num_prompts):
+                for start in range(1, end + 1):
+                    if best[start - 1] is None or not fits[start][end]:
+                        continue
+                    candidate = best[start - 1] + costs[start][end]
+                    if layer_best[end] is None or candidate < layer_best[end]:
+                        layer_best[end], layer_starts[end] = candidate, start
+            best = layer_best
+            starts.append(layer_starts)
+        if best[-1] is None:
+            return None, None
+        starts_of_plan = []
+        end = num_prompts - 1
+        for layer_starts in reversed(starts):
+            starts_of_plan.append(layer_starts[end])
+            end = layer_starts[end] - 1
+        return [prompt_numbers[start] for start in reversed(starts_of_plan[:-1])], best[-1]
+
+    # Find the plan with the fewest segments, and the fewest prompt tokens among those, ranking
+    #   the plans covering prompts 0..j by (segments, prompt tokens).
+    fewest_best = [None] * num_prompts
+    fewest_starts = [None] * num_prompts
+    for end in range(num_prompts):
+        for start in range(end + 1):
+            if not fits[start][end]:
+                continue
+            if start == 0:
+                candidate = (1, costs[0][end])
+            elif fewest_best[start - 1] is None:
+                continue
+            else:
+                candidate = (fewest_best[start - 1][0] + 1,
+                             fewest_best[start - 1][1] + costs[start][end])
+            if fewest_best[end] is None or candidate < fewest_best[end]:
+                fewest_best[end], fewest_starts[end] = candidate, start
+    fewest, fewest_prompt_tokens = None, None
+    if num_prompts and fewest_best[-1] is not None:
+        fewest = resets_from(fewest_starts, num_prompts - 1)
+        fewest_prompt_tokens = fewest_best[-1][1]
+
+    current_starts = [0] + [prompt_numbers.index(i) for i in current if i in prompt_numbers]
+    current_ends = [start - 1 for start in current_starts[1:]] + [num_prompts - 1]
+    current_prompt_tokens = sum(costs[s][e] for s, e in zip(current_starts, current_ends))
+    num_resets = len(current) if num_resets is None else num_resets
+    recommended, recommended_prompt_tokens = plan_for(num_resets + 1)
+    return {
+        'current': current,
+        'current_prompt_tokens': current_prompt_tokens,
+        'num_resets': num_resets,
+        'recommended': recommended,
+        'recommended_prompt_tokens': recommended_prompt_tokens,
+        'fewest': fewest,
+        'fewest_prompt_tokens': fewest_prompt_tokens,
+    }
+
+
+# Format a number of seconds as hours, minutes, and seconds.
+def format_seconds(seconds):
+    """Format a number of seconds as H:MM:SS."""
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+# Create the run plan report string.
+def plan_str(plan, statistics, settings, recommendations=None):
+    """Create the run plan report string."""
+    report = 'Run Plan (dry run, no requests sent):\n'
+    report += '    Conversations: ' + str(len(plan['conversations'])) + '\n'
+    report += '    Completion Statistics: '
+    if statistics['records']:
+        report += 'historical (' + str(statistics['records']) + ' metrics records)\n'
+    else:
+        report += 'defaults (no metrics records)\n'
+    report += '    Expected Requests: ' + '%.1f' % plan['requests'] + '\n'
+    report += '    Expected Prompt Tokens: ' + str(int(round(plan['prompt_tokens']))) + '\n'
+    report += ('    Expected Completion Tokens: ' + str(int(round(plan['completion_tokens'])))
+               + '\n')
+    report += '    Estimated Cost (USD): ' + '%.2f' % plan['cost'] + '\n'
+    report += ('    Estimated Wall-Clock: ' + format_seconds(plan['wall_clock_seconds'])
+               + ' (concurrency ' + str(settings['concurrency']) + '; schedule '
+               + format_seconds(plan['schedule_seconds']) + ', rate limits '
+               + format_seconds(plan['rate_limit_seconds']) + ')\n\n')
+
+    row = '{:<44} {:>9} {:>14} {:>11} {:>8} {:>9}\n'
+    report += row.format('Conversation', 'Requests', 'Prompt Tokens', 'Completion', 'Peak',
+                         'Duration')
+    for result in plan['conversations']:
+        report += row.format(os.path.basename(result['out_file_name'])[:44],
+                             '%.1f' % result['requests'],
+                             int(round(result['prompt_tokens'])),
+                             int(round(result['completion_tokens'])),
+                             result['peak_context'],
+                             format_seconds(result['seconds']))
+
+    for exam, recommendation in (recommendations or {}).items():
+        report += '\nReset Points: ' + exam + '\n'
+        report += ('    Current: ' + str(recommendation['current']) + ' ('
+                   + str(int(round(recommendation['current_prompt_tokens'])))
+                   + ' prompt tokens)\n')
+        if recommendation['recommended'] is None:
+            report += ('    Recommended (' + str(recommendation['num_resets'])
+                       + ' resets): none within the context window\n')
+        else:
+            saved = (recommendation['current_prompt_tokens']
+                     - recommendation['recommended_prompt_tokens'])
+            report += ('    Recommended (' + str(recommendation['num_resets']) + ' resets): '
+                       + str(recommendation['recommended']) + ' ('
+                       + str(int(round(recommendation['recommended_prompt_tokens'])))
+                       + ' prompt tokens, ' + str(int(round(saved))) + ' fewer)\n')
+        if recommendation['fewest'] is not None:
+            report += ('    Fewest Within Context Window: ' + str(recommendation['fewest'])
+                       + ' (' + str(int(round(recommendation['fewest_prompt_tokens'])))
+                       + ' prompt tokens)\n')
+    return report
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('settings_files', nargs='*', default=['Example_Course_settings.json'],
+                        help='Course settings json file(s) of the exams to plan '
+                             '(default: %(default)s)')
+    parser.add_argument('--metrics-files', nargs='*',
+                        default=[os.path.join(Query_GPT4_Exam.IO_DIR, DEFAULT_METRICS_FILE_NAME)],
+                        help=('Metrics file(s) of previous runs supplying completion lengths, '
+                              'follow-up rates, and latencies (default: %(default)s if present)'))
+    parser.add_argument('--concurrency', type=int,
+                        default=Query_GPT4_Exam.MAX_CONCURRENT_CONVERSATIONS,
+                        help='Maximum number of conversations run at once (default: %(default)s)')
+    parser.add_argument('--independent-questions', action='store_true',
+                        help='Plan a run asking each question from its own fresh initial prompt')
+    parser.add_argument('--question-concurrency', type=int,
+                        default=Query_GPT4_Exam.MAX_CONCURRENT_QUESTIONS,
+                        help=('Maximum questions queried at once per conversation with '
+                              '--independent-questions (default: %(default)s)'))
+    parser.add_argument('--context-policy', choices=CONTEXT_POLICIES,
+                        default=Query_GPT4_Exam.CONTEXT_POLICY,
+                        help='Context policy of the run (default: %(default)s)')
+    parser.add_argument('--shorten-context', choices=SHORTEN_CONTEXTS,
+                        default=Query_GPT4_Exam.SHORTEN_CONTEXT,
+                        help='Context of shortening requests (default: %(default)s)')
+    parser.add_argument('--follow-up-rules', nargs='*', choices=list(FOLLOW_UP_RULES),
+                        default=list(Query_GPT4_Exam.FOLLOW_UP_RULE_NAMES),
+                        help='Follow-up rules of the run (default: %(default)s)')
+    parser.add_argument('--samples', type=int, default=Query_GPT4_Exam.SAMPLES,
+                        help='Answers sampled per question (default: %(default)s)')
+    parser.add_argument('--rpm', type=int, default=Query_GPT4_Exam.RATE_LIMIT_RPM,
+                        help='Requests-per-minute budget (default: %(default)s)')
+    parser.add_argument('--tpm', type=int, default=Query_GPT4_Exam.RATE_LIMIT_TPM,
+                        help='Tokens-per-minute budget (default: %(default)s)')
+    add_question_store_arguments(parser)
+    parser.add_argument('--resets', type=int, default=None,
+                        help=('Number of resets for which to recommend reset points '
+                              '(default: the current number of each exam)'))
+    args = parser.parse_args()
+    Query_GPT4_Exam.FOLLOW_UP_RULE_NAMES = tuple(args.follow_up_rules)
+    Query_GPT4_Exam.QUESTION_STORE, Query_GPT4_Exam.QUESTION_SELECTION = \
+        question_store_from_args(args, Query_GPT4_Exam.IO_DIR)
+    plan_settings = {
+        'context_policy': args.context_policy,
+        'shorten_context': args.shorten_context,
+        'samples': args.samples,
+        'concurrency': args.concurrency,
+        'question_concurrency': args.question_concurrency,
+        'rpm': args.rpm,
+        'tpm': args.tpm,
+    }
+
+    metrics_files = [f for f in args.metrics_files if os.path.isfile(f)]
+    completion_stats = completion_statistics(load_metrics(metrics_files))
+
+    # Plan the conversations of the run, as Query_GPT4_Exam.py would run them.
+    all_conversations = []
+    for target_exam_file_name in args.settings_files:
+        all_conversations += Query_GPT4_Exam.plan_conversations(
+            target_exam_file_name, independent_questions=args.independent_questions
+        )
+    all_conversations = Query_GPT4_Exam.group_by_prefix(all_conversations)
+    run_plan = plan_run(all_conversations, completion_stats, plan_settings)
+
+    # Recommend reset points for each exam (conversations with independent questions do not
+    #   have reset points).
+    exam_conversations = collections.OrderedDict()
+    for conversation in all_conversations:
+        if not conversation['independent_questions']:
+            exam_conversations.setdefault(conversation['out_file_prefix'], []).append(conversation)
+    reset_recommendations = {
+        exam: recommend_resets(conversations, completion_stats, plan_settings,
+                               num_resets=args.resets)
+        for exam, conversations in exam_conversations.items()
+    }
+    print(plan_str(run_plan, completion_stats, plan_settings, reset_recommendations))
+    if Query_GPT4_Exam.QUESTION_STORE is not None:
+        Query_GPT4_Exam.QUESTION_STORE.close()
+
+    print('\nDone.\n')
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Post-processing of responses with compiled rule detectors.
+
+Each response to an exam question is inspected by a set of detectors built from precompiled
+patterns, one for each formatting rule given in the prompts: no numbered lists (Expert
+prompts), no markdown symbols (text exams), at least four bolded words or concepts
+(handwritten exams), and a "[Drawing Instructions]" block for questions that request a drawing
+or sketch. Only the rules enabled for a conversation's exam type and template are checked, and
+before each follow-up request its rule is checked against the latest response, so a follow-up
+is only made for a rule still violated after earlier follow-ups. Each detector records its own
+call count, hit count, and time spent.
+
+Usage:
+    python Postprocess_GPT4_Exam.py REPORT_FILE [REPORT_FILE ...]
+"""
+
+import re
+import time
+import argparse
+import threading
+from Settings_GPT4_Grad_Exam import USER_INIT_STATEMENT, LIST_REMOVE_REQUEST, \
+                                    MARKDOWN_REMOVE_REQUEST, BOLD_EMPHASIS_REQUEST, \
+                                    DRAWING_INSTRUCTIONS_REQUEST, SHORTEN_REQUEST
+from Questions_GPT4_Exam import DRAWING_PATTERN
+
+# Minimum bolded words or concepts in each answer of a handwritten exam.
+MIN_BOLD_COUNT = 4
+DRAWING_INSTRUCTIONS_MARKER = '[Drawing Instructions]'
+
+# Numbered list items at the start of a line (e.g. "1. " or "2) "), but not "Figure 1. ".
+NUMBERED_ITEM_PATTERN = re.compile(r'^[ \t]*(\d{1,2})[.)][ \t]+\S', re.MULTILINE)
+MARKDOWN_PATTERN = re.compile(
+    r'^[ \t]*#{1,6}[ \t]+\S'             # Headings
+    r'|^[ \t]*[-*+][ \t]+\S'             # Bulleted list items
+    r'|\*\*[^*\n]+\*\*|__[^_\n]+__'      # Bold text
+    r'|^[ \t]*```|`[^`\n]+`'             # Code
+    r'|^[ \t]*\|.*\|[ \t]*$'             # Tables
+    r'|\[[^\]\n]+\]\([^)\s]+\)',         # Links
+    re.MULTILINE,
+)
+BOLD_PATTERN = re.compile(r'\*\*[^*\n]+?\*\*|__[^_\n]+?__')
+DRAWING_INSTRUCTIONS_PATTERN = re.compile(
+    re.escape(DRAWING_INSTRUCTIONS_MARKER) + r'\s*\S', re.IGNORECASE
+)
+REPORT_HEADER_PATTERN = re.compile(r'^ ----- (user|assistant|system) ----- \n', re.MULTILINE)
+REPORT_SECTION_PATTERN = re.compile(r'\n\n(?:Details|Timing|Context Policy|Response Cache):\n')
+
+# Follow-up rules, in the order their follow-up requests are made. exam_types restricts a rule
+#   to exams of those types (None for all exam types).
+FOLLOW_UP_RULES = {
+    'numbered_list': {
+        'request': LIST_REMOVE_REQUEST,
+        'request_kind': 'list_remove',
+        'exam_types': None,
+    },
+    'markdown': {
+        'request': MARKDOWN_REMOVE_REQUEST,
+        'request_kind': 'markdown_remove',
+        'exam_types': ('text',),
+    },
+    'bold_count': {
+        'request': BOLD_EMPHASIS_REQUEST,
+        'request_kind': 'bold_emphasis',
+        'exam_types': ('handwritten',),
+    },
+    'drawing_instructions': {
+        'request': DRAWING_INSTRUCTIONS_REQUEST,
+        'request_kind': 'drawing_instructions',
+        'exam_types': None,
+    },
+}
+
+
+# Detect a numbered list of at least two consecutively numbered items in a response.
+def detect_numbered_list(response, question=None):
+    """Detect a numbered list of at least two consecutively numbered items in a response."""
+    numbers = [int(match.group(1)) for match in NUMBERED_ITEM_PATTERN.finditer(response)]
+    return any(next_number == number + 1 for number, next_number in zip(numbers, numbers[1:]))
+
+
+# Detect markdown symbols in a response.
+def detect_markdown(response, question=None):
+    """Detect markdown symbols (headings, bullets, bold, code, tables, links) in a response."""
+    return MARKDOWN_PATTERN.search(response) is not None
+
+
+# Detect a response with fewer than MIN_BOLD_COUNT bolded words or concepts.
+def detect_bold_count(response, question=None):
+    """Detect a response with fewer than MIN_BOLD_COUNT bolded words or concepts."""
+    return len(BOLD_PATTERN.findall(response)) < MIN_BOLD_COUNT
+
+
+# Detect a response missing drawing instructions to a question requesting a drawing.
+def detect_drawing_instructions(response, question=None):
+    """Detect a response missing drawing instructions to a question requesting a drawing."""
+    if question is None or DRAWING_PATTERN.search(question) is None:
+        return False
+    return DRAWING_INSTRUCTIONS_PATTERN.search(response) is None
+
+
+DETECTORS = {
+    'numbered_list': detect_numbered_list,
+    'markdown': detect_markdown,
+    'bold_count': detect_bold_count,
+    'drawing_instructions': detect_drawing_instructions,
+}
+
+
+# Return the names of the follow-up rules enabled for an exam type.
+def rules_for_exam(rule_names, exam_type):
+    """Return the names of the follow-up rules in rule_names that apply to exam_type, in order."""
+    return [name for name, rule in FOLLOW_UP_RULES.items()
+            if name in rule_names and (rule['exam_types'] is None
+                                       or exam_type in rule['exam_types'])]
+
+
+# Timed detector of a single rule, counting calls and hits.
+class Detector():
+    """
+    Timed detector of a single rule, counting calls and hits.
+
+    A single detector may be called by concurrent threads; counters are updated under a lock.
+    """
+
+    def __init__(self, name, detect):
+        """Wrap detect(response, question) as the detector named name."""
+        self.name = name
+        self.detect = detect
+        self.lock = threading.Lock()
+        self.counters = {'calls': 0, 'hits': 0, 'seconds': 0.0}
+
+    def __call__(self, response, question=None):
+        """Return whether the rule is violated by response (to question)."""
+        start_time = time.perf_counter()
+        hit = bool(self.detect(response, question))
+        elapsed = time.perf_counter() - start_time
+        with self.lock:
+            self.counters['calls'] += 1
+            self.counters['hits'] += int(hit)
+            self.counters['seconds'] += elapsed
+        return hit
+
+    def stats(self):
+        """Return the detector counters, with hit rate and mean microseconds per call."""
+        with self.lock:
+            stats = dict(self.counters)
+        stats['hit_rate'] = (stats['hits'] / stats['calls']) if stats['calls'] else 0.0
+        stats['mean_us'] = (1e6 * stats['seconds'] / stats['calls']) if stats['calls'] else 0.0
+        return stats
+
+
+# Set of detectors inspecting each response.
+class Post_Processor():
+    """Set of detectors inspecting each response, shared by all conversations of a run."""
+
+    def __init__(self, detectors=DETECTORS):
+        """Create a timed Detector for each detect function in detectors."""
+        self.detectors = {name: Detector(name, detect) for name, detect in detectors.items()}
+
+    def inspect(self, response, question=None):
+        """
+        Run every detector on a response (to question).
+
+        Returns: dict of detector name: whether the rule is violated.
+        """
+        return {name: detector(response, question) for name, detector in self.detectors.items()}
+
+    def violates(self, rule_name, response, question=None):
+        """Return whether a response (to question) violates a single rule."""
+        return self.detectors[rule_name](response, question)
+
+    def stats(self):
+        """Return the counters of each detector."""
+        return {name: detector.stats() for name, detector in self.detectors.items()}
+
+    def stats_str(self):
+        """Return a report string of the detector counters."""
+        stats_str = 'Post-Processing Detectors:\n'
+        row = '    {:<22} {:>7} {:>6} {:>9} {:>10}\n'
+        stats_str += row.format('Detector', 'Calls', 'Hits', 'Hit Rate', 'Mean us')
+        for name, stats in self.stats().items():
+            stats_str += row.format(name, stats['calls'], stats['hits'],
+                                    '%.3f' % stats['hit_rate'], '%.1f' % stats['mean_us'])
+        return stats_str
+
+
+# Yield (question, response) pairs of each question in a text report.
+def iter_report_answers(report_text):
+    """
+    Yield (question, response) pairs of each question in a text report.
+
+    The response is the first assistant response after each user question (before any
+    follow-up request).
+    """
+    non_questions = set(rule['request'] for rule in FOLLOW_UP_RULES.values())
+    non_questions |= {USER_INIT_STATEMENT, SHORTEN_REQUEST}
+    matches = list(REPORT_HEADER_PATTERN.finditer(report_text))
+    question = None
+    for match_i, match in enumerate(matches):
+        end = matches[match_i + 1].start() if match_i + 1 < len(matches) else len(report_text)
+        content = REPORT_SECTION_PATTERN.split(report_text[match.end():end])[0].rstrip()
+        if match.group(1) == 'user':
+            question = None if content in non_questions else content
+        elif match.group(1) == 'assistant' and question is not None:
+            yield question, content
+            question = None
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('report_files', nargs='+',
+                        help='Text report file(s) whose answers are inspected')
+    args = parser.parse_args()
+
+    post_processor = Post_Processor()
+    for report_file_name in args.report_files:
+        with open(report_file_name, 'r') as report_file_obj:
+            for question, response in iter_report_answers(report_file_obj.read()):
+                post_processor.inspect(response, question)
+    print(post_processor.stats_str())
+
+    print('\nDone.\n')
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Tracing spans and profiling hooks of the exam pipeline.
+
+Stages of the pipeline are wrapped in spans: loading exams ("load"), building and serializing
+prompts and applying the context policy ("prompt_build"), response cache lookups ("cache"), API
+requests including rate limiting and retries ("request"), processing responses
+("response_processing"), reporting ("report"), waiting for report writes to reach disk
+("report.sync"), background report flushes ("report.flush", "report.fsync"), journaling
+("journal"), interactive confirmations ("input_wait"), and each question with its follow-up
+requests ("question"). Spans are only recorded when TRACER is set (with --trace-file in
+Query_GPT4_Exam.py); otherwise span() returns a shared no-op context, so disabled spans cost a
+single function call. Recorded spans can be written as a Chrome trace (chrome://tracing or
+Perfetto) or as OpenTelemetry (OTLP/JSON) spans, and are summarized per stage.
+When PROFILER is set (with --profile), the run and each worker thread are profiled with
+cProfile, and the top hot spots of all threads are reported.
+
+Usage:
+    python Profile_GPT4_Exam.py TRACE_FILE
+"""
+
+import io
+import os
+import json
+import time
+import pstats
+import cProfile
+import argparse
+import itertools
+import threading
+import contextlib
+import collections
+
+TRACE_FORMATS = ('chrome', 'otlp')
+DEFAULT_TRACE_FORMAT = 'chrome'
+DEFAULT_PROFILE_TOP = 25
+SERVICE_NAME = 'GPT4_Biomed_Assessment'
+
+# Shared tracer and profiler (enabled in Query_GPT4_Exam.py __main__ with --trace-file and
+#   --profile).
+TRACER = None
+PROFILER = None
+
+# Shared no-op context returned by span() when tracing is disabled.
+NULL_SPAN = contextlib.nullcontext()
+
+
+# Return a context recording a span of a pipeline stage, if tracing is enabled.
+def span(name, **attributes):
+    """Return a context recording a span of a pipeline stage, or a no-op context if disabled."""
+    if TRACER is None:
+        return NULL_SPAN
+    return TRACER.span(name, attributes)
+
+
+# Return func wrapped to be profiled in the thread that calls it, if profiling is enabled.
+def profiled(func):
+    """Return func wrapped to be profiled in the thread that calls it, or func if disabled."""
+    if PROFILER is None:
+        return func
+    profiler = PROFILER
+
+    def profiled_func(*args, **kwargs):
+        return profiler.run(func, *args, **kwargs)
+    return profiled_func
+
+
+# Thread-safe recorder of nested spans.
+class Tracer():
+    """
+    Thread-safe recorder of nested spans.
+
+    Spans are timed with a monotonic clock and converted to wall-clock times for export. Each
+    thread keeps its own stack of open spans, so spans nest within their thread.
+    """
+
+    def __init__(self):
+        """Prepare an empty trace."""
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.span_ids = itertools.count(1)
+        self.trace_id = os.urandom(16).hex()
+        self.clock_offset_ns = time.time_ns() - time.perf_counter_ns()
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name, attributes=None):
+        """
+        Record a span of the enclosed block.
+
+        Yields the span's attributes dict, to which attributes may be added within the block.
+        """
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        span_id = next(self.span_ids)
+        parent_id = stack[-1] if stack else None
+        attributes = dict(attributes or {})
+        stack.append(span_id)
+        start_ns = time.perf_counter_ns()
+        try:
+            yield attributes
+        finally:
+            end_ns = time.perf_counter_ns()
+            stack.pop()
+            thread = threading.current_thread()
+            with self.lock:
+                self.spans.append({
+                    'name': name,
+                    'span_id': span_id,
+                    'parent_id': parent_id,
+                    'start_ns': start_ns + self.clock_offset_ns,
+                    'end_ns': end_ns + self.clock_offset_ns,
+                    'pid': os.getpid(),
+                    'tid': thread.ident,
+                    'thread_name': thread.name,
+                    'attributes': attributes,
+                })
+
+    def completed_spans(self):
+        """Return a copy of the completed spans, in order of completion."""
+        with self.lock:
+            return list(self.spans)
+
+    def stats(self):
+        """
+        Return the count and total, mean, and maximum duration of spans of each name.
+
+        Nested spans are included in the duration of their enclosing spans.
+        """
+        durations = collections.OrderedDict()
+        for completed_span in sorted(self.completed_spans(), key=lambda s: s['start_ns']):
+            durations.setdefault(completed_span['name'], []).append(
+                (completed_span['end_ns'] - completed_span['start_ns']) / 1e9
+            )
+        return collections.OrderedDict(
+            (name, {'count': len(seconds), 'total_seconds': sum(seconds),
+                    'mean_ms': 1000 * sum(seconds) / len(seconds), 'max_ms': 1000 * max(seconds)})
+            for name, seconds in durations.items()
+        )
+
+    def stats_str(self):
+        """Return a report string of the span durations of each stage."""
+        stats_str = 'Trace Spans:\n'
+        row = '    {:<20} {:>8} {:>12} {:>10} {:>10}\n'
+        stats_str += row.format('Span', 'Count', 'Total (s)', 'Mean ms', 'Max ms')
+        for name, stats in self.stats().items():
+            stats_str += row.format(name, stats['count'], '%.3f' % stats['total_seconds'],
+                                    '%.2f' % stats['mean_ms'], '%.2f' % stats['max_ms'])
+        return stats_str
+
+    def write(self, file_name, trace_format=DEFAULT_TRACE_FORMAT):
+        """Write the completed spans as a Chrome trace or OTLP/JSON file."""
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError('Trace format must be one of ' + str(TRACE_FORMATS)
+                             + ', not: ' + str(trace_format))
+        if trace_format == 'chrome':
+            trace = chrome_trace(self.completed_spans())
+        else:
+            trace = otlp_trace(self.completed_spans(), self.trace_id)
+        with open(file_name, 'w') as trace_file_obj:
+            json.dump(trace, trace_file_obj)
+
+
+# Convert spans to a Chrome trace (Trace Event Format) object.
+def chrome_trace(spans):
+    """Convert spans to a Chrome trace (Trace Event Format) object of complete events."""
+    events = []
+    thread_names = {}
+    for completed_span in spans:
+        thread_names[(completed_span['pid'], completed_span['tid'])] = \
+            completed_span['thread_name']
+        events.append({
+            'name': completed_span['name'],
+            'cat': completed_span['name'].split('.')[0],
+            'ph': 'X',
+            'ts': completed_span['start_ns'] / 1000,
+            'dur': (completed_span['end_ns'] - completed_span['start_ns']) / 1000,
+            'pid': completed_span['pid'],
+            'tid': completed_span['tid'],
+            'args': completed_span['attributes'],
+        })
+    for (pid, tid), thread_name in thread_names.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                       'args': {'name': thread_name}})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+# Convert a span attribute value to an OTLP/JSON AnyValue.
+def otlp_value(value):
+    """Convert a span attribute value to an OTLP/JSON AnyValue."""
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, (list, tuple)):
+        return {'arrayValue': {'values': [otlp_value(v) for v in value]}}
+    return {'stringValue': str(value)}
+
+
+# Convert spans to an OpenTelemetry (OTLP/JSON) trace object.
+def otlp_trace(spans, trace_id):
+    """Convert spans to an OpenTelemetry (OTLP/JSON) trace object, as a single trace."""
+    otlp_spans = []
+    for completed_span in spans:
+        otlp_span = {
+            'traceId': trace_id,
+            'spanId': '%016x' % completed_span['span_id'],
+            'name': completed_span['name'],
+            'kind': 1,
+            'startTimeUnixNano': str(completed_span['start_ns']),
+            'endTimeUnixNano': str(completed_span['end_ns']),
+            'attributes': [
+                {'key': key, 'value': otlp_value(value)}
+                for key, value in [('thread.id', completed_span['tid']),
+                                   ('thread.name', completed_span['thread_name']),
+                                   *completed_span['attributes'].items()]
+            ],
+        }
+        if completed_span['parent_id'] is not None:
+            otlp_span['parentSpanId'] = '%016x' % completed_span['parent_id']
+        otlp_spans.append(otlp_span)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [
+            {'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}},
+            {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}},
+        ]},
+        'scopeSpans': [{'scope': {'name': 'Query_GPT4_Exam'}, 'spans': otlp_spans}],
+    }]}
+
+
+# cProfile profiler of the run and of each worker thread.
+class Profiler():
+    """
+    cProfile profiler of the run and of each worker thread.
+
+    cProfile profiles only the thread in which it is enabled (before Python 3.12), so the main
+    thread is profiled from start() to stop(), and functions run by worker threads are profiled
+    with run(); the statistics of all threads are combined. From Python 3.12, a single profile
+    covers all threads, so run() then calls functions directly while the run is profiled.
+    """
+
+    def __init__(self):
+        """Prepare an empty profile."""
+        self.lock = threading.Lock()
+        self.main_profile = None
+        self.combined_stats = None
+
+    def add(self, profile):
+        """Add the statistics of a completed profile."""
+        with self.lock:
+            if self.combined_stats is None:
+                self.combined_stats = pstats.Stats(profile)
+            else:
+                self.combined_stats.add(profile)
+
+    def start(self):
+        """Start profiling the calling (main) thread."""
+        self.main_profile = cProfile.Profile()
+        self.main_profile.enable()
+
+    def stop(self):
+        """Stop profiling the main thread and add its statistics."""
+        if self.main_profile is not None:
+            self.main_profile.disable()
+            self.add(self.main_profile)
+            self.main_profile = None
+
+    def run(self, func, *args, **kwargs):
+        """Call func, profiling the calling thread unless it is already profiled."""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            self.add(profile)
+
+    def stats_str(self, top=DEFAULT_PROFILE_TOP, sort_key='cumulative'):
+        """Return a report string of the top hot spots of all profiled threads."""
+        with self.lock:
+            if self.combined_stats is None:
+                return 'Profile: no profiled calls.\n'
+            stats_stream = io.StringIO()
+            self.combined_stats.stream = stats_stream
+            self.combined_stats.sort_stats(sort_key).print_stats(top)
+        return 'Profile Hot Spots (by ' + sort_key + ' time):\n' + stats_stream.getvalue()
+
+
+# Summarize the spans of a Chrome trace file.
+def chrome_trace_stats(trace_file_name):
+    """Summarize the spans of a Chrome trace file as a Tracer of its complete events."""
+    with open(trace_file_name, 'r') as trace_file_obj:
+        trace = json.load(trace_file_obj)
+    tracer = Tracer()
+    for event in trace['traceEvents']:
+        if event.get('ph') == 'X':
+            tracer.spans.append({
+                'name': event['name'], 'span_id': None, 'parent_id': None,
+                'start_ns': int(event['ts'] * 1000),
+                'end_ns': int((event['ts'] + event['dur']) * 1000),
+                'pid': event['pid'], 'tid': event['tid'], 'thread_name': None,
+                'attributes': event.get('args', {}),
+            })
+    return tracer
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('trace_file', help='Chrome trace file written with --trace-file')
+    args = parser.parse_args()
+
+    print(chrome_trace_stats(args.trace_file).stats_str())
+
+    print('\nDone.\n')
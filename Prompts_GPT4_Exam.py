@@ -0,0 +1,85 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Compiled initial prompts of GPT4 exam conversations.
+
+The initial prompt of a conversation (system prompt and initialization statements) is rendered
+from the templates and statements of Settings_GPT4_Grad_Exam.py once per (template, course,
+field, exam type), and shared by every segment and exam using it, together with its token count
+and a stable prefix hash.
+"""
+
+import json
+import hashlib
+import threading
+from Settings_GPT4_Grad_Exam import USER_INIT_STATEMENT, BLANK_INSTRUCTIONS, \
+                                    EXAM_TYPE_INSTRUCTIONS
+from Context_GPT4_Exam import count_prompt_tokens
+from Conversation_GPT4_Exam import Conversation
+
+
+# Initial prompt (system prompt and initialization statements) rendered for an exam.
+class Compiled_Prompt():
+    """
+    Initial prompt (system prompt and initialization statements) rendered for an exam.
+
+    Attributes: messages (tuple of message dicts), token_count (local estimate of the prompt
+        tokens of the messages), prefix_hash (stable hash of the messages, identical for any
+        prompts sharing this prefix in any run), and conversation (the messages as a
+        Conversation).
+    """
+
+    __slots__ = ('messages', 'token_count', 'prefix_hash', 'conversation')
+
+    def __init__(self, messages):
+        """Compile the initial prompt messages."""
+        self.messages = tuple({'role': m['role'], 'content': m['content']} for m in messages)
+        self.token_count = count_prompt_tokens(self.messages)
+        self.prefix_hash = hashlib.sha256(json.dumps(
+            self.messages, sort_keys=True, ensure_ascii=False, separators=(',', ':')
+        ).encode('utf-8')).hexdigest()
+        self.conversation = Conversation.from_messages(self.messages)
+
+
+# Registry of compiled initial prompts, each rendered once per template and exam.
+class Compiled_Prompt_Registry():
+    """
+    Registry of compiled initial prompts.
+
+    Each initial prompt is rendered once per (template, course, field, exam type). A single
+    registry is shared by all conversations (and all exams) of a run.
+    """
+
+    def __init__(self):
+        """Create an empty registry."""
+        self.lock = threading.Lock()
+        self.compiled_prompts = {}
+        self.counters = {'compiled': 0, 'reused': 0}
+
+    def get(self, template_name, prompt_template, assistant_init_statement, course, field,
+            exam_type, user_init_statement=USER_INIT_STATEMENT,
+            ):
+        """Return the compiled initial prompt for a template and exam, compiling it if needed."""
+        key = (template_name, course, field, exam_type)
+        with self.lock:
+            compiled_prompt = self.compiled_prompts.get(key)
+            if compiled_prompt is not None:
+                self.counters['reused'] += 1
+                return compiled_prompt
+            exam_instructions = EXAM_TYPE_INSTRUCTIONS.get(exam_type, BLANK_INSTRUCTIONS)
+            system_prompt = prompt_template.format(course, field, exam_instructions)
+            compiled_prompt = Compiled_Prompt([
+                {'role': 'system', 'content': system_prompt.lstrip()},
+                {'role': 'user', 'content': user_init_statement},
+                {'role': 'assistant', 'content': assistant_init_statement},
+            ])
+            self.compiled_prompts[key] = compiled_prompt
+            self.counters['compiled'] += 1
+        return compiled_prompt
+
+
+# Shared registry of compiled initial prompts.
+COMPILED_PROMPTS = Compiled_Prompt_Registry()
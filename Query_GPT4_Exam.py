@@ -20,24 +20,33 @@ sciences.
 """
 
 import os
-import copy
-import openai
+import argparse
+import concurrent.futures
 import json
+import time
 import datetime
 from Settings_GPT4_Grad_Exam import PROMPT_TEMPLATE_SIMPLE, PROMPT_TEMPLATE_EXPERT, \
-                                    BLANK_INSTRUCTIONS, TEXT_INSTRUCTIONS, \
-                                    HANDWRITTEN_INSTRUCTIONS, \
-                                    USER_INIT_STATEMENT, \
                                     INIT_STATEMENT_SIMPLE, INIT_STATEMENT_EXPERT, \
-                                    LIST_REMOVE_REQUEST, SHORTEN_REQUEST
-
-# Attempt to find the API key in a file located in: ../../GPT/API_KEY.txt, else ask for API_Key.
-api_key_file = os.path.abspath(os.path.join('..', '..', 'GPT', 'API_KEY.txt'))
-if os.path.isfile(api_key_file):
-    with open(api_key_file, 'r') as api_key_file_obj:
-        openai.api_key = api_key_file_obj.read().strip()
-else:
-    openai.api_key = input('\nEnter API Key:\n')
+                                    SHORTEN_REQUEST
+from Prompts_GPT4_Exam import COMPILED_PROMPTS
+from Conversation_GPT4_Exam import Conversation
+from Context_GPT4_Exam import Context_Policy, CONTEXT_POLICIES, SHORTEN_CONTEXTS, \
+                              count_prompt_tokens, count_text_tokens, minimal_shorten_context, \
+                              shorten_max_tokens
+from Governor_GPT4_Exam import Request_Governor
+from Journal_GPT4_Exam import Conversation_Journal, journal_file_name, load_journal
+from Cache_GPT4_Exam import Response_Cache, CACHE_MODES, DEFAULT_CACHE_FILE_NAME
+from Metrics_GPT4_Exam import Metrics_Sink, DEFAULT_METRICS_FILE_NAME
+from Questions_GPT4_Exam import iter_questions, add_question_store_arguments, \
+                                question_store_from_args, selection_suffix
+from Postprocess_GPT4_Exam import Post_Processor, FOLLOW_UP_RULES, rules_for_exam
+from Consistency_GPT4_Exam import SAMPLES_SUFFIX, write_consistency_report
+from Writer_GPT4_Exam import Report_Writer, DEFAULT_FLUSH_INTERVAL
+from Client_GPT4_Exam import Chat_Client, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, \
+                             DEFAULT_READ_TIMEOUT
+import Profile_GPT4_Exam
+from Profile_GPT4_Exam import Tracer, Profiler, span, profiled, TRACE_FORMATS, \
+                              DEFAULT_TRACE_FORMAT, DEFAULT_PROFILE_TOP
 
 # Constants for the script.
 SCRIPT_VERSION = 'Query_GPT4_Exam.py v0.1.2'
@@ -50,40 +59,71 @@ PROMPT_TEMPLATES = {
     'Expert': (PROMPT_TEMPLATE_EXPERT, INIT_STATEMENT_EXPERT),
     'Expert_Short': (PROMPT_TEMPLATE_EXPERT, INIT_STATEMENT_EXPERT),
 }
-START_AT_PROMPT = 0
+MAX_CONCURRENT_CONVERSATIONS = 1
+INDEPENDENT_QUESTIONS = False
+MAX_CONCURRENT_QUESTIONS = 4
+RATE_LIMIT_RPM = 200
+RATE_LIMIT_TPM = 40000
+MAX_RETRIES = 6
+CONTEXT_POLICY = 'reset'
+CONTEXT_RESERVE_TOKENS = 1024
+SHORTEN_CONTEXT = 'full'
+STREAM_RESPONSES = False
+REPORT_JSONL = False
+FOLLOW_UP_RULE_NAMES = ('numbered_list',)
+SAMPLES = 1
+SAMPLE_TEMPERATURE = None
+REPORT_FLUSH_INTERVAL = DEFAULT_FLUSH_INTERVAL
+RESPONSE_CACHE_MODE = 'off'
+RESPONSE_CACHE_MAX_AGE_DAYS = None
+RESPONSE_CACHE_MAX_BYTES = None
+REQUEST_CONNECT_TIMEOUT = DEFAULT_CONNECT_TIMEOUT
+REQUEST_READ_TIMEOUT = DEFAULT_READ_TIMEOUT
 
 IO_DIR = os.path.abspath('.')
 
+# Shared API client; the API key is resolved and connections are opened on the first request.
+CHAT_CLIENT = Chat_Client(
+    connect_timeout=REQUEST_CONNECT_TIMEOUT,
+    read_timeout=REQUEST_READ_TIMEOUT,
+)
+
+# Shared background writer performing all report file writes.
+REPORT_WRITER = Report_Writer(flush_interval=REPORT_FLUSH_INTERVAL)
+
+# Shared governor through which all API requests are made.
+REQUEST_GOVERNOR = Request_Governor(
+    requests_per_minute=RATE_LIMIT_RPM,
+    tokens_per_minute=RATE_LIMIT_TPM,
+    max_retries=MAX_RETRIES,
+)
+
+# Shared detectors inspecting each answer for violated follow-up rules.
+POST_PROCESSOR = Post_Processor()
+
+# Optional shared cache of API responses (enabled in __main__ with --cache).
+RESPONSE_CACHE = None
+
+# Optional indexed question store, and selection of questions from it (enabled in __main__
+#   with --question-store or any question selection argument).
+QUESTION_STORE = None
+QUESTION_SELECTION = {}
 
-# Add to the list of prompt componenents with a specified role and content.
+# Optional sink of per-call metrics records (enabled in __main__ unless --metrics-file is empty).
+METRICS_SINK = None
+
+
+# Add to the conversation of prompt componenents with a specified role and content.
 def add_to_prompt(initial_prompt, role, content):
-    """Add to the list of prompt componenents with a specified role and content."""
-    ret_prompt = []
-    for item in initial_prompt:
-        ret_prompt.append(copy.deepcopy(item))
-    ret_prompt.append({'role': role, 'content': content})
-    return ret_prompt
-
-
-# Create initial prompot by adding intial 3 components.
-def prep_prompt(prompt_template,
-                assistant_init_statement,
-                user_init_statement=USER_INIT_STATEMENT,
-                ):
-    """Create initial prompot by adding intial 3 components."""
-    question_prefixes = []
-    question_prefixes = add_to_prompt(question_prefixes, 'system', prompt_template.lstrip())
-    question_prefixes = add_to_prompt(
-        question_prefixes,
-        'user',
-        user_init_statement
-    )
-    question_prefixes = add_to_prompt(
-        question_prefixes,
-        'assistant',
-        assistant_init_statement
-    )
-    return question_prefixes
+    """
+    Add to the conversation of prompt componenents with a specified role and content.
+
+    Returns a new Conversation sharing all prior components with initial_prompt
+    (a Conversation, or a list of message dicts).
+    """
+    if not isinstance(initial_prompt, Conversation):
+        initial_prompt = Conversation.from_messages(initial_prompt)
+    return initial_prompt.add(role, content)
 
 
 # Process the response from GPT4. Returns:
@@ -141,218 +181,1127 @@ def process_gpt_response(response_obj,
     return response, finish_reason, tokens_str, details, usage
 
 
-# Query GPT4 with prepared prompt, process the response, and return details.
-def query_gpt(prompt):
-    """Query GPT4 with prepared prompt, process the response, and return details."""
-    response_obj = openai.ChatCompletion.create(
+# Query GPT4 with streaming enabled, writing each token delta to stream_writer as it arrives.
+def stream_gpt_response(messages, stream_writer, start_time, call_stats=None, **kwargs):
+    """
+    Query GPT4 with streaming enabled, writing each token delta to stream_writer as it arrives.
+
+    Any additional kwargs (e.g. temperature) are passed to the API. Streamed responses do not
+    include usage, so usage is estimated locally. The whole request, including reading the
+    stream, is retried by REQUEST_GOVERNOR; any content written by a failed attempt is discarded
+    from stream_writer before retrying.
+    Returns: response_obj assembled in the same form as a non-streamed response, and timing.
+    """
+    # Request and read a complete stream, discarding the content of any earlier attempt.
+    def read_stream(messages, **kwargs):
+        stream_writer.reset()
+        content_parts = []
+        first_token_time = None
+        finish_reason = None
+        response_obj = {'object': 'chat.completion'}
+        for chunk in CHAT_CLIENT.create(messages=messages, **kwargs):
+            for key in ('id', 'created', 'model'):
+                response_obj[key] = chunk[key]
+            if not chunk['choices']:
+                continue
+            choice = chunk['choices'][0]
+            delta = choice['delta'].get('content')
+            if delta:
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+                content_parts.append(delta)
+                stream_writer.write(delta)
+            if choice.get('finish_reason'):
+                finish_reason = choice['finish_reason']
+        return response_obj, ''.join(content_parts), first_token_time, finish_reason
+
+    response_obj, content, first_token_time, finish_reason = REQUEST_GOVERNOR.call(
+        read_stream,
+        messages,
+        call_stats=call_stats,
         model=MODEL,
-        messages=prompt,
-        # temperature=float(temperature),
+        stream=True,
+        **kwargs,
     )
+    end_time = time.perf_counter()
 
-    response, finish_reason, tokens, details, usage = process_gpt_response(
-        response_obj,
-        print_completion=True,
-        print_response=False,
-        print_tokens=True,
-        print_details=True,
-    )
-    return response, finish_reason, tokens, details, usage
+    prompt_tokens = count_prompt_tokens(messages)
+    completion_tokens = count_text_tokens(content)
+    response_obj['choices'] = [{
+        'index': 0,
+        'message': {'role': 'assistant', 'content': content},
+        'finish_reason': finish_reason,
+    }]
+    response_obj['usage'] = {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+    }
+
+    timing = {}
+    if first_token_time is not None:
+        timing['time_to_first_token_seconds'] = round(first_token_time - start_time, 3)
+        if end_time > first_token_time:
+            timing['tokens_per_second'] = round(
+                completion_tokens / (end_time - first_token_time), 1
+            )
+    return response_obj, timing
+
+
+# Return the query_gpt sampling arguments for a request of the given kind.
+def sampling_arguments(request_kind):
+    """
+    Return the query_gpt sampling arguments for a request of the given kind.
+
+    Only question requests are sampled (with SAMPLES choices at SAMPLE_TEMPERATURE); follow-up
+    requests continue from the first sample with a single choice.
+    """
+    if request_kind != 'question':
+        return {}
+    return {'n': SAMPLES, 'temperature': SAMPLE_TEMPERATURE}
+
+
+# Prepare a shortening request with a minimal context instead of the full conversation.
+def minimal_shorten_request(last_prompt_set, full_prompt_set, request):
+    """
+    Prepare a shortening request with a minimal context instead of the full conversation.
+
+    The request is sent with only the system prompt and the answer to shorten (the last message
+    of last_prompt_set), and a completion budget computed from the length of the answer.
+    Returns: the conversation to send, and a shortening dict with keys: context, max_tokens,
+        full_prompt_tokens, minimal_prompt_tokens, and prompt_tokens_saved (local estimates).
+    """
+    minimal_prompt_set = minimal_shorten_context(last_prompt_set, request)
+    full_prompt_tokens = count_prompt_tokens(full_prompt_set)
+    minimal_prompt_tokens = count_prompt_tokens(minimal_prompt_set)
+    return minimal_prompt_set, {
+        'context': 'minimal',
+        'max_tokens': shorten_max_tokens(last_prompt_set.last()['content']),
+        'full_prompt_tokens': full_prompt_tokens,
+        'minimal_prompt_tokens': minimal_prompt_tokens,
+        'prompt_tokens_saved': full_prompt_tokens - minimal_prompt_tokens,
+    }
+
+
+# Query GPT4 with prepared prompt, process the response, and return details.
+def query_gpt(prompt, stream_writer=None, metrics_tags=None, cache_stats=None, n=1,
+              temperature=None, samples=None, max_tokens=None,
+              ):
+    """
+    Query GPT4 with prepared prompt, process the response, and return details.
+
+    If stream_writer is provided, the response is streamed and written to stream_writer
+    as it arrives. If metrics are enabled, a metrics record of the call is written including
+    metrics_tags (which identify the exam, template, prompt, etc.). If the response cache is
+    enabled and cache_stats is a dict, its cache hit/miss counts are incremented.
+    If n is greater than 1, n choices are requested in a single request (streaming is not
+    supported); the first is returned as the response. If temperature is provided, it is used
+    instead of the API default. If samples is a list, the content of every choice is appended.
+    If max_tokens is provided, the completion is limited to max_tokens tokens.
+    Returns: response, finish_reason, tokens, details, usage, and timing.
+    """
+    # Serialize the conversation to the message list sent to the API.
+    with span('prompt_build'):
+        prompt = prompt.to_messages()
+    start_time = time.perf_counter()
+    timing = {}
+    call_stats = {}
+    sampling_kwargs = {}
+    if n != 1:
+        sampling_kwargs['n'] = n
+        stream_writer = None
+    if temperature is not None:
+        sampling_kwargs['temperature'] = float(temperature)
+    if max_tokens is not None:
+        sampling_kwargs['max_tokens'] = int(max_tokens)
+
+    # Check the response cache (if enabled) before querying the API.
+    response_obj = None
+    if RESPONSE_CACHE is not None:
+        with span('cache'):
+            response_obj = RESPONSE_CACHE.get(MODEL, temperature, prompt, stats=cache_stats, n=n,
+                                              max_tokens=max_tokens)
+        if response_obj is not None:
+            print('Response loaded from cache...')
+
+    cache_hit = response_obj is not None
+    if not cache_hit:
+        with span('request', **(metrics_tags or {})) as request_span:
+            if stream_writer is not None:
+                response_obj, timing = stream_gpt_response(prompt, stream_writer, start_time,
+                                                           call_stats=call_stats,
+                                                           **sampling_kwargs)
+            else:
+                response_obj = REQUEST_GOVERNOR.call(
+                    CHAT_CLIENT.create,
+                    prompt,
+                    call_stats=call_stats,
+                    model=MODEL,
+                    **sampling_kwargs,
+                )
+            if request_span is not None:
+                request_span['retries'] = call_stats.get('retries', 0)
+                request_span['throttled_seconds'] = call_stats.get('throttled_seconds', 0.0)
+        if RESPONSE_CACHE is not None:
+            with span('cache'):
+                RESPONSE_CACHE.put(MODEL, temperature, prompt, response_obj, n=n,
+                                   max_tokens=max_tokens)
+    timing['latency_seconds'] = round(time.perf_counter() - start_time, 3)
+
+    with span('response_processing'):
+        response, finish_reason, tokens, details, usage = process_gpt_response(
+            response_obj,
+            print_completion=True,
+            print_response=False,
+            print_tokens=True,
+            print_details=True,
+        )
+    if not cache_hit:
+        REQUEST_GOVERNOR.record_usage(prompt, usage)
+    if samples is not None:
+        samples += [choice['message']['content'] for choice in response_obj['choices']]
+
+    if METRICS_SINK is not None:
+        METRICS_SINK.record({
+            **(metrics_tags or {}),
+            'model': MODEL,
+            'cache_hit': cache_hit,
+            'finish_reason': finish_reason,
+            'latency_seconds': timing['latency_seconds'],
+            'time_to_first_token_seconds': timing.get('time_to_first_token_seconds'),
+            'prompt_tokens': (usage or {}).get('prompt_tokens'),
+            'completion_tokens': (usage or {}).get('completion_tokens'),
+            'total_tokens': (usage or {}).get('total_tokens'),
+            'retries': call_stats.get('retries', 0),
+            'samples': n,
+            'throttled_seconds': round(call_stats.get('throttled_seconds', 0.0), 3),
+        })
+    return response, finish_reason, tokens, details, usage, timing
 
 
 # Check if token usage is near maximum
 def check_token_usage(tokens):
     """Check if token usage is near maximum."""
     if tokens > ((int(MAX_CONTEXT_WINDOW) * 9) / 10):
-        input('Total tokens near max, continue?\n')
+        with span('input_wait'):
+            input('Total tokens near max, continue?\n')
 
 
 # Class to print and write output of the GPT4 query / response conversation to a file.
 class Query_Reporter():
-    """Class to print and write output of the GPT4 query / response conversation to a file."""
+    """
+    Class to print and write output of the GPT4 query / response conversation to a file.
+
+    Writes are performed in the background by REPORT_WRITER. If REPORT_JSONL is enabled, each
+    element of the report is also written as a JSON record to a ".jsonl" file alongside the text
+    report, with the size of the text report after that element ("report_offset"). If SAMPLES
+    is greater than 1, the samples of each question are written to a "_samples.jsonl" file.
+    """
+
+    def __init__(self, file_name, initial_dialog, resume_offset=None):
+        """
+        Open the report file and write the conversation details and initial dialog.
 
-    def __init__(self, file_name, initial_dialog):
-        """Hold place for module docstring."""
+        If resume_offset is provided, the existing report is instead truncated to
+        resume_offset bytes and continued.
+        """
         self.file_name = file_name
-        self.file_obj = open(self.file_name, 'w')
+        self.cache_stats = {'hits': 0, 'misses': 0}
+        self.jsonl_obj = None
+        self.samples_obj = None
+        if REPORT_JSONL:
+            self.jsonl_obj = self.open_jsonl('.jsonl', resume_offset)
+        if SAMPLES > 1:
+            self.samples_obj = self.open_jsonl(SAMPLES_SUFFIX, resume_offset)
+        if resume_offset is not None:
+            self.file_obj = REPORT_WRITER.open(self.file_name, mode='a', truncate=resume_offset)
+            return
+        self.file_obj = REPORT_WRITER.open(self.file_name)
         self.initialize()
         for entry in initial_dialog:
-            self.report(entry)
+            self.report(entry.to_dict())
 
     def __call__(self, dialog, do_print=True):
         """Call the report method if class object is called."""
         self.report(dialog, do_print=do_print)
 
+    def open_jsonl(self, suffix, resume_offset=None):
+        """Open a JSONL file alongside the report, truncated to resume_offset if resuming."""
+        jsonl_file_name = os.path.splitext(self.file_name)[0] + suffix
+        if resume_offset is not None:
+            return REPORT_WRITER.open(jsonl_file_name, mode='a', truncate=(
+                jsonl_resume_offset(jsonl_file_name, resume_offset)
+            ))
+        return REPORT_WRITER.open(jsonl_file_name)
+
+    def record(self, record):
+        """Write a JSON record of a report element (if enabled)."""
+        if self.jsonl_obj is not None:
+            record['report_offset'] = self.file_obj.tell()
+            self.jsonl_obj.write(json.dumps(record) + '\n')
+
     def initialize(self):
         """Initialize the file with convseration details."""
+        performed = str(datetime.datetime.now())
         init_str = 'Conversation Details:\n'
         init_str += '    Script Version: ' + SCRIPT_VERSION + '\n'
-        init_str += '    Performed: ' + str(datetime.datetime.now()) + '\n'
+        init_str += '    Performed: ' + performed + '\n'
         init_str += '    Chat URL: ' + CHAT_URL + '\n'
         init_str += '    Model: ' + MODEL + '\n'
         init_str += '    Max Context Window: ' + MAX_CONTEXT_WINDOW + '\n'
+        if RESPONSE_CACHE is not None:
+            init_str += '    Response Cache: ' + RESPONSE_CACHE.mode + ' ('
+            init_str += os.path.basename(RESPONSE_CACHE.file_name) + ')\n'
         init_str += '\n'
         self.file_obj.write(init_str)
+        self.record({
+            'type': 'details',
+            'script_version': SCRIPT_VERSION,
+            'performed': performed,
+            'chat_url': CHAT_URL,
+            'model': MODEL,
+            'max_context_window': int(MAX_CONTEXT_WINDOW),
+            'response_cache': RESPONSE_CACHE.mode if RESPONSE_CACHE is not None else None,
+        })
 
-    def report(self, dialog, do_print=True):
-        """Report a dialog element by writing to the file handle and printing to the screen."""
-        header_bar = ' ' + ('-' * 5) + ' '
-        write_str = header_bar + dialog['role'] + header_bar + '\n'
-        write_str += dialog['content'].rstrip() + '\n\n'
+    def add_context_decision(self, decision, do_print=True):
+        """Add a context policy decision to the report."""
+        write_str = 'Context Policy:\n'
+        for key in decision:
+            write_str += '    ' + key.replace('_', ' ').title() + ': ' + str(decision[key]) + '\n'
+        write_str += '\n'
         self.file_obj.write(write_str)
-        self.file_obj.flush()
+        self.record({'type': 'context_policy', 'decision': decision})
         if do_print:
             print(write_str)
 
+    def report(self, dialog, do_print=True):
+        """Report a dialog element by writing to the file handle and printing to the screen."""
+        with span('report'):
+            header_bar = ' ' + ('-' * 5) + ' '
+            write_str = header_bar + dialog['role'] + header_bar + '\n'
+            write_str += dialog['content'].rstrip() + '\n\n'
+            self.file_obj.write(write_str)
+            self.record({'type': 'message', 'role': dialog['role'],
+                         'content': dialog['content'].rstrip()})
+            if do_print:
+                print(write_str)
+
+    def stream(self, role, do_print=True):
+        """Return a Stream_Writer to report a dialog element incrementally as it arrives."""
+        return Stream_Writer(self, role, do_print=do_print)
+
+    def add_timing(self, timing):
+        """Add timing of the query to the report."""
+        write_str = 'Timing:\n'
+        for key in timing:
+            write_str += '    ' + key.replace('_', ' ').title() + ': ' + str(timing[key]) + '\n'
+        write_str += '\n'
+        self.file_obj.write(write_str)
+        self.record({'type': 'timing', 'timing': timing})
+
     def add_details(self, details, usage):
         """Add details of the query to the report."""
-        self.file_obj.write('Details:\n')
-        for key in details:
-            self.file_obj.write('    ' + key.title() + ': ' + str(details[key]) + '\n')
-        self.file_obj.write('\n')
-        self.file_obj.write('Usage:\n')
-        for key in usage:
-            self.file_obj.write('    ' + key.title() + ': ' + str(usage[key]) + '\n')
-        self.file_obj.write('\n')
-        self.file_obj.flush()
+        with span('report'):
+            write_str = 'Details:\n'
+            for key in details:
+                write_str += '    ' + key.title() + ': ' + str(details[key]) + '\n'
+            write_str += '\n'
+            write_str += 'Usage:\n'
+            for key in usage:
+                write_str += '    ' + key.title() + ': ' + str(usage[key]) + '\n'
+            write_str += '\n'
+            self.file_obj.write(write_str)
+            self.record({'type': 'usage', 'details': details, 'usage': usage})
+
+    def add_shortening(self, prompt_i, shortening):
+        """Add the context and prompt tokens saved of a minimal-context shortening request."""
+        write_str = 'Shortening:\n'
+        for key, value in shortening.items():
+            write_str += '    ' + key.replace('_', ' ').title() + ': ' + str(value) + '\n'
+        write_str += '\n'
+        self.file_obj.write(write_str)
+        self.record({'type': 'shortening', 'prompt': prompt_i, 'shortening': shortening})
+
+    def add_samples(self, prompt_i, samples):
+        """Add the samples of a question to the samples file."""
+        self.samples_obj.write(json.dumps({
+            'prompt_i': prompt_i,
+            'samples': samples,
+            'report_offset': self.file_obj.tell(),
+        }) + '\n')
+
+    def offset(self):
+        """
+        Return the current size of the report file in bytes.
+
+        Called at turn boundaries (before a turn is journaled), so the report and its JSONL files
+        are first forced to disk up to the returned offset, as a single batch.
+        """
+        with span('report.sync'):
+            REPORT_WRITER.sync([report_file for report_file
+                                in (self.file_obj, self.jsonl_obj, self.samples_obj)
+                                if report_file is not None])
+        return self.file_obj.tell()
 
     def close(self):
-        """Close the file handle."""
+        """Close the file handle, first adding response cache statistics if enabled."""
+        if RESPONSE_CACHE is not None:
+            write_str = 'Response Cache:\n'
+            write_str += '    Hits: ' + str(self.cache_stats['hits']) + '\n'
+            write_str += '    Misses: ' + str(self.cache_stats['misses']) + '\n'
+            write_str += '\n'
+            self.file_obj.write(write_str)
+            self.record({'type': 'response_cache', **self.cache_stats})
+        for jsonl_obj in (self.jsonl_obj, self.samples_obj):
+            if jsonl_obj is not None:
+                jsonl_obj.close()
         self.file_obj.close()
 
 
-# Execute Functionality
-if __name__ == '__main__':
-    # Select json file(s) containing data about the test to be examined.
-    #   mapping keys in this file must include:
-    #   course, field, exam_type, out_file_prefix, questions_file_name
-    target_exam_file_names = [
-        'Example_Course_settings.json',
-    ]
+# Return the size of a report's JSONL file up to the last record within report_offset.
+def jsonl_resume_offset(jsonl_file_name, report_offset):
+    """
+    Return the size of a report's JSONL file up to the last record within report_offset.
 
-    for target_exam_file_name in target_exam_file_names:
-        # Create paths to relevant files and directories for the script.
-        target_exam_file = os.path.abspath(os.path.join(IO_DIR, target_exam_file_name))
+    Used on resume to truncate the JSONL records to those of the truncated text report.
+    """
+    if not os.path.isfile(jsonl_file_name):
+        return 0
+    jsonl_offset = 0
+    with open(jsonl_file_name, 'rb') as jsonl_file_obj:
+        for line in jsonl_file_obj:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record['report_offset'] > report_offset:
+                break
+            jsonl_offset += len(line)
+    return jsonl_offset
+
+
+# Write a dialog element to a Query_Reporter incrementally as it is streamed.
+class Stream_Writer():
+    """
+    Write a dialog element to a Query_Reporter incrementally as it is streamed.
+
+    Leading and trailing whitespace are withheld as the response is written, so that the final
+    report is identical to reporting the complete (stripped) response with Query_Reporter.report.
+    """
+
+    def __init__(self, query_reporter, role, do_print=True):
+        """Prepare to write a dialog element with the specified role."""
+        self.query_reporter = query_reporter
+        self.role = role
+        self.do_print = do_print
+        self.start_offset = query_reporter.file_obj.tell()
+        self.started = False
+        self.pending_whitespace = ''
+
+    def reset(self):
+        """Discard any content written so far (e.g. by a failed attempt), to write it again."""
+        if self.started:
+            self.query_reporter.file_obj.truncate(self.start_offset)
+            if self.do_print:
+                print('\n[Discarded partial response; retrying.]\n')
+        self.started = False
+        self.pending_whitespace = ''
 
-        # Report beginning of test:
-        print('\nBeginning GPT4 test with file:', target_exam_file, '\n')
+    def write(self, delta):
+        """Write a delta of the dialog content."""
+        if not self.started:
+            delta = delta.lstrip()
+            if not delta:
+                return
+            header_bar = ' ' + ('-' * 5) + ' '
+            self.emit(header_bar + self.role + header_bar + '\n')
+            self.started = True
+        text = self.pending_whitespace + delta
+        stripped_text = text.rstrip()
+        self.pending_whitespace = text[len(stripped_text):]
+        self.emit(stripped_text)
 
-        # Load the exam parameters
-        with open(target_exam_file, 'r') as target_exam_file_obj:
-            exam_parameters = json.load(target_exam_file_obj)
+    def emit(self, text):
+        """Write text to the report file (and screen if enabled)."""
+        self.query_reporter.file_obj.write(text)
+        if self.do_print:
+            print(text, end='', flush=True)
 
-        # Load the exam instructions based on specified exam type
-        if exam_parameters['exam_type'] == 'handwritten':
-            exam_instructions = HANDWRITTEN_INSTRUCTIONS
-        elif exam_parameters['exam_type'] == 'text':
-            exam_instructions = TEXT_INSTRUCTIONS
+    def close(self, content):
+        """Complete the dialog element, reporting the full content if nothing was streamed."""
+        if not self.started:
+            self.query_reporter.report({'role': self.role, 'content': content},
+                                       do_print=self.do_print)
+            return
+        self.emit('\n\n')
+        self.query_reporter.record({'type': 'message', 'role': self.role,
+                                    'content': content.strip()})
+        if self.do_print:
+            print()
+
+
+# Load the exam parameters from a course settings json file.
+def load_exam_parameters(target_exam_file):
+    """Load the exam parameters from a course settings json file."""
+    with open(target_exam_file, 'r') as target_exam_file_obj:
+        exam_parameters = json.load(target_exam_file_obj)
+    return exam_parameters
+
+
+# Load the exam questions from the questions file named in the exam parameters.
+def load_exam_prompts(exam_parameters, io_dir=None):
+    """
+    Load the exam questions from the questions file named in the exam parameters.
+
+    The questions file is found in io_dir (default: IO_DIR). If the question store is enabled,
+    the file is indexed (if not already) and the questions matching QUESTION_SELECTION are
+    loaded from the store instead.
+    Returns: list of (prompt_i, exam_prompt), where prompt_i is the position of the question in
+        the questions file (so a selected subset keeps the numbers of a full run).
+    """
+    if io_dir is None:
+        io_dir = IO_DIR
+    full_questions_file_name = os.path.join(io_dir, exam_parameters['questions_file_name'])
+    if QUESTION_STORE is not None:
+        QUESTION_STORE.load_file(full_questions_file_name, exam_parameters['course'])
+        selected = QUESTION_STORE.select(source=full_questions_file_name, **QUESTION_SELECTION)
+        return [(q['position'], q['question']) for q in selected]
+    with open(full_questions_file_name, 'r') as questions_file_obj:
+        exam_prompts = list(enumerate(iter_questions(questions_file_obj), start=1))
+    return exam_prompts
+
+
+# Divide the exam prompts into conversation segments, starting a new segment (and output file)
+#   at each prompt number in reset_prompt_numbers.
+def plan_segments(exam_prompts, reset_prompt_numbers, full_out_file_name):
+    """
+    Divide the numbered exam prompts into conversation segments.
+
+    Each segment begins from the initial prompt and is written to its own output file,
+    so segments are independent of one another and may be run concurrently. If a reset prompt
+    number is not among the prompts (e.g. a selected subset), the reset is made at the next
+    prompt after it.
+    Returns: list of segment dicts with keys: out_file_name, segment (first prompt number, or 1
+        for the first segment), prompts.
+    """
+    segments = [{'out_file_name': full_out_file_name, 'segment': 1, 'prompts': []}]
+    pending_resets = sorted(reset_prompt_numbers)
+    for prompt_i, exam_prompt in exam_prompts:
+        crossed_reset = False
+        while pending_resets and pending_resets[0] <= prompt_i:
+            crossed_reset = True
+            pending_resets.pop(0)
+        if crossed_reset and segments[-1]['prompts']:
+            segments.append({
+                'out_file_name': full_out_file_name.replace('.txt',
+                                                            '_' + str(prompt_i) + '.txt'),
+                'segment': prompt_i,
+                'prompts': [],
+            })
+        segments[-1]['prompts'].append((prompt_i, exam_prompt))
+    return segments
+
+
+# Plan all (template, reset-segment) conversations for a single exam settings file.
+def plan_conversations(target_exam_file_name, independent_questions=None,
+                       reset_prompt_numbers=None, io_dir=None,
+                       ):
+    """
+    Plan all (template, reset-segment) conversations for a single exam settings file.
+
+    If independent_questions is True (default: INDEPENDENT_QUESTIONS), each question is instead
+    asked from its own fresh initial prompt, so a single conversation is planned per template
+    (without reset segments) and written to a separate "_Independent" report. If
+    reset_prompt_numbers is provided, it is used instead of the reset prompt numbers of the exam
+    settings. The settings and questions files are found in, and reports are planned in, io_dir
+    (default: IO_DIR).
+    Returns: list of conversation dicts, each of which can be passed to run_conversation.
+    """
+    if independent_questions is None:
+        independent_questions = INDEPENDENT_QUESTIONS
+    if io_dir is None:
+        io_dir = IO_DIR
+
+    # Create paths to relevant files and directories for the script.
+    target_exam_file = os.path.abspath(os.path.join(io_dir, target_exam_file_name))
+
+    # Report beginning of test:
+    print('\nBeginning GPT4 test with file:', target_exam_file, '\n')
+
+    # Load the exam parameters
+    with span('load', exam_file=os.path.basename(target_exam_file)):
+        exam_parameters = load_exam_parameters(target_exam_file)
+
+    # If reset_prompt_numbers, set variable to avoid overfilling context window
+    if independent_questions:
+        reset_prompt_numbers = []
+    elif reset_prompt_numbers is not None:
+        reset_prompt_numbers = [int(i) for i in reset_prompt_numbers]
+    elif 'reset_prompt_numbers' in exam_parameters:
+        reset_prompt_numbers = [int(i) for i in exam_parameters['reset_prompt_numbers']]
+    else:
+        reset_prompt_numbers = []
+
+    # Load the exam questions
+    with span('load', questions_file=exam_parameters['questions_file_name']):
+        exam_prompts = load_exam_prompts(exam_parameters, io_dir)
+
+    conversations = []
+    for template_name, (use_prompt_template, use_init_statement) in PROMPT_TEMPLATES.items():
+        # Load the compiled initial prompt (rendered once per template, course, field, and
+        #   exam type, and shared by all segments and exams using it).
+        compiled_prompt = COMPILED_PROMPTS.get(
+            template_name,
+            use_prompt_template,
+            use_init_statement,
+            exam_parameters['course'],
+            exam_parameters['field'],
+            exam_parameters['exam_type'],
+        )
+
+        # If expert mode, request follow-ups for answers violating the enabled rules
+        #   (list removal only if enabled for the exam).
+        if 'Expert' in template_name:
+            exam_rules = rules_for_exam(FOLLOW_UP_RULE_NAMES, exam_parameters['exam_type'])
+            follow_up_rules = [
+                name for name in exam_rules
+                if name != 'numbered_list' or exam_parameters['expert_remove_lists']
+            ]
         else:
-            exam_instructions = BLANK_INSTRUCTIONS
-
-        # Test results for each of the prompt templates:
-        for template_name, (use_prompt_template, use_init_statement) in PROMPT_TEMPLATES.items():
-            # load and format the propmpt (where applicable)
-            initial_prompt = prep_prompt(use_prompt_template, use_init_statement)
-            initial_prompt[0]['content'] = initial_prompt[0]['content'].format(
-                exam_parameters['course'], exam_parameters['field'], exam_instructions
-            )
+            follow_up_rules = []
 
-            # If reset_prompt_numbers, set variable to avoid overfilling context window
-            if 'reset_prompt_numbers' in exam_parameters:
-                reset_prompt_numbers = [int(i) for i in exam_parameters['reset_prompt_numbers']]
-            else:
-                reset_prompt_numbers = []
+        # if expert-short mode, add a follow-on request to shorten the previous answer.
+        if template_name == 'Expert_Short':
+            shorten_all_answers = True
+        else:
+            shorten_all_answers = False
 
-            # If expert mode, and enabled, propmpt to remove lists from answers where applicable.
-            if 'Expert' in template_name and exam_parameters['expert_remove_lists']:
-                modify_remove_lists = True
-            else:
-                modify_remove_lists = False
+        # Set up the output file(s)
+        out_file_name = exam_parameters['out_file_prefix'] + '_' + template_name + '.txt'
+        if independent_questions:
+            out_file_name = out_file_name.replace('.txt', '_Independent.txt')
+        if QUESTION_STORE is not None:
+            out_file_name = out_file_name.replace('.txt',
+                                                  selection_suffix(QUESTION_SELECTION) + '.txt')
+        full_out_file_name = os.path.join(io_dir, out_file_name)
+
+        for segment in plan_segments(exam_prompts, reset_prompt_numbers, full_out_file_name):
+            conversations.append({
+                'exam_file': target_exam_file,
+                'out_file_prefix': exam_parameters['out_file_prefix'],
+                'template_name': template_name,
+                'initial_prompt': compiled_prompt.conversation,
+                'prefix_hash': compiled_prompt.prefix_hash,
+                'prefix_tokens': compiled_prompt.token_count,
+                'out_file_name': segment['out_file_name'],
+                'segment': segment['segment'],
+                'prompts': segment['prompts'],
+                'last_exam_prompt': exam_prompts[-1][1],
+                'follow_up_rules': follow_up_rules,
+                'shorten_all_answers': shorten_all_answers,
+                'independent_questions': independent_questions,
+            })
+    return conversations
+
+
+# Order conversations so that those sharing an initial prompt prefix are run together.
+def group_by_prefix(conversations):
+    """
+    Order conversations so that those sharing an initial prompt prefix are run together.
+
+    Conversations are grouped by prefix hash, in order of first appearance, keeping their
+    order within each group, so requests sharing a prefix are sent close together and can
+    benefit from provider-side caching of the shared prefix.
+    """
+    group_order = {}
+    for conversation in conversations:
+        group_order.setdefault(conversation['prefix_hash'], len(group_order))
+    return sorted(conversations, key=lambda c: group_order[c['prefix_hash']])
+
+
+# Query GPT4 with an exam question and its follow-up requests, making each turn with make_turn.
+def ask_question(conversation, prompt_i, exam_prompt, make_turn):
+    """
+    Query GPT4 with an exam question and its follow-up requests, making each turn with make_turn.
+
+    make_turn(prompt_i, request, request_kind) must make the turn and return the response.
+    Returns: the final response.
+    """
+    response = make_turn(prompt_i, exam_prompt, 'question')
+
+    # Request a follow-up for each enabled rule the latest response still violates.
+    for rule_name in conversation['follow_up_rules']:
+        if POST_PROCESSOR.violates(rule_name, response, exam_prompt):
+            rule = FOLLOW_UP_RULES[rule_name]
+            response = make_turn(prompt_i, rule['request'], rule['request_kind'])
+
+    # If enabled, request shortening of the answer.
+    if conversation['shorten_all_answers']:
+        response = make_turn(prompt_i, SHORTEN_REQUEST, 'shorten')
+    return response
+
+
+# Run a single conversation segment, querying GPT4 with each prompt in order.
+def run_conversation(conversation, resume=False, context_policy_mode=CONTEXT_POLICY):
+    """
+    Run a single conversation segment, querying GPT4 with each prompt in order.
+
+    Turns within the conversation are always sequential, as each depends on the prior
+    conversation history. Every completed turn is recorded in the conversation journal.
+    If resume is True and a journal exists, journaled turns are replayed from the journal
+    (without querying GPT4) and the report is continued from the end of the last completed turn.
+    Before each request, the context policy may reset or trim the conversation history to keep
+    the request within the context window.
+    """
+    if conversation['independent_questions']:
+        run_independent_conversation(conversation, resume=resume)
+        return
+
+    template_name = conversation['template_name']
+    journal_name = journal_file_name(conversation['out_file_name'])
+
+    # Load any prior journal of this conversation if resuming.
+    prior_journal = load_journal(journal_name) if resume else None
+    if prior_journal is not None and prior_journal['complete']:
+        print('\nSkipping completed conversation: '
+              + os.path.basename(conversation['out_file_name']) + '\n')
+        return
+    if prior_journal is not None:
+        if prior_journal['initial_prompt'] != conversation['initial_prompt'].to_messages():
+            raise ValueError('Journal initial prompt does not match conversation: ' + journal_name)
+        replay_turns = list(prior_journal['turns'])
+        print('\nResuming conversation: ' + os.path.basename(conversation['out_file_name'])
+              + ' after ' + str(len(replay_turns)) + ' completed turns.\n')
+    else:
+        replay_turns = []
+
+    # Query GPT4 with all questions
+    last_prompt_set = conversation['initial_prompt']
+    if prior_journal is not None:
+        query_reporter = Query_Reporter(conversation['out_file_name'], last_prompt_set,
+                                        resume_offset=prior_journal['report_offset'])
+        journal = Conversation_Journal(journal_name,
+                                       resume_offset=prior_journal['journal_offset'])
+    else:
+        query_reporter = Query_Reporter(conversation['out_file_name'], last_prompt_set)
+        journal = Conversation_Journal(journal_name)
+        journal.start(conversation['initial_prompt'].to_messages(), query_reporter.offset())
+
+    # Manage the context window of each request
+    context_policy = Context_Policy(
+        context_policy_mode,
+        MAX_CONTEXT_WINDOW,
+        reserve_tokens=CONTEXT_RESERVE_TOKENS,
+        follow_up_requests=[r['request'] for r in FOLLOW_UP_RULES.values()] + [SHORTEN_REQUEST],
+    )
+    initial_length = len(conversation['initial_prompt'])
+
+    # Make a single request / response turn of the conversation, replaying from the journal
+    #   if the turn has already been completed.
+    def make_turn(prompt_i, request, request_kind):
+        nonlocal last_prompt_set
+        with span('prompt_build'):
+            next_prompt_set = add_to_prompt(last_prompt_set, 'user', request)
+            next_prompt_set, decision = context_policy.apply(next_prompt_set, initial_length)
+        if decision is not None and not replay_turns:
+            decision = {'prompt': prompt_i, **decision}
+            query_reporter.add_context_decision(decision)
+        if replay_turns:
+            turn = replay_turns.pop(0)
+            if turn['prompt_i'] != prompt_i or turn['messages'][0]['content'] != request:
+                raise ValueError('Journal turn does not match conversation at prompt '
+                                 + str(prompt_i) + ': ' + journal_name)
+            response = turn['messages'][1]['content']
+            context_policy.observe(turn['usage'])
+        else:
+            query_reporter({'role': 'user', 'content': request})
+            metrics_tags = {
+                'exam': conversation['out_file_prefix'],
+                'template': template_name,
+                'prefix_hash': conversation['prefix_hash'],
+                'segment': conversation['segment'],
+                'prompt_i': prompt_i,
+                'request': request_kind,
+                'follow_up_rules': conversation['follow_up_rules'],
+            }
 
-            # if expert-short mode, add a follow-on request to shorten the previous answer.
-            if template_name == 'Expert_Short':
-                shorten_all_answers = True
+            # Send shortening requests with a minimal context, if enabled.
+            send_prompt_set, shortening = next_prompt_set, None
+            request_kwargs = sampling_arguments(request_kind)
+            if request_kind == 'shorten' and SHORTEN_CONTEXT == 'minimal':
+                send_prompt_set, shortening = minimal_shorten_request(
+                    last_prompt_set, next_prompt_set, request
+                )
+                request_kwargs['max_tokens'] = shortening['max_tokens']
+
+            # Query GPT4 and process response
+            samples = []
+            if STREAM_RESPONSES:
+                stream_writer = query_reporter.stream('assistant')
+                response, finish_reason, tokens, details, usage, timing = query_gpt(
+                    send_prompt_set, stream_writer=stream_writer, metrics_tags=metrics_tags,
+                    cache_stats=query_reporter.cache_stats, samples=samples, **request_kwargs,
+                )
+                stream_writer.close(response)
             else:
-                shorten_all_answers = False
-
-            # Load the exam questions
-            full_questions_file_name = os.path.join(IO_DIR, exam_parameters['questions_file_name'])
-            with open(full_questions_file_name, 'r') as questions_file_obj:
-                exam_prompts = [(q.strip() + '\n') for q in questions_file_obj.read().split('-&-')]
-
-            # Set up the output file
-            out_file_name = exam_parameters['out_file_prefix'] + '_' + template_name + '.txt'
-            full_out_file_name = os.path.join(IO_DIR, out_file_name)
-            use_out_file_name = full_out_file_name
-
-            # Query GPT4 with all questions
-            last_prompt_set = copy.deepcopy(initial_prompt)
-            query_reporter = Query_Reporter(use_out_file_name, last_prompt_set)
-
-            for prompt_i, exam_prompt in enumerate(exam_prompts, start=1):
-                # Report skipping or beginning prompt
-                if prompt_i < START_AT_PROMPT:
-                    print('Skipping prompt', prompt_i, '...')
-                    continue
-                else:
-                    print('------ Mode:', template_name, 'Prompt:', prompt_i, '------')
-
-                # If resetting prompt, close output file and open a new one.
-                if prompt_i in reset_prompt_numbers:
-                    query_reporter.close()
-                    use_out_file_name = full_out_file_name.replace(
-                        '.txt', ('_' + str(prompt_i) + '.txt')
-                        )
-                    last_prompt_set = copy.deepcopy(initial_prompt)
-                    query_reporter = Query_Reporter(use_out_file_name, last_prompt_set)
-
-                # Prepare next prompt
-                query_reporter({'role': 'user', 'content': exam_prompt})
-                next_prompt_set = add_to_prompt(last_prompt_set, 'user', exam_prompt)
-
-                # Query GPT4 and process response
-                response, finish_reason, tokens, details, usage = query_gpt(next_prompt_set)
+                response, finish_reason, tokens, details, usage, timing = query_gpt(
+                    send_prompt_set, metrics_tags=metrics_tags,
+                    cache_stats=query_reporter.cache_stats, samples=samples, **request_kwargs,
+                )
                 query_reporter({'role': 'assistant', 'content': response})
-                query_reporter.add_details(details, usage)
-                last_prompt_set = add_to_prompt(next_prompt_set, 'assistant', response)
+            query_reporter.add_details(details, usage)
+            if shortening is not None:
+                query_reporter.add_shortening(prompt_i, shortening)
+            if STREAM_RESPONSES:
+                query_reporter.add_timing(timing)
+            if len(samples) > 1:
+                query_reporter.add_samples(prompt_i, samples)
+            journal.record_turn(
+                prompt_i,
+                [{'role': 'user', 'content': request}, {'role': 'assistant', 'content': response}],
+                details,
+                usage,
+                query_reporter.offset(),
+                timing=timing,
+                samples=samples if len(samples) > 1 else None,
+            )
 
-                # Check for token useage nearing maximum
+            # Check for token useage nearing maximum
+            context_policy.observe(usage)
+            if context_policy.mode == 'prompt':
                 check_token_usage(usage['total_tokens'])
 
-                if modify_remove_lists and '1. ' in response:
-                    next_prompt_set = add_to_prompt(last_prompt_set, 'user', LIST_REMOVE_REQUEST)
-                    query_reporter({'role': 'user', 'content': LIST_REMOVE_REQUEST})
+        last_prompt_set = add_to_prompt(next_prompt_set, 'assistant', response)
+        return response
+
+    for prompt_i, exam_prompt in conversation['prompts']:
+        # Report beginning prompt
+        print('------ Mode:', template_name, 'Prompt:', prompt_i, '------')
+
+        # Prepare next prompt, query GPT4, and process response
+        with span('question', template=template_name, prompt_i=prompt_i):
+            ask_question(conversation, prompt_i, exam_prompt, make_turn)
+
+        # manually require continue if enabled
+        if CONFIRM_CONTINUE and exam_prompt != conversation['last_exam_prompt']:
+            with span('input_wait'):
+                input('\nContinue?\n')
+
+    # At completion of this conversation, close the output file and journal
+    query_reporter.close()
+    journal.complete()
+    journal.close()
+
+    # Report completion of this section:
+    print('\nCompleted assessment with ' + template_name + ' prompt template: '
+          + os.path.basename(conversation['out_file_name']) + '\n')
+
+
+# Run a conversation in which every question is asked from its own fresh initial prompt.
+def run_independent_conversation(conversation, resume=False,
+                                 max_concurrent_questions=None,
+                                 ):
+    """
+    Run a conversation in which every question is asked from its own fresh initial prompt.
+
+    As questions do not depend on each other, up to max_concurrent_questions questions are
+    queried at once (MAX_CONCURRENT_QUESTIONS if None, as set when the conversation is run);
+    the turns of each question (the question and its follow-up requests) remain
+    sequential. Completed questions are written to the report and journal strictly in question
+    order, so the report does not depend on the order in which responses arrive. Responses are
+    not streamed in this mode.
+    """
+    template_name = conversation['template_name']
+    journal_name = journal_file_name(conversation['out_file_name'])
+    initial_prompt = conversation['initial_prompt']
+
+    # Load any prior journal of this conversation if resuming.
+    prior_journal = load_journal(journal_name) if resume else None
+    if prior_journal is not None and prior_journal['complete']:
+        print('\nSkipping completed conversation: '
+              + os.path.basename(conversation['out_file_name']) + '\n')
+        return
+    replay_questions = {}
+    if prior_journal is not None:
+        if prior_journal['initial_prompt'] != initial_prompt.to_messages():
+            raise ValueError('Journal initial prompt does not match conversation: ' + journal_name)
+        for turn in prior_journal['turns']:
+            replay_questions.setdefault(turn['prompt_i'], []).append(turn)
+        print('\nResuming conversation: ' + os.path.basename(conversation['out_file_name'])
+              + ' after ' + str(len(replay_questions)) + ' completed questions.\n')
+        query_reporter = Query_Reporter(conversation['out_file_name'], initial_prompt,
+                                        resume_offset=prior_journal['report_offset'])
+        journal = Conversation_Journal(journal_name,
+                                       resume_offset=prior_journal['journal_offset'])
+    else:
+        query_reporter = Query_Reporter(conversation['out_file_name'], initial_prompt)
+        journal = Conversation_Journal(journal_name)
+        journal.start(initial_prompt.to_messages(), query_reporter.offset())
+
+    # Query GPT4 with a single question and its follow-up requests from the initial prompt.
+    def run_question(prompt_i, exam_prompt):
+        turns = []
+        last_prompt_set = initial_prompt
+
+        def make_turn(prompt_i, request, request_kind):
+            nonlocal last_prompt_set
+            with span('prompt_build'):
+                next_prompt_set = add_to_prompt(last_prompt_set, 'user', request)
+            metrics_tags = {
+                'exam': conversation['out_file_prefix'],
+                'template': template_name,
+                'prefix_hash': conversation['prefix_hash'],
+                'segment': conversation['segment'],
+                'prompt_i': prompt_i,
+                'request': request_kind,
+                'follow_up_rules': conversation['follow_up_rules'],
+            }
+            send_prompt_set, shortening = next_prompt_set, None
+            request_kwargs = sampling_arguments(request_kind)
+            if request_kind == 'shorten' and SHORTEN_CONTEXT == 'minimal':
+                send_prompt_set, shortening = minimal_shorten_request(
+                    last_prompt_set, next_prompt_set, request
+                )
+                request_kwargs['max_tokens'] = shortening['max_tokens']
+            samples = []
+            response, finish_reason, tokens, details, usage, timing = query_gpt(
+                send_prompt_set, metrics_tags=metrics_tags,
+                cache_stats=query_reporter.cache_stats, samples=samples, **request_kwargs,
+            )
+            turns.append({'request': request, 'response': response, 'details': details,
+                          'usage': usage, 'timing': timing, 'shortening': shortening,
+                          'samples': samples if len(samples) > 1 else None})
+            last_prompt_set = add_to_prompt(next_prompt_set, 'assistant', response)
+            return response
+
+        with span('question', template=template_name, prompt_i=prompt_i):
+            ask_question(conversation, prompt_i, exam_prompt, make_turn)
+        return turns
+
+    if max_concurrent_questions is None:
+        max_concurrent_questions = MAX_CONCURRENT_QUESTIONS
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_questions) as executor:
+        futures = {}
+        for prompt_i, exam_prompt in conversation['prompts']:
+            if prompt_i not in replay_questions:
+                futures[prompt_i] = executor.submit(profiled(run_question), prompt_i,
+                                                    exam_prompt)
+
+        # Commit completed questions to the report and journal in question order.
+        for prompt_i, exam_prompt in conversation['prompts']:
+            if prompt_i in replay_questions:
+                continue
+            print('------ Mode:', template_name, 'Independent Prompt:', prompt_i, '------')
+            turns = futures.pop(prompt_i).result()
+            for turn in turns:
+                query_reporter({'role': 'user', 'content': turn['request']})
+                query_reporter({'role': 'assistant', 'content': turn['response']})
+                query_reporter.add_details(turn['details'], turn['usage'])
+                if turn['shortening'] is not None:
+                    query_reporter.add_shortening(prompt_i, turn['shortening'])
+                if turn['samples'] is not None:
+                    query_reporter.add_samples(prompt_i, turn['samples'])
+            report_offset = query_reporter.offset()
+            # Every turn of the question is journaled with the report offset after the whole
+            #   question, so a partially journaled question is still complete on resume.
+            for turn in turns:
+                journal.record_turn(
+                    prompt_i,
+                    [{'role': 'user', 'content': turn['request']},
+                     {'role': 'assistant', 'content': turn['response']}],
+                    turn['details'],
+                    turn['usage'],
+                    report_offset,
+                    timing=turn['timing'],
+                    samples=turn['samples'],
+                )
+
+    # At completion of this conversation, close the output file and journal
+    query_reporter.close()
+    journal.complete()
+    journal.close()
+
+    # Report completion of this section:
+    print('\nCompleted independent-question assessment with ' + template_name
+          + ' prompt template: ' + os.path.basename(conversation['out_file_name']) + '\n')
+
 
-                    # Repeat query of GPT4 and process response
-                    response, finish_reason, tokens, details, usage = query_gpt(next_prompt_set)
-                    query_reporter({'role': 'assistant', 'content': response})
-                    query_reporter.add_details(details, usage)
-                    last_prompt_set = add_to_prompt(next_prompt_set, 'assistant', response)
+# Run independent conversations concurrently, up to max_concurrent at a time.
+def run_conversations(conversations, max_concurrent=MAX_CONCURRENT_CONVERSATIONS, resume=False,
+                      context_policy_mode=CONTEXT_POLICY,
+                      ):
+    """
+    Run independent conversations concurrently, up to max_concurrent at a time.
 
-                    # Check for token useage nearing maximum
-                    check_token_usage(usage['total_tokens'])
+    Each conversation writes only to its own output file, so output files are identical
+    to those of a serial run. Any exception raised by a conversation is re-raised after
+    all running conversations have finished.
+    """
+    if max_concurrent <= 1:
+        for conversation in conversations:
+            run_conversation(conversation, resume=resume,
+                             context_policy_mode=context_policy_mode)
+        return
 
-                if shorten_all_answers:
-                    next_prompt_set = add_to_prompt(last_prompt_set, 'user', SHORTEN_REQUEST)
-                    query_reporter({'role': 'user', 'content': SHORTEN_REQUEST})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = [executor.submit(profiled(run_conversation), c, resume, context_policy_mode)
+                   for c in conversations]
+        concurrent.futures.wait(futures)
+    for future in futures:
+        future.result()
 
-                    # Repeat query of GPT4 and process response
-                    response, finish_reason, tokens, details, usage = query_gpt(next_prompt_set)
-                    query_reporter({'role': 'assistant', 'content': response})
-                    query_reporter.add_details(details, usage)
-                    last_prompt_set = add_to_prompt(next_prompt_set, 'assistant', response)
 
-                    # Check for token useage nearing maximum
-                    check_token_usage(usage['total_tokens'])
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('settings_files', nargs='*', default=['Example_Course_settings.json'],
+                        help=('Course settings json file(s) of the exams to run; see '
+                              'Shard_GPT4_Exam.py to run many (default: %(default)s)'))
+    parser.add_argument('--concurrency', type=int, default=MAX_CONCURRENT_CONVERSATIONS,
+                        help=('Maximum number of conversations to run at once '
+                              '(default: %(default)s)'))
+    parser.add_argument('--independent-questions', action='store_true',
+                        help=('Ask each question from its own fresh initial prompt, querying '
+                              'questions concurrently'))
+    parser.add_argument('--question-concurrency', type=int, default=MAX_CONCURRENT_QUESTIONS,
+                        help=('Maximum questions queried at once per conversation with '
+                              '--independent-questions (default: %(default)s)'))
+    parser.add_argument('--connect-timeout', type=float, default=REQUEST_CONNECT_TIMEOUT,
+                        help='Seconds to wait to connect to the API (default: %(default)s)')
+    parser.add_argument('--read-timeout', type=float, default=REQUEST_READ_TIMEOUT,
+                        help=('Seconds to wait for each read from the API before retrying '
+                              '(default: %(default)s)'))
+    add_question_store_arguments(parser)
+    parser.add_argument('--rpm', type=int, default=RATE_LIMIT_RPM,
+                        help='Requests-per-minute budget (default: %(default)s)')
+    parser.add_argument('--tpm', type=int, default=RATE_LIMIT_TPM,
+                        help='Tokens-per-minute budget (default: %(default)s)')
+    parser.add_argument('--cache', choices=CACHE_MODES, default=RESPONSE_CACHE_MODE,
+                        help=('Response cache mode; "replay" serves only cached responses '
+                              '(default: %(default)s)'))
+    parser.add_argument('--cache-file', default=os.path.join(IO_DIR, DEFAULT_CACHE_FILE_NAME),
+                        help='Response cache database file (default: %(default)s)')
+    parser.add_argument('--cache-max-age-days', type=float, default=RESPONSE_CACHE_MAX_AGE_DAYS,
+                        help=('Evict cached responses older than this many days '
+                              '(default: no limit)'))
+    parser.add_argument('--cache-max-bytes', type=int, default=RESPONSE_CACHE_MAX_BYTES,
+                        help=('Evict least-recently used cached responses beyond this many bytes '
+                              '(default: no limit)'))
+    parser.add_argument('--context-policy', choices=CONTEXT_POLICIES, default=CONTEXT_POLICY,
+                        help=('Action taken when a request would exceed the context window; '
+                              '"prompt" asks for confirmation instead (default: %(default)s)'))
+    parser.add_argument('--shorten-context', choices=SHORTEN_CONTEXTS, default=SHORTEN_CONTEXT,
+                        help=('Context of Expert_Short shortening requests; "minimal" sends only '
+                              'the system prompt and the answer, with a completion budget from '
+                              'the answer length (default: %(default)s)'))
+    parser.add_argument('--stream', action='store_true',
+                        help=('Stream responses into the report as they arrive, and report '
+                              'time-to-first-token, tokens/second, and latency per turn'))
+    parser.add_argument('--metrics-file', default=os.path.join(IO_DIR, DEFAULT_METRICS_FILE_NAME),
+                        help=('File to append per-call metrics records to, or "" to disable '
+                              '(default: %(default)s)'))
+    parser.add_argument('--report-jsonl', action='store_true',
+                        help='Also write each report as JSON records to a ".jsonl" file')
+    parser.add_argument('--flush-interval', type=float, default=REPORT_FLUSH_INTERVAL,
+                        help=('Seconds between flushes of report files, which are also forced '
+                              'to disk after each turn (default: %(default)s)'))
+    parser.add_argument('--follow-up-rules', nargs='*', choices=list(FOLLOW_UP_RULES),
+                        default=list(FOLLOW_UP_RULE_NAMES),
+                        help=('Rules for which Expert answers found in violation receive a '
+                              'follow-up request (default: %(default)s)'))
+    parser.add_argument('--samples', type=int, default=SAMPLES,
+                        help=('Answers sampled per question in a single request; with more than '
+                              'one, samples and their consistency are written next to each '
+                              'report (default: %(default)s)'))
+    parser.add_argument('--temperature', type=float, default=SAMPLE_TEMPERATURE,
+                        help='Sampling temperature of questions (default: API default)')
+    parser.add_argument('--resume', action='store_true',
+                        help=('Resume from conversation journals, skipping completed turns and '
+                              'conversations'))
+    parser.add_argument('--trace-file', default=None,
+                        help=('Record spans of each pipeline stage and write them to this file '
+                              '(default: tracing disabled)'))
+    parser.add_argument('--trace-format', choices=TRACE_FORMATS, default=DEFAULT_TRACE_FORMAT,
+                        help=('Format of --trace-file: Chrome trace or OpenTelemetry OTLP/JSON '
+                              '(default: %(default)s)'))
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the run with cProfile and report the top hot spots')
+    parser.add_argument('--profile-top', type=int, default=DEFAULT_PROFILE_TOP,
+                        help='Number of hot spots reported with --profile (default: %(default)s)')
+    args = parser.parse_args()
+    if args.trace_file:
+        Profile_GPT4_Exam.TRACER = Tracer()
+    if args.profile:
+        Profile_GPT4_Exam.PROFILER = Profiler()
+        Profile_GPT4_Exam.PROFILER.start()
+    STREAM_RESPONSES = args.stream
+    SHORTEN_CONTEXT = args.shorten_context
+    REPORT_JSONL = args.report_jsonl
+    FOLLOW_UP_RULE_NAMES = tuple(args.follow_up_rules)
+    SAMPLES = args.samples
+    SAMPLE_TEMPERATURE = args.temperature
+    REPORT_WRITER.flush_interval = args.flush_interval
+    MAX_CONCURRENT_QUESTIONS = args.question_concurrency
+    if args.metrics_file:
+        METRICS_SINK = Metrics_Sink(args.metrics_file)
+    QUESTION_STORE, QUESTION_SELECTION = question_store_from_args(args, IO_DIR)
+    CHAT_CLIENT = Chat_Client(
+        pool_size=max(DEFAULT_POOL_SIZE, args.concurrency * args.question_concurrency),
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+    )
+    REQUEST_GOVERNOR = Request_Governor(
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_retries=MAX_RETRIES,
+    )
+    if args.cache != 'off':
+        RESPONSE_CACHE = Response_Cache(
+            args.cache_file,
+            mode=args.cache,
+            max_age_days=args.cache_max_age_days,
+            max_bytes=args.cache_max_bytes,
+        )
 
-                # manually require continue if enabled
-                if CONFIRM_CONTINUE and exam_prompt != exam_prompts[-1]:
-                    input('\nContinue?\n')
+    # Select json file(s) containing data about the test to be examined.
+    #   mapping keys in this file must include:
+    #   course, field, exam_type, out_file_prefix, questions_file_name
+    target_exam_file_names = args.settings_files
 
-            # At completion of this prompt-style, close the output file
-            query_reporter.close()
+    # Plan each (exam, template, reset-segment) conversation, then run them.
+    all_conversations = []
+    for target_exam_file_name in target_exam_file_names:
+        all_conversations += plan_conversations(
+            target_exam_file_name, independent_questions=args.independent_questions
+        )
+    all_conversations = group_by_prefix(all_conversations)
+    run_conversations(all_conversations, max_concurrent=args.concurrency, resume=args.resume,
+                      context_policy_mode=args.context_policy)
 
-            # Report completion of this section:
-            print('\nCompleted assessment with ' + template_name + ' prompt template.\n')
+    # Score the consistency of sampled answers of each conversation.
+    if SAMPLES > 1:
+        for conversation in all_conversations:
+            samples_file_name = os.path.splitext(conversation['out_file_name'])[0] + SAMPLES_SUFFIX
+            print('Sample consistency written to:', write_consistency_report(samples_file_name))
+    print('\n' + REQUEST_GOVERNOR.stats_str())
+    print(POST_PROCESSOR.stats_str())
+    if RESPONSE_CACHE is not None:
+        print(RESPONSE_CACHE.stats_str())
+        RESPONSE_CACHE.close()
+    if METRICS_SINK is not None:
+        METRICS_SINK.close()
+        print('Metrics written to:', args.metrics_file)
+    CHAT_CLIENT.close()
+    REPORT_WRITER.close()
+    if QUESTION_STORE is not None:
+        QUESTION_STORE.close()
+    if Profile_GPT4_Exam.PROFILER is not None:
+        Profile_GPT4_Exam.PROFILER.stop()
+        print(Profile_GPT4_Exam.PROFILER.stats_str(top=args.profile_top))
+    if Profile_GPT4_Exam.TRACER is not None:
+        Profile_GPT4_Exam.TRACER.write(args.trace_file, trace_format=args.trace_format)
+        print(Profile_GPT4_Exam.TRACER.stats_str())
+        print('Trace written to:', args.trace_file)
 
     print('\nDone.\n')
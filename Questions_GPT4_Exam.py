@@ -0,0 +1,328 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Streaming question-file parser and indexed question store.
+
+Questions files are parsed lazily, one "-&-"-delimited question at a time, without reading
+the whole file into memory. Parsed questions can be indexed in a SQLite question store keyed on
+(course, question number, content hash) together with their page-length tag (e.g. "(1/2 page)")
+and whether they refer to a figure or request a drawing, so that pooled question banks covering
+many courses are parsed once and subsets of questions can then be selected without rereading
+the text files. A file is only reparsed when its size or modification time changes.
+
+Usage:
+    python Questions_GPT4_Exam.py index --course COURSE QUESTIONS_FILE [QUESTIONS_FILE ...]
+    python Questions_GPT4_Exam.py select [--course COURSE] [--page-length "1/2"] [--figure only]
+"""
+
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+QUESTION_DELIMITER = '-&-'
+DEFAULT_QUESTION_STORE_FILE_NAME = 'GPT4_Question_Store.sqlite'
+READ_CHUNK_SIZE = 65536
+KEYWORD_FILTERS = ('only', 'exclude')
+
+# Patterns used to index question text (keywords follow the instructions in the prompts).
+QUESTION_NUMBER_PATTERN = re.compile(r'^\s*Question\s+([^\s:]+)\s*:', re.IGNORECASE)
+PAGE_LENGTH_PATTERN = re.compile(r'\(\s*([\d/.]+)\s*pages?\s*\)', re.IGNORECASE)
+FIGURE_PATTERN = re.compile(r'\b(figure|chart|graphic|graph|panel)s?\b', re.IGNORECASE)
+DRAWING_PATTERN = re.compile(r'\b(draw|drawing|sketch)\b', re.IGNORECASE)
+
+
+# Yield questions from a "-&-"-delimited questions file object, one at a time.
+def iter_questions(file_obj, delimiter=QUESTION_DELIMITER, chunk_size=READ_CHUNK_SIZE):
+    """
+    Yield questions from a "-&-"-delimited questions file object, one at a time.
+
+    Each question is stripped of surrounding whitespace and ends with a single newline, as in
+    reports. The file is read in chunks of chunk_size characters, so only the question being
+    parsed is held in memory.
+    """
+    buffer = ''
+    for chunk in iter(lambda: file_obj.read(chunk_size), ''):
+        buffer += chunk
+        pieces = buffer.split(delimiter)
+        buffer = pieces.pop()
+        for piece in pieces:
+            yield piece.strip() + '\n'
+    yield buffer.strip() + '\n'
+
+
+# Return the content hash of a question.
+def question_hash(question):
+    """Return the content hash of a question (ignoring surrounding whitespace)."""
+    return hashlib.sha256(question.strip().encode('utf-8')).hexdigest()
+
+
+# Return the index fields of a question.
+def index_question(question):
+    """
+    Return the index fields of a question.
+
+    Returns: dict with keys: number (str or None), page_length (e.g. "1/2", or None),
+        has_figure, has_drawing.
+    """
+    number_match = QUESTION_NUMBER_PATTERN.match(question)
+    page_length_match = PAGE_LENGTH_PATTERN.search(question)
+    return {
+        'number': number_match.group(1) if number_match else None,
+        'page_length': page_length_match.group(1) if page_length_match else None,
+        'has_figure': FIGURE_PATTERN.search(question) is not None,
+        'has_drawing': DRAWING_PATTERN.search(question) is not None,
+    }
+
+
+# SQLite-backed index of questions from one or more questions files.
+class Question_Store():
+    """
+    SQLite-backed index of questions from one or more questions files.
+
+    A single store object may be shared by concurrent threads; access to the database is
+    serialized with a lock.
+    """
+
+    def __init__(self, file_name=DEFAULT_QUESTION_STORE_FILE_NAME):
+        """Open (or create) the question store database."""
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.file_name, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS sources ('
+                ' source TEXT PRIMARY KEY,'
+                ' course TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' mtime_ns INTEGER NOT NULL)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS questions ('
+                ' course TEXT NOT NULL,'
+                ' number TEXT,'
+                ' content_hash TEXT NOT NULL,'
+                ' source TEXT NOT NULL,'
+                ' position INTEGER NOT NULL,'
+                ' page_length TEXT,'
+                ' has_figure INTEGER NOT NULL,'
+                ' has_drawing INTEGER NOT NULL,'
+                ' question TEXT NOT NULL,'
+                ' PRIMARY KEY (source, position))'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS questions_key'
+                ' ON questions (course, number, content_hash)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS questions_page_length ON questions (page_length)'
+            )
+
+    def load_file(self, questions_file_name, course):
+        """
+        Index the questions of a questions file under course, unless already indexed.
+
+        The file is reparsed only if its size, modification time, or course has changed.
+        Returns: True if the file was (re)parsed, else False.
+        """
+        source = os.path.abspath(questions_file_name)
+        file_stat = os.stat(source)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT course, size, mtime_ns FROM sources WHERE source = ?', (source,)
+            ).fetchone()
+            if row == (course, file_stat.st_size, file_stat.st_mtime_ns):
+                return False
+
+            with self.connection, open(source, 'r') as questions_file_obj:
+                self.connection.execute('DELETE FROM questions WHERE source = ?', (source,))
+                rows = []
+                for position, question in enumerate(iter_questions(questions_file_obj), start=1):
+                    fields = index_question(question)
+                    rows.append((course, fields['number'], question_hash(question), source,
+                                 position, fields['page_length'], int(fields['has_figure']),
+                                 int(fields['has_drawing']), question))
+                    if len(rows) >= 1000:
+                        self.connection.executemany(
+                            'INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows
+                        )
+                        rows = []
+                self.connection.executemany(
+                    'INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows
+                )
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)',
+                    (source, course, file_stat.st_size, file_stat.st_mtime_ns)
+                )
+        return True
+
+    def select(self, course=None, source=None, page_length=None, figure=None, drawing=None,
+               numbers=None):
+        """
+        Select questions, in file order.
+
+        Each argument that is not None restricts the selection: course and source (a questions
+        file name) to questions from that course or file; page_length to questions with that
+        page-length tag (e.g. "1/2"); figure and drawing to questions that do ("only") or do
+        not ("exclude") refer to a figure or request a drawing; numbers to the listed question
+        numbers.
+        Returns: list of question dicts with keys: course, number, content_hash, source,
+            position, page_length, has_figure, has_drawing, question.
+        """
+        conditions = []
+        values = []
+        if course is not None:
+            conditions.append('course = ?')
+            values.append(course)
+        if source is not None:
+            conditions.append('source = ?')
+            values.append(os.path.abspath(source))
+        if page_length is not None:
+            conditions.append('page_length = ?')
+            values.append(page_length)
+        for column, keyword_filter in (('has_figure', figure), ('has_drawing', drawing)):
+            if keyword_filter is None:
+                continue
+            if keyword_filter not in KEYWORD_FILTERS:
+                raise ValueError('Keyword filter must be one of ' + str(KEYWORD_FILTERS)
+                                 + ', not: ' + str(keyword_filter))
+            conditions.append(column + ' = ?')
+            values.append(1 if keyword_filter == 'only' else 0)
+        if numbers is not None:
+            numbers = [str(number) for number in numbers]
+            conditions.append('number IN (' + ', '.join('?' for _ in numbers) + ')')
+            values += numbers
+
+        query = 'SELECT * FROM questions'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY source, position'
+        with self.lock:
+            cursor = self.connection.execute(query, values)
+            columns = [description[0] for description in cursor.description]
+            questions = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for question in questions:
+            question['has_figure'] = bool(question['has_figure'])
+            question['has_drawing'] = bool(question['has_drawing'])
+        return questions
+
+    def courses(self):
+        """Return the number of questions indexed for each course."""
+        with self.lock:
+            return dict(self.connection.execute(
+                'SELECT course, COUNT(*) FROM questions GROUP BY course ORDER BY course'
+            ).fetchall())
+
+    def close(self):
+        """Close the question store database."""
+        with self.lock:
+            self.connection.close()
+
+
+# Add arguments for selecting questions to an argument parser.
+def add_selection_arguments(parser):
+    """Add arguments for selecting questions to an argument parser."""
+    parser.add_argument('--page-length',
+                        help='Select only questions with this page-length tag, e.g. "1/2"')
+    parser.add_argument('--figure', choices=KEYWORD_FILTERS,
+                        help='Select only, or exclude, questions that refer to a figure')
+    parser.add_argument('--drawing', choices=KEYWORD_FILTERS,
+                        help='Select only, or exclude, questions that request a drawing')
+    parser.add_argument('--numbers', nargs='+', help='Select only these question numbers')
+
+
+# Return the question selection from parsed arguments.
+def selection_from_args(args):
+    """Return the question selection (keyword arguments of Question_Store.select) from args."""
+    return {
+        'page_length': args.page_length,
+        'figure': args.figure,
+        'drawing': args.drawing,
+        'numbers': args.numbers,
+    }
+
+
+# Add arguments for indexing questions in a question store and selecting them to a parser.
+def add_question_store_arguments(parser):
+    """Add arguments for indexing questions in a question store and selecting them."""
+    parser.add_argument('--question-store', default=None,
+                        help=('Question store database file in which to index questions files, '
+                              'required to select questions (default: '
+                              + DEFAULT_QUESTION_STORE_FILE_NAME + ' when selecting)'))
+    add_selection_arguments(parser)
+
+
+# Open the question store and return the question selection from parsed arguments.
+def question_store_from_args(args, io_dir='.'):
+    """
+    Open the question store and return the question selection from parsed arguments.
+
+    The store is opened if a store file or any question selection is given (in io_dir by
+    default). Returns: (question store, or None if not used; selection dict of the given
+    selection arguments).
+    """
+    selection = {k: v for k, v in selection_from_args(args).items() if v is not None}
+    question_store = None
+    if args.question_store or selection:
+        question_store = Question_Store(
+            args.question_store or os.path.join(io_dir, DEFAULT_QUESTION_STORE_FILE_NAME)
+        )
+    return question_store, selection
+
+
+# Return the suffix of the output file names of runs of a question selection.
+def selection_suffix(selection):
+    """
+    Return the suffix of the output file names of runs of a question selection.
+
+    Runs of different selections (and of all questions) write to different reports, journals,
+    and JSONL files. Returns: "" if no question is excluded, else "_Selection_" and a short
+    hash of the selection.
+    """
+    selection = {key: value for key, value in (selection or {}).items() if value is not None}
+    if not selection:
+        return ''
+    selection_hash = hashlib.sha256(json.dumps(selection, sort_keys=True).encode('utf-8'))
+    return '_Selection_' + selection_hash.hexdigest()[:8]
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--store', default=DEFAULT_QUESTION_STORE_FILE_NAME,
+                        help='Question store database file (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    index_parser = subparsers.add_parser('index', help='Index questions files')
+    index_parser.add_argument('--course', required=True, help='Course of the questions')
+    index_parser.add_argument('questions_files', nargs='+', help='Questions file(s) to index')
+    select_parser = subparsers.add_parser(
+        'select', help='Write selected questions in questions-file format'
+    )
+    select_parser.add_argument('--course', help='Select only questions from this course')
+    add_selection_arguments(select_parser)
+    select_parser.add_argument('--out-file', help='File to write (default: print)')
+    args = parser.parse_args()
+
+    question_store = Question_Store(args.store)
+    if args.command == 'index':
+        for questions_file_name in args.questions_files:
+            parsed = question_store.load_file(questions_file_name, args.course)
+            print(('Indexed: ' if parsed else 'Unchanged: ') + questions_file_name)
+        for course, count in question_store.courses().items():
+            print('    ' + course + ': ' + str(count) + ' questions')
+    else:
+        selected = question_store.select(course=args.course, **selection_from_args(args))
+        selected_text = ('\n' + QUESTION_DELIMITER + '\n').join(q['question'] for q in selected)
+        if args.out_file:
+            with open(args.out_file, 'w') as out_file_obj:
+                out_file_obj.write(selected_text)
+            print('Wrote ' + str(len(selected)) + ' questions to: ' + args.out_file)
+        else:
+            print(selected_text)
+    question_store.close()
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Structured result store and cross-run query index.
+
+Text reports written by Query_Reporter are imported into an indexed SQLite store with one row
+per message: the exam, course, template, question selection, segment, and prompt number of the
+question, the role, request kind, and content of the message, and the details, usage, and timing
+reported for each response. A report is only reimported when its size or modification time
+changes, so reports of many runs can be imported incrementally and then filtered and aggregated
+(e.g. the mean completion tokens by template and course) without reparsing any text.
+
+Usage:
+    python Results_GPT4_Exam.py import REPORT_FILE [REPORT_FILE ...] [--settings SETTINGS_FILE ...]
+    python Results_GPT4_Exam.py aggregate completion_tokens --by template course --role assistant
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from Query_GPT4_Exam import PROMPT_TEMPLATES
+from Settings_GPT4_Grad_Exam import USER_INIT_STATEMENT, SHORTEN_REQUEST
+from Postprocess_GPT4_Exam import FOLLOW_UP_RULES
+from Journal_GPT4_Exam import journal_file_name, load_journal
+
+DEFAULT_RESULT_STORE_FILE_NAME = 'GPT4_Results.sqlite'
+
+# Columns by which messages may be filtered and grouped, and numeric columns to aggregate.
+FILTER_COLUMNS = ('exam', 'course', 'field', 'exam_type', 'template', 'mode', 'selection',
+                  'segment', 'prompt_i', 'role', 'request_kind', 'model', 'finish_reason',
+                  'source', 'performed')
+VALUE_COLUMNS = ('prompt_tokens', 'completion_tokens', 'total_tokens', 'latency_seconds',
+                 'time_to_first_token_seconds', 'content_length')
+AGGREGATE_FUNCTIONS = ('avg', 'sum', 'min', 'max', 'count')
+
+# Patterns of report structure (as written by Query_Reporter).
+MESSAGE_HEADER_PATTERN = re.compile(r'^ ----- (system|user|assistant) ----- \n', re.MULTILINE)
+BLOCK_TITLES = ('Details', 'Usage', 'Timing', 'Context Policy', 'Shortening', 'Response Cache')
+TRAILING_BLOCK_PATTERN = re.compile(r'\n\n(?:' + '|'.join(BLOCK_TITLES) + r'):\n    ')
+BLOCK_PATTERN = re.compile(r'^([A-Z][A-Za-z -]*):\n((?:    .*(?:\n|$))*)', re.MULTILINE)
+BLOCK_ENTRY_PATTERN = re.compile(r'^    ([^:]+): (.*)$', re.MULTILINE)
+
+
+# Return the name of a report block or entry as a lowercase key.
+def key_name(name):
+    """Return the name of a report block or entry as a lowercase key (e.g. "finish_reason")."""
+    return re.sub(r'[\s-]+', '_', name.strip()).lower()
+
+
+# Convert a report entry value to an int or float where possible.
+def parse_value(value):
+    """Convert a report entry value to an int or float where possible."""
+    for value_type in (int, float):
+        try:
+            return value_type(value)
+        except ValueError:
+            pass
+    return None if value == 'None' else value
+
+
+# Parse the titled blocks (e.g. "Details:" followed by indented entries) of report text.
+def parse_blocks(text):
+    """Parse the titled blocks of report text into a dict of block key: dict of entries."""
+    blocks = {}
+    for block_match in BLOCK_PATTERN.finditer(text):
+        blocks[key_name(block_match.group(1))] = {
+            key_name(entry.group(1)): parse_value(entry.group(2))
+            for entry in BLOCK_ENTRY_PATTERN.finditer(block_match.group(2))
+        }
+    return blocks
+
+
+# Parse a text report into its conversation details, messages, and trailing blocks.
+def parse_report(report_text):
+    """
+    Parse a text report into its conversation details, messages, and trailing blocks.
+
+    Returns: (details, messages, report_blocks), where details are the conversation details
+        entries, messages is a list of dicts with keys: role, content, blocks (the blocks
+        reported after the message), and report_blocks are blocks after the final message that
+        describe the whole report (e.g. the response cache statistics).
+    """
+    header_matches = list(MESSAGE_HEADER_PATTERN.finditer(report_text))
+    head = report_text[:header_matches[0].start()] if header_matches else report_text
+    details = parse_blocks(head).get('conversation_details', {})
+    messages = []
+    report_blocks = {}
+    pending_blocks = {}
+    for match_i, match in enumerate(header_matches):
+        end = (header_matches[match_i + 1].start() if match_i + 1 < len(header_matches)
+               else len(report_text))
+        segment = report_text[match.end():end]
+        trailing_match = TRAILING_BLOCK_PATTERN.search(segment)
+        content = segment[:trailing_match.start()] if trailing_match else segment
+        blocks = parse_blocks(segment[trailing_match.start():]) if trailing_match else {}
+
+        # A context policy decision is reported before the request it applies to.
+        message_blocks = dict(pending_blocks)
+        pending_blocks = {}
+        if 'context_policy' in blocks:
+            pending_blocks['context_policy'] = blocks.pop('context_policy')
+        if 'response_cache' in blocks:
+            report_blocks['response_cache'] = blocks.pop('response_cache')
+        message_blocks.update(blocks)
+        messages.append({'role': match.group(1), 'content': content.rstrip(),
+                         'blocks': message_blocks})
+    return details, messages, report_blocks
+
+
+# Identify the exam, template, mode, selection, and segment of a report from its file name.
+def parse_report_file_name(report_file_name):
+    """
+    Identify the exam, template, mode, selection, and segment of a report from its file name.
+
+    Returns: dict with keys: exam, template, mode ("conversation", "independent", or "batch"),
+        selection (the hash of the question selection of the run, or None if all questions were
+        run), and segment (the first prompt number), or None if the file name is not a report
+        name.
+    """
+    base_name = os.path.basename(report_file_name)
+    for template_name in sorted(PROMPT_TEMPLATES, key=len, reverse=True):
+        name_match = re.match(r'^(?P<exam>.+)_' + re.escape(template_name)
+                              + r'(?P<mode>_Independent|_Batch)?'
+                              + r'(?:_Selection_(?P<selection>[0-9a-f]{8}))?'
+                              + r'(?:_(?P<segment>\d+))?\.txt$',
+                              base_name)
+        if name_match:
+            return {
+                'exam': name_match.group('exam'),
+                'template': template_name,
+                'mode': (name_match.group('mode') or '_conversation')[1:].lower(),
+                'selection': name_match.group('selection'),
+                'segment': int(name_match.group('segment') or 1),
+            }
+    return None
+
+
+# Return the request kind of a user message.
+def request_kind(content):
+    """Return the request kind of a user message ("question", "init", "shorten", or a rule's)."""
+    if content == USER_INIT_STATEMENT.rstrip():
+        return 'init'
+    if content == SHORTEN_REQUEST.rstrip():
+        return 'shorten'
+    for rule in FOLLOW_UP_RULES.values():
+        if content == rule['request'].rstrip():
+            return rule['request_kind']
+    return 'question'
+
+
+# Return the journaled prompt numbers of the questions of a report.
+def journal_prompt_numbers(report_file_name):
+    """
+    Return the journaled prompt numbers of the questions of a report.
+
+    Returns: dict of question content (with trailing whitespace removed, as in parsed reports):
+        list of prompt numbers in journal order; empty if the report has no journal.
+    """
+    prompt_numbers = {}
+    journal = load_journal(journal_file_name(report_file_name))
+    for turn in (journal or {}).get('turns', []):
+        content = turn['messages'][0]['content'].rstrip()
+        if request_kind(content) == 'question':
+            prompt_numbers.setdefault(content, []).append(turn['prompt_i'])
+    return prompt_numbers
+
+
+# Load the course parameters of each exam from course settings files.
+def load_exam_settings(settings_file_names):
+    """Load the course parameters of each exam (by out_file_prefix) from course settings files."""
+    exam_settings = {}
+    for settings_file_name in settings_file_names or []:
+        with open(settings_file_name, 'r') as settings_file_obj:
+            exam_parameters = json.load(settings_file_obj)
+        exam_settings[exam_parameters['out_file_prefix']] = exam_parameters
+    return exam_settings
+
+
+# SQLite-backed store of report messages from any number of runs.
+class Result_Store():
+    """
+    SQLite-backed store of report messages from any number of runs.
+
+    A single store object may be shared by concurrent threads; access to the database is
+    serialized with a lock.
+    """
+
+    def __init__(self, file_name=DEFAULT_RESULT_STORE_FILE_NAME):
+        """Open (or create) the result store database."""
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.file_name, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS reports ('
+                ' source TEXT PRIMARY KEY,'
+                ' size INTEGER NOT NULL,'
+                ' mtime_ns INTEGER NOT NULL,'
+                ' exam TEXT, course TEXT, field TEXT, exam_type TEXT,'
+                ' template TEXT, mode TEXT, segment INTEGER,'
+                ' script_version TEXT, performed TEXT, model TEXT, max_context_window INTEGER,'
+                ' blocks TEXT, selection TEXT)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                ' source TEXT NOT NULL,'
+                ' position INTEGER NOT NULL,'
+                ' exam TEXT, course TEXT, field TEXT, exam_type TEXT,'
+                ' template TEXT, mode TEXT, segment INTEGER, performed TEXT, model TEXT,'
+                ' prompt_i INTEGER,'
+                ' role TEXT NOT NULL,'
+                ' request_kind TEXT,'
+                ' content TEXT NOT NULL,'
+                ' content_length INTEGER NOT NULL,'
+                ' finish_reason TEXT,'
+                ' prompt_tokens INTEGER, completion_tokens INTEGER, total_tokens INTEGER,'
+                ' latency_seconds REAL, time_to_first_token_seconds REAL,'
+                ' blocks TEXT,'
+                ' selection TEXT,'
+                ' PRIMARY KEY (source, position))'
+            )
+            # Add the selection column to stores created before it existed.
+            for table_name in ('reports', 'messages'):
+                columns = [row[1] for row in self.connection.execute(
+                    'PRAGMA table_info(' + table_name + ')'
+                )]
+                if 'selection' not in columns:
+                    self.connection.execute(
+                        'ALTER TABLE ' + table_name + ' ADD COLUMN selection TEXT'
+                    )
+            for index_name, index_columns in (
+                    ('messages_course_template', 'course, template'),
+                    ('messages_template_kind', 'template, request_kind, role'),
+                    ('messages_exam_prompt', 'exam, prompt_i'),
+                    ('messages_performed', 'performed'),
+            ):
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS ' + index_name + ' ON messages (' + index_columns
+                    + ')'
+                )
+
+    def import_report(self, report_file_name, exam_settings=None):
+        """
+        Import a text report, unless already imported and unchanged.
+
+        exam_settings optionally maps each exam (out_file_prefix) to its course parameters;
+        otherwise the course of a report is its exam name.
+        Returns: True if the report was (re)imported, else False.
+        """
+        source = os.path.abspath(report_file_name)
+        file_stat = os.stat(source)
+        name_fields = parse_report_file_name(source)
+        if name_fields is None:
+            raise ValueError('Not a report file name: ' + report_file_name)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT size, mtime_ns FROM reports WHERE source = ?', (source,)
+            ).fetchone()
+            if row == (file_stat.st_size, file_stat.st_mtime_ns):
+                return False
+
+        with open(source, 'r') as report_file_obj:
+            details, messages, report_blocks = parse_report(report_file_obj.read())
+        exam_parameters = (exam_settings or {}).get(name_fields['exam'], {})
+        report_fields = {
+            **name_fields,
+            'course': exam_parameters.get('course', name_fields['exam']),
+            'field': exam_parameters.get('field'),
+            'exam_type': exam_parameters.get('exam_type'),
+            'performed': details.get('performed'),
+            'model': details.get('model'),
+        }
+
+        # Number questions by their journaled prompt numbers (a question selection keeps the
+        #   numbers of a full run, with gaps), counting on from the previous question where
+        #   there is no journal; follow-up requests and responses belong to the question before
+        #   them, and a response has the request kind of the request it answers.
+        prompt_numbers = journal_prompt_numbers(source)
+        rows = []
+        prompt_i = None
+        kind = None
+        next_prompt_i = report_fields['segment']
+        for position, message in enumerate(messages):
+            if message['role'] == 'system':
+                kind = None
+            elif message['role'] == 'user':
+                kind = request_kind(message['content'])
+                if kind == 'question':
+                    journaled_numbers = prompt_numbers.get(message['content'])
+                    prompt_i = journaled_numbers.pop(0) if journaled_numbers else next_prompt_i
+                    next_prompt_i = prompt_i + 1
+            blocks = message['blocks']
+            message_details = blocks.get('details', {})
+            usage = blocks.get('usage', {})
+            timing = blocks.get('timing', {})
+            rows.append((
+                source, position, report_fields['exam'], report_fields['course'],
+                report_fields['field'], report_fields['exam_type'], report_fields['template'],
+                report_fields['mode'], report_fields['segment'], report_fields['performed'],
+                report_fields['model'], prompt_i, message['role'], kind, message['content'],
+                len(message['content']), message_details.get('finish_reason'),
+                usage.get('prompt_tokens'), usage.get('completion_tokens'),
+                usage.get('total_tokens'), timing.get('latency_seconds'),
+                timing.get('time_to_first_token_seconds'),
+                json.dumps(blocks) if blocks else None, report_fields['selection'],
+            ))
+
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM messages WHERE source = ?', (source,))
+            self.connection.executemany(
+                'INSERT INTO messages VALUES (' + ', '.join('?' * 24) + ')', rows
+            )
+            self.connection.execute(
+                'INSERT OR REPLACE INTO reports VALUES (' + ', '.join('?' * 16) + ')',
+                (source, file_stat.st_size, file_stat.st_mtime_ns, report_fields['exam'],
+                 report_fields['course'], report_fields['field'], report_fields['exam_type'],
+                 report_fields['template'], report_fields['mode'], report_fields['segment'],
+                 details.get('script_version'), report_fields['performed'],
+                 report_fields['model'], details.get('max_context_window'),
+                 json.dumps(report_blocks) if report_blocks else None,
+                 report_fields['selection'])
+            )
+        return True
+
+    def where_clause(self, filters):
+        """
+        Build the WHERE clause and values of filters on FILTER_COLUMNS.
+
+        Each filter value may be a single value or a list of values (any of which match).
+        """
+        conditions = []
+        values = []
+        for column, value in filters.items():
+            if value is None:
+                continue
+            if column not in FILTER_COLUMNS:
+                raise ValueError('Filter column must be one of ' + str(FILTER_COLUMNS)
+                                 + ', not: ' + str(column))
+            if column == 'source':
+                value = ([os.path.abspath(v) for v in value] if isinstance(value, (list, tuple))
+                         else os.path.abspath(value))
+            if isinstance(value, (list, tuple)):
+                conditions.append(column + ' IN (' + ', '.join('?' for _ in value) + ')')
+                values += list(value)
+            else:
+                conditions.append(column + ' = ?')
+                values.append(value)
+        return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', values
+
+    def select(self, limit=None, **filters):
+        """
+        Select messages matching filters (on FILTER_COLUMNS), in report order.
+
+        Returns: list of message dicts with all message columns (blocks parsed from JSON).
+        """
+        where, values = self.where_clause(filters)
+        query = 'SELECT * FROM messages' + where + ' ORDER BY source, position'
+        if limit is not None:
+            query += ' LIMIT ' + str(int(limit))
+        with self.lock:
+            cursor = self.connection.execute(query, values)
+            columns = [description[0] for description in cursor.description]
+            messages = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for message in messages:
+            message['blocks'] = json.loads(message['blocks']) if message['blocks'] else {}
+        return messages
+
+    def aggregate(self, value='completion_tokens', function='avg', group_by=('template',),
+                  **filters):
+        """
+        Aggregate a value column over the messages matching filters, by group_by columns.
+
+        value must be one of VALUE_COLUMNS, function one of AGGREGATE_FUNCTIONS, and group_by
+        columns and filters (on FILTER_COLUMNS) select and group messages, e.g.
+        aggregate('completion_tokens', 'avg', ('template', 'course'), role='assistant').
+        Returns: list of dicts with the group_by columns, "messages" (the number of messages
+            with a value), and the aggregate (keyed function + "_" + value).
+        """
+        if value not in VALUE_COLUMNS:
+            raise ValueError('Value column must be one of ' + str(VALUE_COLUMNS)
+                             + ', not: ' + str(value))
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError('Aggregate function must be one of ' + str(AGGREGATE_FUNCTIONS)
+                             + ', not: ' + str(function))
+        group_by = list(group_by or [])
+        for column in group_by:
+            if column not in FILTER_COLUMNS:
+                raise ValueError('Group column must be one of ' + str(FILTER_COLUMNS)
+                                 + ', not: ' + str(column))
+        where, values = self.where_clause(filters)
+        where += (' AND ' if where else ' WHERE ') + value + ' IS NOT NULL'
+        aggregate_name = function + '_' + value
+        query = 'SELECT ' + ''.join(column + ', ' for column in group_by)
+        query += 'COUNT(' + value + '), ' + function.upper() + '(' + value + ') FROM messages'
+        query += where
+        if group_by:
+            query += ' GROUP BY ' + ', '.join(group_by) + ' ORDER BY ' + ', '.join(group_by)
+        with self.lock:
+            rows = self.connection.execute(query, values).fetchall()
+        return [dict(zip(group_by + ['messages', aggregate_name], row)) for row in rows]
+
+    def reports(self):
+        """Return the number of imported reports and messages."""
+        with self.lock:
+            num_reports = self.connection.execute('SELECT COUNT(*) FROM reports').fetchone()[0]
+            num_messages = self.connection.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        return num_reports, num_messages
+
+    def close(self):
+        """Close the result store database."""
+        with self.lock:
+            self.connection.close()
+
+
+# Create the string of an aggregate result table.
+def aggregate_str(results):
+    """Create the string of an aggregate result table."""
+    if not results:
+        return 'No matching messages.\n'
+    columns = list(results[0])
+    widths = [max(len(column), *(len(str(r[column])) for r in results)) for column in columns]
+    report = '  '.join(c.ljust(w) for c, w in zip(columns, widths)).rstrip() + '\n'
+    for result in results:
+        values = [('%.2f' % v) if isinstance(v, float) else str(v)
+                  for v in (result[column] for column in columns)]
+        report += '  '.join(v.ljust(w) for v, w in zip(values, widths)).rstrip() + '\n'
+    return report
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--store', default=DEFAULT_RESULT_STORE_FILE_NAME,
+                        help='Result store database file (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='Import text reports')
+    import_parser.add_argument('report_files', nargs='+', help='Text report file(s) to import')
+    import_parser.add_argument('--settings', nargs='*', default=[],
+                               help='Course settings json file(s) of the reports\' exams')
+    aggregate_parser = subparsers.add_parser('aggregate', help='Aggregate a value across runs')
+    aggregate_parser.add_argument('value', choices=VALUE_COLUMNS, help='Value to aggregate')
+    aggregate_parser.add_argument('--function', choices=AGGREGATE_FUNCTIONS, default='avg',
+                                  help='Aggregate function (default: %(default)s)')
+    aggregate_parser.add_argument('--by', nargs='*', choices=FILTER_COLUMNS,
+                                  default=['template'], help='Columns to group by')
+    for filter_column in FILTER_COLUMNS:
+        aggregate_parser.add_argument('--' + filter_column.replace('_', '-'), nargs='+',
+                                      help='Select only messages with this ' + filter_column)
+    args = parser.parse_args()
+
+    result_store = Result_Store(args.store)
+    if args.command == 'import':
+        exam_settings = load_exam_settings(args.settings)
+        for report_file_name in args.report_files:
+            if parse_report_file_name(report_file_name) is None:
+                print('Skipped (not a report): ' + report_file_name)
+                continue
+            imported = result_store.import_report(report_file_name, exam_settings)
+            print(('Imported: ' if imported else 'Unchanged: ') + report_file_name)
+        num_reports, num_messages = result_store.reports()
+        print('Result store: ' + str(num_reports) + ' reports, ' + str(num_messages)
+              + ' messages')
+    else:
+        aggregate_filters = {column: getattr(args, column) for column in FILTER_COLUMNS}
+        start_time = time.perf_counter()
+        aggregate_results = result_store.aggregate(args.value, args.function, args.by,
+                                                   **aggregate_filters)
+        elapsed_ms = 1000 * (time.perf_counter() - start_time)
+        print(aggregate_str(aggregate_results))
+        print('Query time: %.1f ms' % elapsed_ms)
+    result_store.close()
+
+    print('\nDone.\n')
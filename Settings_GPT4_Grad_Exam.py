@@ -8,6 +8,7 @@
 #                 - Add Expert_Short mode
 #                 - Add Prompt resetting
 #   Version 0.1.2 - Add paragraph with instructions regarding sources
+#                 - Add follow-up requests for post-processing rules
 
 """Settings for testing the GPT-4 model on a graduate exam."""
 
@@ -108,7 +109,29 @@ LIST_REMOVE_REQUEST = textwrap.dedent("""\
     The last answer you provided included a list. Please restate the answer as paragraphs of
     clear, concise narrative text without any numeric lists.""")
 
+# Request for removal of markdown from response (text exams)
+MARKDOWN_REMOVE_REQUEST = textwrap.dedent("""\
+    The last answer you provided included markdown symbols. Please restate the answer as
+    plaintext, without any markdown symbols.""")
+
+# Request for bolded emphasis in response (handwritten exams)
+BOLD_EMPHASIS_REQUEST = textwrap.dedent("""\
+    Please restate the last answer, emphasizing at least four of the most important words or
+    concepts in the answer using bolded text.""")
+
+# Request for drawing instructions missing from response
+DRAWING_INSTRUCTIONS_REQUEST = textwrap.dedent("""\
+    The question asked for a drawing or sketch. Please restate the last answer, followed by the
+    text "[Drawing Instructions]" and detailed instructions to draw a graphic illustrating the
+    answer.""")
+
 # Request to shorten response
 SHORTEN_REQUEST = textwrap.dedent("""\
     Please shorten the last answer to approximately sixty-five percent of the original length.
     The shortened answer should be correct, clear, and concise without any numeric lists.""")
+
+# Instructions for each exam type (any other exam type uses BLANK_INSTRUCTIONS).
+EXAM_TYPE_INSTRUCTIONS = {
+    'handwritten': HANDWRITTEN_INSTRUCTIONS,
+    'text': TEXT_INSTRUCTIONS,
+}
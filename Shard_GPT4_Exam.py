@@ -0,0 +1,479 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Sharded exam runs across processes and machines through a filesystem work queue.
+
+Course settings files (given as files, directories, or glob patterns) are split into one work
+item per (exam, template), written to the "pending" directory of a work queue. Workers claim
+items by atomically renaming them into the "claimed" directory, so any number of worker
+processes on any number of machines sharing the queue directory can run at once. Each item is
+run with Query_GPT4_Exam.py into its own output directory in the queue (with conversation
+journals, so an interrupted item resumes where it stopped when requeued), then moved to "done"
+(or "failed"). While an item is run, its worker renews its lease on the claim every
+HEARTBEAT_SECONDS by updating the claimed file's modification time; a claim whose lease has
+expired (e.g. from a stopped worker) can be returned to pending with "enqueue --requeue". Each
+worker process is given an equal share of the requests- and tokens-per-minute budgets. The merge
+step collects the reports and metrics of completed items into IO_DIR.
+
+Usage:
+    python Shard_GPT4_Exam.py run SETTINGS [SETTINGS ...] [--processes 4]
+    python Shard_GPT4_Exam.py enqueue QUEUE_DIR SETTINGS [SETTINGS ...]
+    python Shard_GPT4_Exam.py enqueue QUEUE_DIR --requeue [--lease-seconds 300]
+    python Shard_GPT4_Exam.py work QUEUE_DIR [--processes 4] [--machines 2]
+    python Shard_GPT4_Exam.py merge QUEUE_DIR
+"""
+
+import os
+import glob
+import time
+import json
+import shutil
+import socket
+import hashlib
+import argparse
+import threading
+import traceback
+import contextlib
+import concurrent.futures
+import Query_GPT4_Exam
+from Governor_GPT4_Exam import Request_Governor
+from Cache_GPT4_Exam import Response_Cache, CACHE_MODES, DEFAULT_CACHE_FILE_NAME
+from Metrics_GPT4_Exam import Metrics_Sink, DEFAULT_METRICS_FILE_NAME
+from Journal_GPT4_Exam import JOURNAL_SUFFIX
+
+QUEUE_STATES = ('pending', 'claimed', 'done', 'failed')
+DEFAULT_QUEUE_DIR_NAME = 'GPT4_Work_Queue'
+SETTINGS_FILE_PATTERN = '*_settings.json'
+MERGED_METRICS_FILE_NAME = 'GPT4_Shard_Metrics.jsonl'
+WORKER_LOG_FILE_NAME = 'worker.log'
+# Interval at which workers renew the lease on a claimed item, and the time after the last
+#   renewal at which a claim is considered abandoned.
+HEARTBEAT_SECONDS = 30.0
+DEFAULT_LEASE_SECONDS = 300.0
+
+
+# Return the course settings files given as files, directories, or glob patterns.
+def find_settings_files(paths):
+    """
+    Return the course settings files given as files, directories, or glob patterns.
+
+    Directories are searched (non-recursively) for files matching SETTINGS_FILE_PATTERN.
+    Returns: sorted list of unique absolute file names.
+    """
+    settings_files = set()
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, SETTINGS_FILE_PATTERN))
+        elif os.path.isfile(path):
+            matches = [path]
+        else:
+            matches = glob.glob(path)
+        if not matches:
+            raise FileNotFoundError('No course settings files found for: ' + path)
+        settings_files.update(os.path.abspath(match) for match in matches)
+    return sorted(settings_files)
+
+
+# Create the work queue directories (if needed) and return the path of each state directory.
+def queue_dirs(queue_dir):
+    """Create the work queue directories (if needed) and return the path of each state."""
+    dirs = {state: os.path.join(queue_dir, state) for state in QUEUE_STATES}
+    dirs['output'] = os.path.join(queue_dir, 'output')
+    for state_dir in dirs.values():
+        os.makedirs(state_dir, exist_ok=True)
+    return dirs
+
+
+# Return the identifier of the work item for an (exam, template).
+def work_item_id(settings_file, template_name):
+    """Return the identifier (and file name stem) of the work item for an (exam, template)."""
+    settings_hash = hashlib.sha256(settings_file.encode('utf-8')).hexdigest()[:8]
+    settings_name = os.path.basename(settings_file).replace('.json', '')
+    return settings_name + '__' + template_name + '__' + settings_hash
+
+
+# Add a work item for each (exam, template) to the work queue.
+def enqueue(queue_dir, settings_files, template_names=None, requeue=False,
+            lease_seconds=DEFAULT_LEASE_SECONDS,
+            ):
+    """
+    Add a work item for each (exam, template) to the work queue.
+
+    Items already in the queue (in any state) are not added again. If requeue is True, failed
+    items, and claimed items whose lease has not been renewed for lease_seconds (e.g. from a
+    stopped worker), are first returned to pending; their conversations then resume from their
+    journals. Claims still renewed by a running worker are left in place.
+    Returns: number of items added or requeued.
+    """
+    dirs = queue_dirs(queue_dir)
+    if template_names is None:
+        template_names = list(Query_GPT4_Exam.PROMPT_TEMPLATES)
+
+    count = 0
+    if requeue:
+        for state in ('claimed', 'failed'):
+            for item_file_name in sorted(os.listdir(dirs[state])):
+                item_path = os.path.join(dirs[state], item_file_name)
+                try:
+                    if state == 'claimed' and (time.time() - os.path.getmtime(item_path)
+                                               < lease_seconds):
+                        continue
+                    os.replace(item_path, os.path.join(dirs['pending'], item_file_name))
+                except FileNotFoundError:
+                    # Completed (or requeued by another process) in the meantime.
+                    continue
+                count += 1
+
+    queued = set()
+    for state in QUEUE_STATES:
+        queued.update(os.listdir(dirs[state]))
+    for settings_file in settings_files:
+        for template_name in template_names:
+            item_id = work_item_id(settings_file, template_name)
+            item_file_name = item_id + '.json'
+            if item_file_name in queued:
+                continue
+            # Write then rename, so that workers never see a partially written item.
+            temp_file_name = os.path.join(dirs['pending'], '.' + item_file_name + '.tmp')
+            with open(temp_file_name, 'w') as item_file_obj:
+                json.dump({'id': item_id, 'settings_file': settings_file,
+                           'template_name': template_name}, item_file_obj, indent=2)
+            os.replace(temp_file_name, os.path.join(dirs['pending'], item_file_name))
+            count += 1
+    return count
+
+
+# Claim the next pending work item.
+def claim_item(dirs):
+    """
+    Claim the next pending work item by renaming it into the claimed directory.
+
+    Renaming is atomic, so each item is claimed by exactly one worker. The lease on the claim
+    is started (by updating the modification time, which renaming keeps) before the item is
+    renamed, so a claim is never seen with an expired lease. The error of any earlier failed
+    run of a requeued item is discarded.
+    Returns: the work item dict, or None if no items are pending.
+    """
+    for item_file_name in sorted(os.listdir(dirs['pending'])):
+        if item_file_name.startswith('.'):
+            continue
+        pending_file_name = os.path.join(dirs['pending'], item_file_name)
+        claimed_file_name = os.path.join(dirs['claimed'], item_file_name)
+        try:
+            os.utime(pending_file_name)
+            os.rename(pending_file_name, claimed_file_name)
+        except FileNotFoundError:
+            continue
+        with open(claimed_file_name, 'r') as item_file_obj:
+            item = json.load(item_file_obj)
+        item.pop('error', None)
+        return item
+    return None
+
+
+# Renew the lease on a claimed work item every HEARTBEAT_SECONDS while the enclosed block runs.
+@contextlib.contextmanager
+def heartbeat(claimed_file_name, interval=HEARTBEAT_SECONDS):
+    """Renew the lease on a claimed work item every interval seconds while the block runs."""
+    stopped = threading.Event()
+
+    def renew():
+        while not stopped.wait(interval):
+            try:
+                os.utime(claimed_file_name)
+            except FileNotFoundError:
+                return
+
+    renew_thread = threading.Thread(target=renew, daemon=True)
+    renew_thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        renew_thread.join()
+
+
+# Run a single work item, writing its outputs to its own directory in the work queue.
+def run_item(item, dirs, worker_config, io_dir):
+    """
+    Run the conversations of a single (exam, template) work item.
+
+    Questions files are found in io_dir; outputs are written to the item's output directory.
+    """
+    out_dir = os.path.join(dirs['output'], item['id'])
+    os.makedirs(out_dir, exist_ok=True)
+
+    if worker_config['metrics']:
+        Query_GPT4_Exam.METRICS_SINK = Metrics_Sink(
+            os.path.join(out_dir, DEFAULT_METRICS_FILE_NAME), run_id=worker_config['run_id']
+        )
+    try:
+        conversations = [
+            c for c in Query_GPT4_Exam.plan_conversations(
+                item['settings_file'],
+                independent_questions=worker_config['independent_questions'],
+                io_dir=io_dir,
+            )
+            if c['template_name'] == item['template_name']
+        ]
+        for conversation in conversations:
+            conversation['out_file_name'] = os.path.join(
+                out_dir, os.path.basename(conversation['out_file_name'])
+            )
+        Query_GPT4_Exam.run_conversations(
+            conversations,
+            max_concurrent=worker_config['concurrency'],
+            resume=True,
+            context_policy_mode=worker_config['context_policy'],
+        )
+    finally:
+        if Query_GPT4_Exam.METRICS_SINK is not None:
+            Query_GPT4_Exam.METRICS_SINK.close()
+            Query_GPT4_Exam.METRICS_SINK = None
+
+
+# Claim and run work items until none are pending.
+def work(queue_dir, worker_config, worker_id=None):
+    """
+    Claim and run work items until none are pending.
+
+    worker_config is a dict with keys: rpm, tpm (this worker's share of the budgets),
+    concurrency, independent_questions, context_policy, cache, cache_file, metrics, run_id.
+    Each item's output is logged to a worker.log file in its output directory.
+    Returns: dict with counts of items done and failed.
+    """
+    dirs = queue_dirs(queue_dir)
+    worker_id = worker_id or (socket.gethostname() + '-' + str(os.getpid()))
+    Query_GPT4_Exam.REQUEST_GOVERNOR = Request_Governor(
+        requests_per_minute=worker_config['rpm'],
+        tokens_per_minute=worker_config['tpm'],
+        max_retries=Query_GPT4_Exam.MAX_RETRIES,
+    )
+    if worker_config['cache'] != 'off':
+        Query_GPT4_Exam.RESPONSE_CACHE = Response_Cache(worker_config['cache_file'],
+                                                        mode=worker_config['cache'])
+
+    counts = {'done': 0, 'failed': 0}
+    while True:
+        item = claim_item(dirs)
+        if item is None:
+            break
+        item_file_name = item['id'] + '.json'
+        log_file_name = os.path.join(dirs['output'], item['id'], WORKER_LOG_FILE_NAME)
+        os.makedirs(os.path.dirname(log_file_name), exist_ok=True)
+        error = None
+        with open(log_file_name, 'a') as log_file_obj, contextlib.redirect_stdout(log_file_obj):
+            print('Worker:', worker_id)
+            try:
+                # Questions files are found next to the settings file.
+                with heartbeat(os.path.join(dirs['claimed'], item_file_name)):
+                    run_item(item, dirs, worker_config, os.path.dirname(item['settings_file']))
+            except Exception:
+                error = traceback.format_exc()
+                print(error)
+        if error is not None:
+            item['error'] = error
+            with open(os.path.join(dirs['claimed'], item_file_name), 'w') as item_file_obj:
+                json.dump(item, item_file_obj, indent=2)
+            os.replace(os.path.join(dirs['claimed'], item_file_name),
+                       os.path.join(dirs['failed'], item_file_name))
+            print('Failed:', item['id'], '(see ' + log_file_name + ')')
+            counts['failed'] += 1
+        else:
+            os.replace(os.path.join(dirs['claimed'], item_file_name),
+                       os.path.join(dirs['done'], item_file_name))
+            print('Done:', item['id'])
+            counts['done'] += 1
+
+    if Query_GPT4_Exam.RESPONSE_CACHE is not None:
+        Query_GPT4_Exam.RESPONSE_CACHE.close()
+        Query_GPT4_Exam.RESPONSE_CACHE = None
+    return counts
+
+
+# Run work items in a pool of worker processes, sharing the rate-limit budgets between them.
+def work_processes(queue_dir, processes, worker_config, machines=1):
+    """
+    Run work items in a pool of worker processes, sharing the rate-limit budgets between them.
+
+    worker_config rpm and tpm are the total budgets, which are divided equally between the
+    processes of all machines working on the queue.
+    Returns: dict with counts of items done and failed.
+    """
+    shares = processes * machines
+    process_config = dict(worker_config)
+    process_config['rpm'] = max(1, worker_config['rpm'] // shares)
+    process_config['tpm'] = max(1, worker_config['tpm'] // shares)
+    print('Running', processes, 'worker processes, each with', process_config['rpm'],
+          'requests/minute and', process_config['tpm'], 'tokens/minute.')
+
+    counts = {'done': 0, 'failed': 0}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(work, queue_dir, process_config) for _ in range(processes)]
+        for future in concurrent.futures.as_completed(futures):
+            for key, value in future.result().items():
+                counts[key] += value
+    return counts
+
+
+# Collect the reports and metrics of completed work items into io_dir.
+def merge(queue_dir, io_dir):
+    """
+    Collect the reports and metrics of completed work items into io_dir.
+
+    Reports (text, and JSONL if enabled) are copied to io_dir, and the metrics of all items are
+    combined in MERGED_METRICS_FILE_NAME (rewritten on each merge). Raises ValueError (before
+    copying anything) if two items produced reports with the same file name.
+    Returns: dict with keys: reports (list of copied file names), metrics_records, and the
+        number of work items in each queue state.
+    """
+    dirs = queue_dirs(queue_dir)
+    done_ids = sorted(f[:-len('.json')] for f in os.listdir(dirs['done']) if f.endswith('.json'))
+
+    report_sources = {}
+    metrics_files = []
+    for item_id in done_ids:
+        out_dir = os.path.join(dirs['output'], item_id)
+        for file_name in sorted(os.listdir(out_dir)):
+            full_file_name = os.path.join(out_dir, file_name)
+            if file_name == DEFAULT_METRICS_FILE_NAME:
+                metrics_files.append(full_file_name)
+            elif file_name.endswith('.txt') or (file_name.endswith('.jsonl')
+                                                and not file_name.endswith(JOURNAL_SUFFIX)):
+                if file_name in report_sources:
+                    raise ValueError('Report ' + file_name + ' produced by both: '
+                                     + report_sources[file_name] + ' and ' + item_id)
+                report_sources[file_name] = item_id
+
+    os.makedirs(io_dir, exist_ok=True)
+    for file_name, item_id in report_sources.items():
+        shutil.copy2(os.path.join(dirs['output'], item_id, file_name),
+                     os.path.join(io_dir, file_name))
+    metrics_records = 0
+    with open(os.path.join(io_dir, MERGED_METRICS_FILE_NAME), 'w') as merged_obj:
+        for metrics_file in metrics_files:
+            with open(metrics_file, 'r') as metrics_file_obj:
+                for line in metrics_file_obj:
+                    merged_obj.write(line)
+                    metrics_records += 1
+
+    merge_stats = {'reports': sorted(report_sources), 'metrics_records': metrics_records}
+    for state in QUEUE_STATES:
+        merge_stats[state] = sum(1 for f in os.listdir(dirs[state]) if f.endswith('.json')
+                                 and not f.startswith('.'))
+    return merge_stats
+
+
+# Create the merge report string.
+def merge_str(merge_stats, io_dir):
+    """Create the merge report string."""
+    report = 'Merged Into: ' + io_dir + '\n'
+    report += '    Reports: ' + str(len(merge_stats['reports'])) + '\n'
+    report += '    Metrics Records: ' + str(merge_stats['metrics_records']) + '\n'
+    for state in QUEUE_STATES:
+        report += '    Items ' + state.title() + ': ' + str(merge_stats[state]) + '\n'
+    return report
+
+
+# Add arguments for worker configuration to an argument parser.
+def add_worker_arguments(parser):
+    """Add arguments for worker configuration to an argument parser."""
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes on this machine (default: %(default)s)')
+    parser.add_argument('--machines', type=int, default=1,
+                        help=('Machines working on the queue with the same number of processes, '
+                              'used to divide the budgets (default: %(default)s)'))
+    parser.add_argument('--rpm', type=int, default=Query_GPT4_Exam.RATE_LIMIT_RPM,
+                        help='Total requests-per-minute budget (default: %(default)s)')
+    parser.add_argument('--tpm', type=int, default=Query_GPT4_Exam.RATE_LIMIT_TPM,
+                        help='Total tokens-per-minute budget (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int,
+                        default=Query_GPT4_Exam.MAX_CONCURRENT_CONVERSATIONS,
+                        help='Conversations run at once per process (default: %(default)s)')
+    parser.add_argument('--independent-questions', action='store_true',
+                        help='Ask each question from its own fresh initial prompt')
+    parser.add_argument('--context-policy', choices=Query_GPT4_Exam.CONTEXT_POLICIES,
+                        default=Query_GPT4_Exam.CONTEXT_POLICY,
+                        help='Action taken when a request would exceed the context window')
+    parser.add_argument('--cache', choices=CACHE_MODES,
+                        default=Query_GPT4_Exam.RESPONSE_CACHE_MODE,
+                        help='Response cache mode, shared by all processes (default: %(default)s)')
+    parser.add_argument('--cache-file',
+                        default=os.path.join(Query_GPT4_Exam.IO_DIR, DEFAULT_CACHE_FILE_NAME),
+                        help='Response cache database file (default: %(default)s)')
+    parser.add_argument('--no-metrics', action='store_true', help='Do not record metrics')
+
+
+# Return the worker configuration from parsed arguments.
+def worker_config_from_args(args):
+    """Return the worker configuration from parsed arguments."""
+    return {
+        'rpm': args.rpm,
+        'tpm': args.tpm,
+        'concurrency': args.concurrency,
+        'independent_questions': args.independent_questions,
+        'context_policy': args.context_policy,
+        'cache': args.cache,
+        'cache_file': os.path.abspath(args.cache_file),
+        'metrics': not args.no_metrics,
+        'run_id': time.strftime('%Y%m%d-%H%M%S'),
+    }
+
+
+# Execute Functionality
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser(
+        'run', help='Enqueue, work, and merge on this machine'
+    )
+    run_parser.add_argument('settings', nargs='+',
+                            help='Course settings files, directories, or glob patterns')
+    run_parser.add_argument('--queue-dir',
+                            default=os.path.join(Query_GPT4_Exam.IO_DIR, DEFAULT_QUEUE_DIR_NAME),
+                            help='Work queue directory (default: %(default)s)')
+    add_worker_arguments(run_parser)
+
+    enqueue_parser = subparsers.add_parser('enqueue', help='Add work items to a work queue')
+    enqueue_parser.add_argument('queue_dir', help='Work queue directory')
+    enqueue_parser.add_argument('settings', nargs='*',
+                                help='Course settings files, directories, or glob patterns')
+    enqueue_parser.add_argument('--requeue', action='store_true',
+                                help=('Return failed items, and claims with expired leases, '
+                                      'to pending'))
+    enqueue_parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS,
+                                help=('Seconds after its last heartbeat (every '
+                                      + str(HEARTBEAT_SECONDS) + ' seconds) at which a claim '
+                                      'expires (default: %(default)s)'))
+
+    work_parser = subparsers.add_parser('work', help='Run work items from a work queue')
+    work_parser.add_argument('queue_dir', help='Work queue directory')
+    add_worker_arguments(work_parser)
+
+    merge_parser = subparsers.add_parser('merge', help='Collect outputs of completed items')
+    merge_parser.add_argument('queue_dir', help='Work queue directory')
+    for merge_args_parser in (run_parser, merge_parser):
+        merge_args_parser.add_argument(
+            '--io-dir', default=Query_GPT4_Exam.IO_DIR,
+            help='Directory to merge outputs into (default: %(default)s)'
+        )
+    args = parser.parse_args()
+
+    if args.command in ('run', 'enqueue'):
+        added = enqueue(args.queue_dir, find_settings_files(args.settings),
+                        requeue=getattr(args, 'requeue', False),
+                        lease_seconds=getattr(args, 'lease_seconds', DEFAULT_LEASE_SECONDS))
+        print('Queued', added, 'work items in:', args.queue_dir)
+    if args.command in ('run', 'work'):
+        work_counts = work_processes(args.queue_dir, args.processes,
+                                     worker_config_from_args(args), machines=args.machines)
+        print('Work items done:', work_counts['done'], ' failed:', work_counts['failed'])
+    if args.command in ('run', 'merge'):
+        io_dir = os.path.abspath(args.io_dir)
+        print('\n' + merge_str(merge(args.queue_dir, io_dir), io_dir))
+
+    print('\nDone.\n')
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""
+Buffered background writer for report files.
+
+Writes to report files are queued and performed by a single background thread, so threads
+waiting on the API never block on file I/O. Queued writes are batched per file and flushed to
+the operating system every flush interval; sync() (called once per turn, before the turn is
+journaled) flushes and fsyncs the files of a report in a single batch and waits until they are
+on disk. Closing a file, or the
+writer, drains all queued writes first, and the writer is closed at interpreter exit, so no
+queued write is lost on a clean shutdown. After a crash, a file holds at least every write
+before its last sync(), which is all that conversation journals refer to.
+"""
+
+import os
+import time
+import queue
+import atexit
+import threading
+from Profile_GPT4_Exam import span
+
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+# Report file whose writes are performed by a Report_Writer.
+class Report_File():
+    """
+    Report file whose writes are performed by a Report_Writer.
+
+    The file size is tracked as writes are queued, so tell() does not wait for the writer.
+    Text is written as UTF-8.
+    """
+
+    def __init__(self, writer, file_name, mode='w', truncate=None):
+        """
+        Open the file ("w" or "a" mode) to be written by writer.
+
+        If truncate is provided, the file is first truncated to truncate bytes.
+        """
+        if mode not in ('w', 'a'):
+            raise ValueError('Report file mode must be "w" or "a", not: ' + str(mode))
+        if truncate is not None:
+            with open(file_name, 'ab') as truncate_file_obj:
+                truncate_file_obj.truncate(truncate)
+        self.writer = writer
+        self.file_name = file_name
+        self.file_obj = open(file_name, mode + 'b')
+        self.size = self.file_obj.tell()
+        self.error = None
+
+    def write(self, text):
+        """Queue text to be written to the file."""
+        data = text.encode('utf-8')
+        self.size += len(data)
+        self.writer.submit('write', (self,), data)
+
+    def tell(self):
+        """Return the size of the file once all queued writes are performed."""
+        return self.size
+
+    def truncate(self, size):
+        """Queue truncation of the file to size bytes, after all previously queued writes."""
+        self.size = size
+        self.writer.submit('truncate', (self,), size)
+
+    def sync(self):
+        """Perform all queued writes and force them to disk."""
+        self.writer.sync((self,))
+
+    def close(self):
+        """Perform all queued writes, force them to disk, and close the file."""
+        self.writer.submit('close', (self,), wait=True)
+
+
+# Single background thread performing queued writes to report files.
+class Report_Writer():
+    """
+    Single background thread performing queued writes to report files.
+
+    Writes to each file are performed in the order they were queued. An error in an operation
+    on a file is raised once, in the next call that queues an operation on that file.
+    """
+
+    def __init__(self, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        """Prepare the writer; the background thread is started on the first write."""
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def open(self, file_name, mode='w', truncate=None):
+        """Open a Report_File written by this writer."""
+        return Report_File(self, file_name, mode=mode, truncate=truncate)
+
+    def raise_error(self, report_files):
+        """Raise (and clear) the error of a failed operation on any of report_files."""
+        for report_file in report_files:
+            with self.lock:
+                error, report_file.error = report_file.error, None
+            if error is not None:
+                raise error
+
+    def submit(self, operation, report_files, data=None, wait=False):
+        """
+        Queue an operation ("write", "truncate", "sync", or "close") on a tuple of report files.
+
+        Writes, truncations, and closes are queued on a single file; a sync may cover several
+        files. If wait is True, wait until the operation has been performed.
+        """
+        self.raise_error(report_files)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+        done = threading.Event() if wait else None
+        self.queue.put((operation, report_files, data, done))
+        if done is not None:
+            done.wait()
+            self.raise_error(report_files)
+
+    def sync(self, report_files):
+        """Perform all queued writes to report_files and force them to disk, as one batch."""
+        self.submit('sync', tuple(report_files), wait=True)
+
+    def perform(self, report_file, action):
+        """
+        Perform action on the file object of report_file in the background thread.
+
+        An error is recorded against report_file (unless one is already pending), to be raised
+        in the next call queuing an operation on it.
+        """
+        try:
+            action(report_file.file_obj)
+        except Exception as error:
+            with self.lock:
+                if report_file.error is None:
+                    report_file.error = error
+
+    def run(self):
+        """Perform queued operations, flushing written files every flush_interval seconds."""
+        dirty_files = set()
+        next_flush = None
+        while True:
+            try:
+                timeout = None if next_flush is None else max(0.0, next_flush - time.monotonic())
+                operation, report_files, data, done = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                operation, report_files, data, done = None, (), None, None
+
+            if operation == 'write':
+                self.perform(report_files[0], lambda file_obj: file_obj.write(data))
+                dirty_files.add(report_files[0])
+                if next_flush is None:
+                    next_flush = time.monotonic() + self.flush_interval
+            elif operation == 'truncate':
+                self.perform(report_files[0], lambda file_obj: (
+                    file_obj.flush(), file_obj.truncate(data), file_obj.seek(data)
+                ))
+            elif operation in ('sync', 'close'):
+                # Flush every file before forcing any to disk, so their fsyncs are batched.
+                with span('report.fsync', files=len(report_files)):
+                    for report_file in report_files:
+                        self.perform(report_file, lambda file_obj: file_obj.flush())
+                    for report_file in report_files:
+                        self.perform(report_file, lambda file_obj: os.fsync(file_obj.fileno()))
+                        dirty_files.discard(report_file)
+                if operation == 'close':
+                    self.perform(report_files[0], lambda file_obj: file_obj.close())
+            elif operation == 'stop':
+                for dirty_file in dirty_files:
+                    self.perform(dirty_file, lambda file_obj: file_obj.flush())
+                    self.perform(dirty_file, lambda file_obj: os.fsync(file_obj.fileno()))
+                return
+
+            # Flush all written files to the operating system once per flush interval.
+            if next_flush is not None and time.monotonic() >= next_flush:
+                with span('report.flush', files=len(dirty_files)):
+                    for dirty_file in dirty_files:
+                        self.perform(dirty_file, lambda file_obj: file_obj.flush())
+                dirty_files.clear()
+                next_flush = None
+            if done is not None:
+                done.set()
+
+    def close(self):
+        """Perform all queued writes, force written files to disk, and stop the thread."""
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None:
+            atexit.unregister(self.close)
+            self.queue.put(('stop', None, None, None))
+            thread.join()
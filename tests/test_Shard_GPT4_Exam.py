@@ -0,0 +1,55 @@
+#!/usr/bin/env python3.8
+# Daniel Stribling  |  ORCID: 0000-0002-0649-9506
+# University of Florida
+# GPT4_Biomed_Assessment Project
+
+"""Tests of the filesystem work queue of Shard_GPT4_Exam.py."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Shard_GPT4_Exam  # noqa: E402
+
+WORKER_CONFIG = {'rpm': 1000, 'tpm': 100000, 'cache': 'off'}
+
+
+# A failed item that is requeued and then runs successfully ends up in done.
+def test_requeued_failed_item_completes(tmp_path, monkeypatch):
+    """A failed item that is requeued and then runs successfully ends up in done."""
+    queue_dir = str(tmp_path / 'queue')
+    settings_file = str(tmp_path / 'Example_Course_settings.json')
+    assert Shard_GPT4_Exam.enqueue(queue_dir, [settings_file], template_names=['Simple']) == 1
+
+    run_results = [RuntimeError('Simulated failure'), None]
+
+    def run_item(item, dirs, worker_config, io_dir):
+        result = run_results.pop(0)
+        if result is not None:
+            raise result
+    monkeypatch.setattr(Shard_GPT4_Exam, 'run_item', run_item)
+
+    dirs = Shard_GPT4_Exam.queue_dirs(queue_dir)
+    assert Shard_GPT4_Exam.work(queue_dir, WORKER_CONFIG) == {'done': 0, 'failed': 1}
+    assert len(os.listdir(dirs['failed'])) == 1
+
+    assert Shard_GPT4_Exam.enqueue(queue_dir, [], requeue=True) == 1
+    assert Shard_GPT4_Exam.work(queue_dir, WORKER_CONFIG) == {'done': 1, 'failed': 0}
+    assert os.listdir(dirs['failed']) == []
+    assert len(os.listdir(dirs['done'])) == 1
+
+
+# Claimed items start with a fresh lease, so a requeue does not take them from their worker.
+def test_claimed_item_is_not_requeued(tmp_path):
+    """Claimed items start with a fresh lease, so a requeue does not take them from a worker."""
+    queue_dir = str(tmp_path / 'queue')
+    settings_file = str(tmp_path / 'Example_Course_settings.json')
+    Shard_GPT4_Exam.enqueue(queue_dir, [settings_file], template_names=['Simple'])
+    dirs = Shard_GPT4_Exam.queue_dirs(queue_dir)
+    (item_file_name,) = os.listdir(dirs['pending'])
+    os.utime(os.path.join(dirs['pending'], item_file_name), (0, 0))
+
+    assert Shard_GPT4_Exam.claim_item(dirs) is not None
+    assert Shard_GPT4_Exam.enqueue(queue_dir, [], requeue=True) == 0
+    assert os.listdir(dirs['claimed']) == [item_file_name]